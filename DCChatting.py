@@ -1,1497 +1,4255 @@
-import os
-import sys
-import socket
-import threading
-import time
-import datetime
-import json
-import pickle
-import uuid
-import platform
-from tkinter import *
-from tkinter import ttk, messagebox, filedialog, scrolledtext
-from PIL import Image, ImageTk, ImageDraw, ImageOps, ImageFont
-import base64
-import io
-
-# 全局配置
-BROADCAST_PORT = 12345
-TCP_PORT = 54321
-BUFFER_SIZE = 4096
-HEARTBEAT_INTERVAL = 5  # 心跳间隔(秒)
-DISCOVERY_INTERVAL = 10  # 设备发现间隔(秒)
-OFFLINE_TIMEOUT = 30  # 设备超时时间(秒)
-MAX_RECORD_FILE_SIZE = 512 * 1024 * 1024  # 512MB
-DEFAULT_AVATAR_SIZE = 100  # 默认头像尺寸
-
-class NetworkDevice:
-    def __init__(self, ip, mac, name, avatar=None, timestamp=None):
-        self.ip = ip
-        self.mac = mac
-        self.name = name
-        self.avatar = avatar or self.generate_default_avatar(name)
-        self.timestamp = timestamp or time.time()
-        self.is_online = True
-        self.unread_messages = 0
-        
-    def update_timestamp(self):
-        self.timestamp = time.time()
-        
-    def check_online(self):
-        self.is_online = (time.time() - self.timestamp) < OFFLINE_TIMEOUT
-        return self.is_online
-        
-    def __str__(self):
-        return f"{self.name} ({self.ip})"
-    
-    def to_dict(self):
-        """只包含基本信息，不包含完整头像，解决广播包过大问题"""
-        return {
-            "ip": self.ip,
-            "mac": self.mac,
-            "name": self.name,
-            "timestamp": self.timestamp
-        }
-    
-    def avatar_base64(self):
-        if isinstance(self.avatar, bytes):
-            return base64.b64encode(self.avatar).decode('utf-8')
-        return self.avatar
-    
-    def generate_default_avatar(self, name):
-        """使用Data\Image\目录下的headimg1~5.png作为默认头像，如果不存在则生成"""
-        default_avatars = []
-        # 检查是否存在自定义默认头像
-        img_dir = os.path.join("Data", "Image")
-        for i in range(1, 6):
-            img_path = os.path.join(img_dir, f"headimg{i}.png")
-            if os.path.exists(img_path):
-                try:
-                    with open(img_path, 'rb') as f:
-                        default_avatars.append(f.read())
-                except:
-                    continue
-        
-        # 如果有可用的默认头像
-        if default_avatars:
-            return default_avatars[hash(name) % len(default_avatars)]
-        
-        # 如果没有自定义头像，生成默认头像
-        colors = ['#FF6B6B', '#4ECDC4', '#45B7D1', '#FFA07A', '#98D8C8']
-        color = colors[hash(name) % len(colors)]
-        
-        img = Image.new('RGBA', (DEFAULT_AVATAR_SIZE, DEFAULT_AVATAR_SIZE), (0, 0, 0, 0))
-        draw = ImageDraw.Draw(img)
-        draw.ellipse((0, 0, DEFAULT_AVATAR_SIZE-1, DEFAULT_AVATAR_SIZE-1), fill=color)
-        
-        if name:
-            letter = name[0].upper()
-            font = ImageFont.load_default()
-            font = font.font_variant(size=int(DEFAULT_AVATAR_SIZE/2))
-            draw.text((DEFAULT_AVATAR_SIZE/2, DEFAULT_AVATAR_SIZE/2), 
-                      letter, fill="white", font=font, anchor="mm")
-        
-        img_byte_arr = io.BytesIO()
-        img.save(img_byte_arr, format='PNG')
-        return img_byte_arr.getvalue()
-    
-    @staticmethod
-    def create_avatar_from_base64(avatar_str):
-        if avatar_str:
-            try:
-                return base64.b64decode(avatar_str.encode('utf-8'))
-            except:
-                pass
-        return None
-    
-    def get_safe_mac(self):
-        """获取安全的MAC地址，用于文件名"""
-        return self.mac.replace(':', '_')
-
-class LanChatApp:
-    def __init__(self, root):
-        self.root = root
-        self.root.title("DCChatting | 局域网通信工具")
-        self.root.geometry("1000x700")
-        self.root.resizable(True, True)
-        
-        # 设置窗口图标
-        self.set_window_icon()
-        
-        # 创建数据目录和图片目录
-        self.data_dir = "Data"
-        self.image_dir = os.path.join(self.data_dir, "Image")
-        os.makedirs(self.data_dir, exist_ok=True)
-        os.makedirs(self.image_dir, exist_ok=True)
-        
-        # 线程锁，确保共享数据安全
-        self.devices_lock = threading.Lock()
-        self.connections_lock = threading.Lock()
-        
-        # 获取本地设备信息
-        self.local_device = self.get_local_device()
-        self.devices = {}  # MAC -> NetworkDevice
-        self.connections = {}  # IP -> socket
-        self.active_chats = {}  # device_name -> chat_info
-        
-        # 当前选中的聊天设备
-        self.current_chat_device = None
-        
-        # 创建主界面
-        self.create_main_interface()
-        
-        # 启动网络服务
-        self.running = True
-        self.start_networking()
-        
-        # 启动设备发现线程
-        threading.Thread(target=self.discovery_loop, daemon=True).start()
-        
-        # 启动心跳线程
-        threading.Thread(target=self.heartbeat_loop, daemon=True).start()
-        
-        # 启动超时检查线程
-        threading.Thread(target=self.timeout_check_loop, daemon=True).start()
-        
-        # 关闭窗口时的清理
-        self.root.protocol("WM_DELETE_WINDOW", self.on_closing)
-    
-    def set_window_icon(self):
-        """设置窗口图标为当前目录下的icon.ico"""
-        try:
-            if os.path.exists("icon.ico"):
-                self.root.iconbitmap("icon.ico")
-        except Exception as e:
-            print(f"设置图标失败: {e}")
-    
-    def get_local_ip(self):
-        """获取非本地的IP地址"""
-        try:
-            # 尝试连接到外部服务器获取IP
-            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            s.connect(("8.8.8.8", 80))
-            ip = s.getsockname()[0]
-            s.close()
-            if not ip.startswith("127."):
-                return ip
-        except:
-            pass
-            
-        # 如果连接外部失败，遍历所有网络接口
-        for interface in socket.if_nameindex():
-            try:
-                sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-                sock.bind((interface[1], 0))
-                sock.connect(("8.8.8.8", 80))
-                ip = sock.getsockname()[0]
-                sock.close()
-                if not ip.startswith("127."):
-                    return ip
-            except:
-                continue
-                
-        return "127.0.0.1"
-    
-    def get_local_device(self):
-        # 获取本机IP地址
-        ip = self.get_local_ip()
-        
-        # 获取MAC地址
-        mac = ':'.join(['{:02x}'.format((uuid.getnode() >> elements) & 0xff) 
-                       for elements in range(0,2*6,2)][::-1])
-        
-        # 获取计算机名作为默认名称
-        name = platform.node()
-        
-        # 尝试从配置文件加载用户设置的名称
-        name_config_path = os.path.join(self.data_dir, "username.txt")
-        if os.path.exists(name_config_path):
-            try:
-                with open(name_config_path, 'r', encoding='utf-8') as f:
-                    saved_name = f.read().strip()
-                    if saved_name:
-                        name = saved_name
-            except:
-                pass
-        
-        # 创建默认头像
-        avatar = None
-        
-        # 尝试加载自定义头像
-        avatar_path = os.path.join(self.data_dir, "avatar.png")
-        if os.path.exists(avatar_path):
-            try:
-                img = Image.open(avatar_path)
-                img = self.crop_to_circle(img)
-                img_byte_arr = io.BytesIO()
-                img.save(img_byte_arr, format='PNG')
-                avatar = img_byte_arr.getvalue()
-            except:
-                pass
-        
-        return NetworkDevice(ip, mac, name, avatar)
-    
-    def save_username(self, username):
-        """保存用户名到配置文件"""
-        try:
-            name_config_path = os.path.join(self.data_dir, "username.txt")
-            with open(name_config_path, 'w', encoding='utf-8') as f:
-                f.write(username)
-            return True
-        except Exception as e:
-            print(f"保存用户名失败: {e}")
-            return False
-    
-    def change_username(self):
-        """修改用户名对话框"""
-        def apply_change():
-            new_name = entry.get().strip()
-            if new_name and new_name != self.local_device.name:
-                old_name = self.local_device.name
-                self.local_device.name = new_name
-                # 保存到配置文件
-                self.save_username(new_name)
-                # 更新UI显示
-                self.local_name_label.config(text=new_name)
-                # 广播名称更新
-                self.broadcast_name_change(old_name, new_name)
-                top.destroy()
-        
-        top = Toplevel(self.root)
-        top.title("修改用户名")
-        top.geometry("300x150")
-        top.resizable(False, False)
-        top.transient(self.root)
-        top.grab_set()
-        
-        frame = ttk.Frame(top, padding=20)
-        frame.pack(fill=BOTH, expand=True)
-        
-        ttk.Label(frame, text="请输入新的用户名:").pack(anchor=W, pady=5)
-        
-        entry = ttk.Entry(frame)
-        entry.pack(fill=X, pady=10)
-        entry.insert(0, self.local_device.name)
-        entry.focus()
-        
-        btn_frame = ttk.Frame(frame)
-        btn_frame.pack(fill=X)
-        
-        ttk.Button(btn_frame, text="取消", command=top.destroy).pack(side=RIGHT, padx=5)
-        ttk.Button(btn_frame, text="确定", command=apply_change).pack(side=RIGHT)
-        
-        # 按Enter键确认
-        entry.bind("<Return>", lambda e: apply_change())
-    
-    def broadcast_name_change(self, old_name, new_name):
-        """广播名称变更信息给所有在线计算机"""
-        # 立即广播设备信息
-        self.broadcast_device_info()
-        
-        # 向所有已连接设备发送名称变更消息
-        name_change_msg = pickle.dumps({
-            'type': 'name_change',
-            'old_name': old_name,
-            'new_name': new_name,
-            'mac': self.local_device.mac
-        })
-        
-        with self.connections_lock:
-            for sock in list(self.connections.values()):
-                try:
-                    sock.send(name_change_msg)
-                except Exception as e:
-                    print(f"发送名称变更消息失败: {e}")
-        
-        # 更新本地设备列表中的名称
-        with self.devices_lock:
-            for device in self.devices.values():
-                if device.name == old_name:
-                    device.name = new_name
-                    break
-        
-        # 更新设备列表显示
-        self.update_devices_listbox()
-        
-        # 如果当前正在与改名设备聊天，更新聊天窗口
-        if self.current_chat_device and self.current_chat_device.name == old_name:
-            self.current_chat_device.name = new_name
-            self.create_chat_interface(self.current_chat_device)
-    
-    def crop_to_circle(self, img):
-        """将图像裁剪为圆形"""
-        size = min(img.size)
-        mask = Image.new('L', (size, size), 0)
-        draw = ImageDraw.Draw(mask)
-        draw.ellipse((0, 0, size, size), fill=255)
-        
-        output = ImageOps.fit(img, (size, size), centering=(0.5, 0.5))
-        output.putalpha(mask)
-        return output
-    
-    def create_main_interface(self):
-        # 创建主框架
-        main_frame = ttk.Frame(self.root)
-        main_frame.pack(fill=BOTH, expand=True, padx=10, pady=10)
-        
-        # 分割左右面板
-        paned_window = ttk.PanedWindow(main_frame, orient=HORIZONTAL)
-        paned_window.pack(fill=BOTH, expand=True)
-        
-        # 左侧设备面板
-        left_frame = ttk.Frame(paned_window, width=250)
-        paned_window.add(left_frame, weight=0)
-        
-        # 标题、头像和名称修改按钮
-        self.title_frame = ttk.Frame(left_frame)
-        self.title_frame.pack(fill=X, pady=(0, 10))
-        
-        # 显示本地头像
-        self.local_avatar_img = self.create_avatar_image(self.local_device.avatar, 60)
-        avatar_label = ttk.Label(self.title_frame, image=self.local_avatar_img)
-        avatar_label.image = self.local_avatar_img
-        avatar_label.pack(side=LEFT, padx=(0, 10))
-        
-        # 名称和修改按钮
-        name_frame = ttk.Frame(self.title_frame)
-        name_frame.pack(side=LEFT, fill=X, expand=True)
-        
-        # 设备名称 - 使用单独的变量引用以便更新
-        self.local_name_label = ttk.Label(name_frame, text=self.local_device.name, 
-                 font=("Arial", 12, "bold"))
-        self.local_name_label.pack(anchor=W)
-        
-        # 修改名称按钮
-        ttk.Button(name_frame, text="修改名称", width=8, 
-                  command=self.change_username).pack(anchor=W)
-        
-        # 更改头像按钮
-        ttk.Button(self.title_frame, text="更改头像", width=10, 
-                  command=self.change_avatar).pack(side=RIGHT, padx=(10, 0))
-        
-        # 搜索框
-        search_frame = ttk.Frame(left_frame)
-        search_frame.pack(fill=X, pady=(0, 10))
-        
-        self.search_var = StringVar()
-        search_entry = ttk.Entry(search_frame, textvariable=self.search_var)
-        search_entry.pack(side=LEFT, fill=X, expand=True, padx=(0, 5))
-        search_entry.bind("<KeyRelease>", self.filter_devices)
-        
-        ttk.Button(search_frame, text="搜索", 
-                  command=self.filter_devices).pack(side=LEFT)
-        
-        # 在线设备列表
-        devices_frame = ttk.LabelFrame(left_frame, text="在线设备")
-        devices_frame.pack(fill=BOTH, expand=True)
-        
-        # 创建Treeview
-        self.devices_tree = ttk.Treeview(devices_frame, columns=["name"], show="headings")
-        self.devices_tree.column("name", width=180)
-        self.devices_tree.heading("name", text="设备名称")
-        
-        scrollbar = ttk.Scrollbar(devices_frame, orient=VERTICAL, 
-                                 command=self.devices_tree.yview)
-        self.devices_tree.configure(yscrollcommand=scrollbar.set)
-        
-        scrollbar.pack(side=RIGHT, fill=Y)
-        self.devices_tree.pack(fill=BOTH, expand=True, padx=0, pady=0)
-        
-        # 绑定选择事件
-        self.devices_tree.bind('<<TreeviewSelect>>', self.on_device_select)
-        
-        # 右侧聊天面板
-        self.right_frame = ttk.Frame(paned_window)
-        paned_window.add(self.right_frame, weight=1)
-        
-        # 创建初始聊天界面
-        self.create_chat_placeholder()
-        
-        # 状态栏
-        self.status_var = StringVar()
-        self.status_var.set("就绪")
-        status_bar = ttk.Label(self.root, textvariable=self.status_var, relief=SUNKEN, anchor=W)
-        status_bar.pack(side=BOTTOM, fill=X)
-    
-    def create_chat_placeholder(self):
-        # 清除右侧面板
-        for widget in self.right_frame.winfo_children():
-            widget.destroy()
-        
-        # 创建占位界面
-        placeholder_frame = ttk.Frame(self.right_frame)
-        placeholder_frame.pack(fill=BOTH, expand=True, padx=50, pady=50)
-        
-        # 添加提示信息
-        ttk.Label(placeholder_frame, text="局域网通信工具", 
-                 font=("Arial", 24, "bold"), foreground="#4e8cff").pack(pady=20)
-        
-        # 添加图标
-        try:
-            img = Image.open("chat_icon.png")
-        except:
-            # 创建默认图标
-            img = Image.new('RGB', (256, 256), color='white')
-            draw = ImageDraw.Draw(img)
-            draw.ellipse((50, 50, 206, 206), outline='#4e8cff', width=10)
-            draw.line((80, 180, 176, 180), fill='#4e8cff', width=10)
-        
-        img = img.resize((200, 200), Image.LANCZOS)
-        self.chat_img = ImageTk.PhotoImage(img)
-        
-        ttk.Label(placeholder_frame, image=self.chat_img).pack(pady=20)
-        
-        info_text = "请从左侧设备列表中选择一个设备开始聊天\n\n"
-        info_text += "功能说明:\n"
-        info_text += "- 搜索框可以按名称过滤设备\n"
-        info_text += "- 点击设备可以开始聊天\n"
-        info_text += "- 支持文本消息和文件传输\n"
-        info_text += "- 聊天记录自动保存并分页存储\n"
-        info_text += "- 可以更改个人头像和用户名"
-        
-        ttk.Label(placeholder_frame, text=info_text, 
-                 font=("Arial", 11), justify=LEFT).pack(pady=10)
-    
-    def create_chat_interface(self, device):
-        # 清除右侧面板
-        for widget in self.right_frame.winfo_children():
-            widget.destroy()
-        
-        # 创建聊天主框架
-        chat_frame = ttk.Frame(self.right_frame)
-        chat_frame.pack(fill=BOTH, expand=True, padx=10, pady=10)
-        
-        # 聊天头部 (显示对方信息)
-        header_frame = ttk.Frame(chat_frame)
-        header_frame.pack(fill=X, pady=(0, 10))
-        
-        # 显示对方头像
-        avatar_img = self.create_avatar_image(device.avatar, 50)
-        avatar_label = ttk.Label(header_frame, image=avatar_img)
-        avatar_label.image = avatar_img
-        avatar_label.pack(side=LEFT, padx=(0, 10))
-        
-        # 对方信息
-        info_frame = ttk.Frame(header_frame)
-        info_frame.pack(side=LEFT, fill=X, expand=True)
-        
-        # 对方名称标签 - 使用变量以便后续更新
-        self.current_chat_name_label = ttk.Label(info_frame, text=device.name, 
-                 font=("Arial", 14, "bold"))
-        self.current_chat_name_label.pack(anchor=W)
-        
-        status_text = "在线" if device.is_online else "离线"
-        status_color = "green" if device.is_online else "gray"
-        ttk.Label(info_frame, text=status_text, 
-                 font=("Arial", 10), foreground=status_color).pack(anchor=W)
-        
-        # 聊天记录区域
-        chat_history_frame = ttk.LabelFrame(chat_frame, text="聊天记录")
-        chat_history_frame.pack(fill=BOTH, expand=True, pady=(0, 10))
-        
-        chat_text = scrolledtext.ScrolledText(chat_history_frame, wrap=WORD, state="disabled")
-        chat_text.pack(fill=BOTH, expand=True, padx=5, pady=5)
-        
-        # 输入区域
-        input_frame = ttk.Frame(chat_frame)
-        input_frame.pack(fill=X, pady=(0, 10))
-        
-        input_entry = ttk.Entry(input_frame)
-        input_entry.pack(side=LEFT, fill=X, expand=True, padx=(0, 5))
-        input_entry.bind("<Return>", lambda e: self.send_message(device, input_entry))
-        
-        send_btn = ttk.Button(input_frame, text="发送", 
-                             command=lambda: self.send_message(device, input_entry))
-        send_btn.pack(side=LEFT)
-        
-        # 文件发送按钮
-        file_btn = ttk.Button(input_frame, text="发送文件", 
-                             command=lambda: self.send_file(device))
-        file_btn.pack(side=LEFT, padx=(5, 0))
-        
-        # 管理记录按钮
-        manage_btn = ttk.Button(input_frame, text="管理记录", 
-                              command=self.manage_records)
-        manage_btn.pack(side=RIGHT, padx=(5, 0))
-        
-        # 保存聊天界面引用
-        self.active_chats[device.name] = {
-            "text_widget": chat_text,
-            "input_entry": input_entry,
-            "device": device,
-            "name_label": self.current_chat_name_label
-        }
-        
-        # 加载历史消息
-        self.load_history_messages(device, chat_text)
-        
-        # 重置未读消息计数
-        with self.devices_lock:
-            device.unread_messages = 0
-        self.update_devices_listbox()
-    
-    def create_avatar_image(self, avatar_data, size):
-        """从字节数据创建头像图像"""
-        try:
-            if avatar_data:
-                img = Image.open(io.BytesIO(avatar_data))
-            else:
-                # 创建默认头像
-                img = Image.new('RGBA', (size, size), (0, 0, 0, 0))
-                draw = ImageDraw.Draw(img)
-                draw.ellipse((0, 0, size-1, size-1), fill="#4e8cff")
-        except:
-            # 创建默认头像
-            img = Image.new('RGBA', (size, size), (0, 0, 0, 0))
-            draw = ImageDraw.Draw(img)
-            draw.ellipse((0, 0, size-1, size-1), fill="#4e8cff")
-        
-        # 调整大小并转换为圆形
-        img = img.resize((size, size), Image.LANCZOS)
-        img = self.crop_to_circle(img)
-        return ImageTk.PhotoImage(img)
-    
-    def start_networking(self):
-        # 启动UDP广播监听
-        self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-        self.udp_socket.bind(('0.0.0.0', BROADCAST_PORT))
-        
-        # 启动TCP服务器
-        self.tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.tcp_socket.bind(('0.0.0.0', TCP_PORT))
-        self.tcp_socket.listen(5)
-        
-        # 启动线程处理网络通信
-        threading.Thread(target=self.udp_listener, daemon=True).start()
-        threading.Thread(target=self.tcp_listener, daemon=True).start()
-    
-    def udp_listener(self):
-        while self.running:
-            try:
-                data, addr = self.udp_socket.recvfrom(BUFFER_SIZE)
-                device_info = json.loads(data.decode('utf-8'))
-                
-                # 忽略自己的广播
-                if device_info['mac'] == self.local_device.mac:
-                    continue
-                
-                # 更新设备列表
-                with self.devices_lock:
-                    # 检查设备是否已存在
-                    if device_info['mac'] in self.devices:
-                        # 只更新时间戳和名称
-                        self.devices[device_info['mac']].timestamp = time.time()
-                        self.devices[device_info['mac']].name = device_info['name']
-                        self.devices[device_info['mac']].ip = device_info['ip']
-                    else:
-                        # 创建新设备
-                        device = NetworkDevice(
-                            device_info['ip'],
-                            device_info['mac'],
-                            device_info['name'],
-                            timestamp=time.time()
-                        )
-                        self.devices[device.mac] = device
-                
-                self.update_devices_listbox()
-                
-            except Exception as e:
-                if self.running:
-                    print(f"UDP监听错误: {e}")
-    
-    def tcp_listener(self):
-        while self.running:
-            try:
-                client_socket, addr = self.tcp_socket.accept()
-                threading.Thread(target=self.handle_tcp_connection, args=(client_socket, addr), daemon=True).start()
-            except Exception as e:
-                if self.running:
-                    print(f"TCP监听错误: {e}")
-    
-    def handle_tcp_connection(self, client_socket, addr):
-        device = None
-        try:
-            # 接收设备信息
-            data = client_socket.recv(BUFFER_SIZE)
-            if not data:
-                return
-                
-            device_info = json.loads(data.decode('utf-8'))
-            mac = device_info['mac']
-            
-            # 检查是否已知设备
-            with self.devices_lock:
-                if mac in self.devices:
-                    device = self.devices[mac]
-                else:
-                    device = NetworkDevice(addr[0], mac, device_info['name'])
-                    self.devices[mac] = device
-            
-            # 发送本地头像
-            client_socket.send(pickle.dumps({
-                'type': 'avatar',
-                'content': self.local_device.avatar_base64()
-            }))
-            
-            # 接收对方头像
-            try:
-                avatar_data = client_socket.recv(BUFFER_SIZE)
-                if avatar_data:
-                    avatar_msg = pickle.loads(avatar_data)
-                    if avatar_msg['type'] == 'avatar':
-                        with self.devices_lock:
-                            device.avatar = NetworkDevice.create_avatar_from_base64(avatar_msg['content'])
-            except:
-                pass
-            
-            # 更新设备列表
-            self.update_devices_listbox()
-            
-            # 保存连接
-            with self.connections_lock:
-                self.connections[device.ip] = client_socket
-            
-            # 打开聊天窗口
-            if device.name in self.active_chats and self.current_chat_device == device:
-                self.create_chat_interface(device)
-            elif not self.current_chat_device:
-                self.create_chat_interface(device)
-                self.current_chat_device = device
-            
-            # 持续接收数据
-            while self.running:
-                try:
-                    data = client_socket.recv(BUFFER_SIZE)
-                    if not data:
-                        break
-                        
-                    # 尝试解析消息
-                    try:
-                        message = pickle.loads(data)
-                        if message['type'] == 'text':
-                            self.receive_message(device, message['content'])
-                        elif message['type'] == 'file_metadata':
-                            # 处理文件传输
-                            self.handle_file_reception(client_socket, device, message)
-                        elif message['type'] == 'name_change':
-                            # 处理名称变更
-                            self.handle_name_change(message['old_name'], message['new_name'], message['mac'])
-                        elif message['type'] == 'avatar_update':
-                            # 处理头像更新
-                            with self.devices_lock:
-                                if message['mac'] in self.devices:
-                                    self.devices[message['mac']].avatar = NetworkDevice.create_avatar_from_base64(message['content'])
-                            self.update_devices_listbox()
-                            if self.current_chat_device and self.current_chat_device.mac == message['mac']:
-                                self.create_chat_interface(self.current_chat_device)
-                    except Exception as e:
-                        print(f"解析消息错误: {e}")
-                except Exception as e:
-                    print(f"接收数据错误: {e}")
-                    break
-                
-        except Exception as e:
-            print(f"TCP连接处理错误: {e}")
-        finally:
-            if device:
-                with self.connections_lock:
-                    if device.ip in self.connections:
-                        del self.connections[device.ip]
-            try:
-                client_socket.close()
-            except:
-                pass
-    
-    def handle_name_change(self, old_name, new_name, mac):
-        """处理接收到的名称变更消息"""
-        with self.devices_lock:
-            if mac in self.devices:
-                device = self.devices[mac]
-                device.name = new_name
-        
-        # 更新设备列表显示
-        self.update_devices_listbox()
-        
-        # 更新聊天窗口引用
-        if old_name in self.active_chats:
-            chat_info = self.active_chats.pop(old_name)
-            self.active_chats[new_name] = chat_info
-            self.active_chats[new_name]['device'].name = new_name
-            
-            # 更新聊天窗口中的名称标签
-            if 'name_label' in chat_info:
-                chat_info['name_label'].config(text=new_name)
-            else:
-                # 如果找不到标签引用，重新创建聊天界面
-                if self.current_chat_device and self.current_chat_device.mac == mac:
-                    self.create_chat_interface(self.current_chat_device)
-        
-        # 如果正在聊天，刷新聊天窗口
-        if self.current_chat_device and self.current_chat_device.mac == mac:
-            self.current_chat_device.name = new_name
-            self.create_chat_interface(self.current_chat_device)
-    
-    def broadcast_device_info(self):
-        """立即广播设备信息"""
-        device_info = {
-            'ip': self.local_device.ip,
-            'mac': self.local_device.mac,
-            'name': self.local_device.name,
-            'timestamp': self.local_device.timestamp
-        }
-        
-        try:
-            self.udp_socket.sendto(
-                json.dumps(device_info).encode('utf-8'),
-                ('<broadcast>', BROADCAST_PORT)
-            )
-        except Exception as e:
-            print(f"广播错误: {e}")
-    
-    def discovery_loop(self):
-        while self.running:
-            # 广播设备信息
-            self.broadcast_device_info()
-            time.sleep(DISCOVERY_INTERVAL)
-    
-    def heartbeat_loop(self):
-        while self.running:
-            # 向所有连接的设备发送心跳
-            with self.connections_lock:
-                for ip, sock in list(self.connections.items()):
-                    try:
-                        sock.send(b'HEARTBEAT')
-                    except:
-                        if ip in self.connections:
-                            del self.connections[ip]
-            
-            time.sleep(HEARTBEAT_INTERVAL)
-    
-    def timeout_check_loop(self):
-        while self.running:
-            # 检查设备超时
-            offline_devices = []
-            with self.devices_lock:
-                for mac, device in list(self.devices.items()):
-                    if not device.check_online():
-                        offline_devices.append(mac)
-            
-            with self.devices_lock:
-                for mac in offline_devices:
-                    if mac in self.devices:
-                        del self.devices[mac]
-            
-            if offline_devices:
-                self.update_devices_listbox()
-            
-            time.sleep(5)
-    
-    def update_devices_listbox(self):
-        # 清空现有项
-        for item in self.devices_tree.get_children():
-            self.devices_tree.delete(item)
-        
-        # 获取搜索关键词
-        search_term = self.search_var.get().lower()
-        
-        # 添加设备到列表
-        with self.devices_lock:
-            # 按名称排序设备
-            sorted_devices = sorted(self.devices.values(), key=lambda d: d.name)
-            
-            for device in sorted_devices:
-                # 过滤搜索结果
-                if search_term and search_term not in device.name.lower():
-                    continue
-                
-                # 创建显示文本（包含未读消息计数）
-                display_text = device.name
-                if device.unread_messages > 0:
-                    display_text += f" ({device.unread_messages})"
-                
-                # 设置字体样式
-                tags = []
-                if device.unread_messages > 0:
-                    self.devices_tree.tag_configure("unread", font=("Arial", 10, "bold"), foreground="blue")
-                    tags.append("unread")
-                elif not device.is_online:
-                    self.devices_tree.tag_configure("offline", font=("Arial", 10), foreground="gray")
-                    tags.append("offline")
-                else:
-                    self.devices_tree.tag_configure("online", font=("Arial", 10), foreground="black")
-                    tags.append("online")
-                
-                # 添加到Treeview
-                self.devices_tree.insert("", END, values=[display_text], tags=tags)
-    
-    def on_device_select(self, event):
-        # 获取选中的设备
-        selection = self.devices_tree.selection()
-        if not selection:
-            return
-            
-        item = selection[0]
-        display_text = self.devices_tree.item(item, "values")[0]
-        device_name = display_text.split(' (')[0]  # 移除未读计数
-        
-        # 找到对应的设备对象
-        device = None
-        with self.devices_lock:
-            for dev in self.devices.values():
-                if dev.name == device_name:
-                    device = dev
-                    break
-        
-        if not device:
-            return
-            
-        # 尝试连接到设备（如果尚未连接）
-        with self.connections_lock:
-            if device.ip not in self.connections:
-                try:
-                    # 创建TCP连接
-                    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                    sock.settimeout(10)  # 设置连接超时
-                    sock.connect((device.ip, TCP_PORT))
-                    
-                    # 发送本地设备信息
-                    device_info = {
-                        'ip': self.local_device.ip,
-                        'mac': self.local_device.mac,
-                        'name': self.local_device.name
-                    }
-                    sock.send(json.dumps(device_info).encode('utf-8'))
-                    
-                    # 发送头像
-                    sock.send(pickle.dumps({
-                        'type': 'avatar',
-                        'content': self.local_device.avatar_base64()
-                    }))
-                    
-                    # 接收对方头像
-                    try:
-                        avatar_data = sock.recv(BUFFER_SIZE)
-                        if avatar_data:
-                            avatar_msg = pickle.loads(avatar_data)
-                            if avatar_msg['type'] == 'avatar':
-                                with self.devices_lock:
-                                    device.avatar = NetworkDevice.create_avatar_from_base64(avatar_msg['content'])
-                    except:
-                        pass
-                    
-                    # 保存连接
-                    self.connections[device.ip] = sock
-                    
-                    # 启动线程处理这个连接
-                    threading.Thread(target=self.handle_tcp_connection, args=(sock, (device.ip, TCP_PORT)), daemon=True).start()
-                except Exception as e:
-                    messagebox.showerror("连接失败", f"无法连接到设备: {e}")
-                    return
-        
-        # 设置当前聊天设备
-        self.current_chat_device = device
-        
-        # 创建聊天界面
-        self.create_chat_interface(device)
-    
-    def send_message(self, device, input_entry):
-        message = input_entry.get().strip()
-        if not message:
-            return
-            
-        input_entry.delete(0, END)
-        
-        # 保存消息到本地
-        self.save_message(device, message, sent=True)
-        
-        # 更新聊天窗口
-        if device.name in self.active_chats:
-            chat = self.active_chats[device.name]
-            self.append_message(chat["text_widget"], 
-                              f"我 ({datetime.datetime.now().strftime('%H:%M:%S')}): {message}")
-        
-        # 发送消息
-        with self.connections_lock:
-            if device.ip in self.connections:
-                try:
-                    data = pickle.dumps({
-                        'type': 'text',
-                        'content': message
-                    })
-                    self.connections[device.ip].send(data)
-                except Exception as e:
-                    print(f"发送消息失败: {e}")
-                    messagebox.showerror("发送失败", "无法发送消息")
-    
-    def receive_message(self, device, message):
-        # 保存消息
-        self.save_message(device, message, sent=False)
-        
-        # 更新聊天窗口
-        if device.name in self.active_chats and self.current_chat_device == device:
-            chat = self.active_chats[device.name]
-            self.append_message(chat["text_widget"], 
-                              f"{device.name} ({datetime.datetime.now().strftime('%H:%M:%S')}): {message}")
-        else:
-            # 增加未读消息计数
-            with self.devices_lock:
-                device.unread_messages += 1
-            self.update_devices_listbox()
-    
-    def send_file(self, device):
-        filepath = filedialog.askopenfilename(title="选择要发送的文件")
-        if not filepath:
-            return
-            
-        filename = os.path.basename(filepath)
-        
-        try:
-            # 检查文件大小
-            file_size = os.path.getsize(filepath)
-            if file_size > MAX_RECORD_FILE_SIZE:
-                messagebox.showerror("文件过大", f"文件大小不能超过{MAX_RECORD_FILE_SIZE//(1024*1024)}MB")
-                return
-                
-            # 读取文件内容
-            with open(filepath, 'rb') as f:
-                file_data = f.read()
-                
-            # 保存文件到本地记录
-            self.save_file(device, filename, file_data, sent=True)
-            
-            # 更新聊天窗口
-            if device.name in self.active_chats:
-                chat = self.active_chats[device.name]
-                self.append_message(chat["text_widget"], 
-                                  f"我 ({datetime.datetime.now().strftime('%H:%M:%S')}): 发送文件 '{filename}'")
-            
-            # 发送文件
-            with self.connections_lock:
-                if device.ip in self.connections:
-                    try:
-                        # 先发送文件元数据
-                        metadata = pickle.dumps({
-                            'type': 'file_metadata',
-                            'filename': filename,
-                            'size': len(file_data)
-                        })
-                        self.connections[device.ip].send(metadata)
-                        
-                        # 等待确认，增加超时和重试机制
-                        ready_received = False
-                        retries = 3
-                        timeout = 5  # 5秒超时
-                        
-                        for attempt in range(retries):
-                            try:
-                                # 设置超时
-                                self.connections[device.ip].settimeout(timeout)
-                                response = self.connections[device.ip].recv(BUFFER_SIZE)
-                                if response == b'READY':
-                                    ready_received = True
-                                    break
-                            except socket.timeout:
-                                print(f"等待READY超时，尝试 {attempt + 1}/{retries}")
-                                # 重新发送元数据
-                                self.connections[device.ip].send(metadata)
-                            except Exception as e:
-                                print(f"接收READY错误: {e}")
-                                break
-                        
-                        # 恢复超时设置
-                        self.connections[device.ip].settimeout(None)
-                        
-                        if not ready_received:
-                            raise Exception("接收方未准备好或超时")
-                            
-                        # 分块发送文件数据
-                        offset = 0
-                        while offset < len(file_data):
-                            chunk = file_data[offset:offset+BUFFER_SIZE]
-                            self.connections[device.ip].send(pickle.dumps({
-                                'type': 'file_chunk',
-                                'content': chunk
-                            }))
-                            offset += BUFFER_SIZE
-                            
-                        # 发送结束标志
-                        self.connections[device.ip].send(pickle.dumps({
-                            'type': 'file_end'
-                        }))
-                        
-                        # 更新聊天窗口，显示发送成功
-                        if device.name in self.active_chats:
-                            chat = self.active_chats[device.name]
-                            self.append_message(chat["text_widget"], 
-                                              f"文件 '{filename}' 发送成功")
-                            
-                    except Exception as e:
-                        error_msg = f"无法发送文件: {e}"
-                        print(error_msg)
-                        messagebox.showerror("发送失败", error_msg)
-                        
-                        # 更新聊天窗口，显示发送失败
-                        if device.name in self.active_chats:
-                            chat = self.active_chats[device.name]
-                            self.append_message(chat["text_widget"], 
-                                              f"文件 '{filename}' 发送失败: {e}")
-        except Exception as e:
-            error_msg = f"读取文件失败: {e}"
-            print(error_msg)
-            messagebox.showerror("错误", error_msg)
-
-    def handle_file_reception(self, sock, device, metadata):
-        """处理文件接收"""
-        try:
-            filename = metadata['filename']
-            file_size = metadata['size']
-            
-            # 立即发送准备就绪确认
-            sock.send(b'READY')
-            
-            # 接收文件内容
-            file_data = b''
-            start_time = time.time()
-            timeout = 30  # 30秒超时
-            
-            while len(file_data) < file_size:
-                # 检查超时
-                if time.time() - start_time > timeout:
-                    raise Exception("文件接收超时")
-                    
-                chunk_data = sock.recv(BUFFER_SIZE)
-                if not chunk_data:
-                    raise Exception("连接中断")
-                    
-                try:
-                    chunk = pickle.loads(chunk_data)
-                    if chunk['type'] == 'file_end':
-                        break
-                    if chunk['type'] == 'file_chunk':
-                        file_data += chunk['content']
-                except:
-                    # 如果无法解析，可能是数据损坏，继续接收
-                    file_data += chunk_data
-            
-            # 检查文件完整性
-            if len(file_data) != file_size:
-                raise Exception(f"文件不完整，期望 {file_size} 字节，收到 {len(file_data)} 字节")
-            
-            # 保存文件
-            self.save_file(device, filename, file_data, sent=False)
-            
-            # 更新聊天窗口
-            if device.name in self.active_chats and self.current_chat_device == device:
-                chat = self.active_chats[device.name]
-                self.append_message(chat["text_widget"], 
-                                  f"{device.name} ({datetime.datetime.now().strftime('%H:%M:%S')}): 发送文件 '{filename}'")
-                
-                # 添加另存为按钮
-                save_frame = Frame(chat["text_widget"].master)
-                save_frame.pack(fill=X, padx=5, pady=2)
-                
-                ttk.Label(save_frame, text=f"收到文件: {filename}").pack(side=LEFT, padx=(0, 10))
-                ttk.Button(save_frame, text="另存为", 
-                          command=lambda: self.save_file_as(device, filename, file_data)).pack(side=LEFT)
-                
-                # 将小部件插入到文本区域
-                chat["text_widget"].window_create(END, window=save_frame)
-                chat["text_widget"].insert(END, "\n")
-                chat["text_widget"].see(END)
-            else:
-                # 增加未读消息计数
-                with self.devices_lock:
-                    device.unread_messages += 1
-                self.update_devices_listbox()
-                
-        except Exception as e:
-            error_msg = f"文件接收错误: {e}"
-            print(error_msg)
-            # 发送错误通知给发送方
-            try:
-                sock.send(pickle.dumps({
-                    'type': 'file_error',
-                    'message': error_msg
-                }))
-            except:
-                pass
-    
-    def save_file_as(self, device, filename, file_data):
-        save_path = filedialog.asksaveasfilename(
-            title="保存文件",
-            initialfile=filename
-        )
-        
-        if save_path:
-            try:
-                with open(save_path, 'wb') as f:
-                    f.write(file_data)
-                messagebox.showinfo("成功", "文件保存成功")
-            except Exception as e:
-                messagebox.showerror("错误", f"保存文件失败: {e}")
-    
-    def get_current_record_file(self, device_dir):
-        """获取当前记录文件，如果超过大小则创建新文件"""
-        # 获取所有记录文件
-        record_files = [f for f in os.listdir(device_dir) 
-                      if f.startswith("Records") and f.endswith(".dc")]
-        
-        if not record_files:
-            return os.path.join(device_dir, "Records1.dc")
-        
-        # 按文件编号排序
-        record_files.sort(key=lambda f: int(f[7:-3]) if f[7:-3].isdigit() else 0)
-        latest_file = os.path.join(device_dir, record_files[-1])
-        
-        # 检查文件大小
-        if os.path.getsize(latest_file) < MAX_RECORD_FILE_SIZE:
-            return latest_file
-        
-        # 创建新文件
-        file_number = 1
-        if record_files:
-            # 获取最大文件编号
-            last_num = int(record_files[-1][7:-3])
-            file_number = last_num + 1
-        
-        return os.path.join(device_dir, f"Records{file_number}.dc")
-    
-    def save_message(self, device, message, sent):
-        # 使用MAC地址而不是名称作为目录名
-        safe_mac = device.get_safe_mac()
-        device_dir = os.path.join(self.data_dir, safe_mac)
-        os.makedirs(device_dir, exist_ok=True)
-        
-        # 保存设备信息元数据
-        device_info = {
-            'mac': device.mac,
-            'name': device.name,
-            'last_known_name': device.name,
-            'ip': device.ip
-        }
-        device_info_path = os.path.join(device_dir, 'device_info.json')
-        with open(device_info_path, 'w', encoding='utf-8') as f:
-            json.dump(device_info, f, ensure_ascii=False)
-        
-        # 获取当前记录文件
-        record_file = self.get_current_record_file(device_dir)
-        
-        # 创建消息记录
-        record = {
-            'timestamp': time.time(),
-            'sent': sent,
-            'content': message,
-            'sender_name': self.local_device.name if sent else device.name
-        }
-        
-        # 追加到文件
-        with open(record_file, 'a', encoding='utf-8') as f:
-            f.write(json.dumps(record, ensure_ascii=False) + "\n")
-    
-    def save_file(self, device, filename, file_data, sent):
-        # 使用MAC地址而不是名称作为目录名
-        safe_mac = device.get_safe_mac()
-        device_dir = os.path.join(self.data_dir, safe_mac)
-        os.makedirs(device_dir, exist_ok=True)
-        
-        # 保存设备信息元数据
-        device_info = {
-            'mac': device.mac,
-            'name': device.name,
-            'last_known_name': device.name,
-            'ip': device.ip
-        }
-        device_info_path = os.path.join(device_dir, 'device_info.json')
-        with open(device_info_path, 'w', encoding='utf-8') as f:
-            json.dump(device_info, f, ensure_ascii=False)
-        
-        # 创建文件目录
-        files_dir = os.path.join(device_dir, "Files")
-        os.makedirs(files_dir, exist_ok=True)
-        
-        # 保存文件
-        filepath = os.path.join(files_dir, filename)
-        
-        # 如果文件已存在，添加后缀
-        counter = 1
-        base, ext = os.path.splitext(filename)
-        while os.path.exists(filepath):
-            filename = f"{base}_{counter}{ext}"
-            filepath = os.path.join(files_dir, filename)
-            counter += 1
-        
-        with open(filepath, 'wb') as f:
-            f.write(file_data)
-        
-        # 记录文件传输
-        record = {
-            'timestamp': time.time(),
-            'sent': sent,
-            'filename': filename,
-            'filepath': filepath,
-            'sender_name': self.local_device.name if sent else device.name
-        }
-        
-        # 添加到消息记录
-        record_file = self.get_current_record_file(device_dir)
-        with open(record_file, 'a', encoding='utf-8') as f:
-            f.write(json.dumps(record, ensure_ascii=False) + "\n")
-    
-    def load_history_messages(self, device, text_widget):
-        # 使用MAC地址而不是名称作为目录名
-        safe_mac = device.get_safe_mac()
-        device_dir = os.path.join(self.data_dir, safe_mac)
-        
-        if not os.path.exists(device_dir):
-            return
-            
-        # 获取所有记录文件
-        record_files = [f for f in os.listridir(device_dir) 
-                      if f.startswith("Records") and f.endswith(".dc")]
-        record_files.sort(key=lambda f: int(f[7:-3]) if f[7:-3].isdigit() else 0)
-        
-        # 清空当前显示
-        text_widget.config(state=NORMAL)
-        text_widget.delete(1.0, END)
-        
-        # 读取所有记录
-        for file in record_files:
-            with open(os.path.join(device_dir, file), 'r', encoding='utf-8') as f:
-                lines = f.readlines()
-                
-            # 显示消息
-            for line in lines:
-                try:
-                    record = json.loads(line.strip())
-                    
-                    timestamp = datetime.datetime.fromtimestamp(record['timestamp']).strftime('%Y-%m-%d %H:%M:%S')
-                    sender_name = record.get('sender_name', '未知')
-                    
-                    if 'content' in record:
-                        # 文本消息
-                        self.append_message(text_widget, f"{sender_name} ({timestamp}): {record['content']}")
-                    elif 'filename' in record:
-                        # 文件消息
-                        self.append_message(text_widget, f"{sender_name} ({timestamp}): 发送文件 '{record['filename']}'")
-                        
-                        if not record['sent']:
-                            # 添加另存为按钮
-                            save_frame = Frame(text_widget.master)
-                            ttk.Label(save_frame, text=f"收到文件: {record['filename']}").pack(side=LEFT, padx=(0, 10))
-                            ttk.Button(save_frame, text="另存为", 
-                                      command=lambda f=record['filepath'], n=record['filename']: self.save_file_from_history(f, n)).pack(side=LEFT)
-                            
-                            text_widget.window_create(END, window=save_frame)
-                            text_widget.insert(END, "\n")
-                except:
-                    pass
-                
-        text_widget.see(END)
-        text_widget.config(state="disabled")
-    
-    def save_file_from_history(self, filepath, filename):
-        if not os.path.exists(filepath):
-            messagebox.showerror("错误", "文件不存在或已被删除")
-            return
-            
-        save_path = filedialog.asksaveasfilename(
-            title="保存文件",
-            initialfile=filename
-        )
-        
-        if save_path:
-            try:
-                with open(filepath, 'rb') as src, open(save_path, 'wb') as dest:
-                    dest.write(src.read())
-                messagebox.showinfo("成功", "文件保存成功")
-            except Exception as e:
-                messagebox.showerror("错误", f"保存文件失败: {e}")
-    
-    def append_message(self, text_widget, message):
-        text_widget.config(state=NORMAL)
-        text_widget.insert(END, message + "\n")
-        text_widget.config(state="disabled")
-        text_widget.see(END)
-    
-    def manage_records(self):
-        # 创建记录管理窗口
-        manage_win = Toplevel(self.root)
-        manage_win.title("管理聊天记录")
-        manage_win.geometry("400x300")
-        
-        # 时间选项
-        ttk.Label(manage_win, text="删除超过以下时间的记录:").pack(pady=(10, 5))
-        
-        time_options = [
-            ("7天之前", 7),
-            ("14天之前", 14),
-            ("30天之前", 30),
-            ("60天之前", 60),
-            ("180天之前", 180),
-            ("所有记录", -1)
-        ]
-        
-        selected_time = IntVar(value=7)
-        
-        for text, days in time_options:
-            ttk.Radiobutton(manage_win, text=text, variable=selected_time, value=days).pack(anchor=W, padx=20)
-        
-        # 删除按钮
-        ttk.Button(manage_win, text="删除记录", 
-                  command=lambda: self.delete_records(manage_win, selected_time.get())).pack(pady=20)
-    
-    def delete_records(self, window, days):
-        if days == -1:
-            # 删除所有记录
-            confirm = messagebox.askyesno("确认", "确定要删除所有聊天记录吗？")
-            if not confirm:
-                return
-        else:
-            confirm = messagebox.askyesno("确认", f"确定要删除{days}天之前的所有聊天记录吗？")
-            if not confirm:
-                return
-        
-        # 计算时间阈值
-        threshold = time.time() - (days * 24 * 60 * 60) if days > 0 else 0
-        
-        # 遍历所有设备记录
-        deleted_records = 0
-        deleted_files = 0
-        
-        for device_name in os.listdir(self.data_dir):
-            device_dir = os.path.join(self.data_dir, device_name)
-            if not os.path.isdir(device_dir):
-                continue
-                
-            # 处理所有记录文件
-            record_files = [f for f in os.listdir(device_dir) 
-                          if f.startswith("Records") and f.endswith(".dc")]
-            
-            for record_file in record_files:
-                file_path = os.path.join(device_dir, record_file)
-                
-                # 读取所有记录
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    lines = f.readlines()
-                
-                # 过滤记录
-                new_lines = []
-                for line in lines:
-                    try:
-                        record = json.loads(line.strip())
-                        if record['timestamp'] >= threshold:
-                            new_lines.append(line)
-                        else:
-                            deleted_records += 1
-                            
-                            # 如果是文件记录，删除文件
-                            if 'filepath' in record and os.path.exists(record['filepath']):
-                                try:
-                                    os.remove(record['filepath'])
-                                    deleted_files += 1
-                                except:
-                                    pass
-                    except:
-                        new_lines.append(line)
-                
-                # 重写文件
-                with open(file_path, 'w', encoding='utf-8') as f:
-                    f.writelines(new_lines)
-        
-        # 显示结果
-        messagebox.showinfo("完成", f"已删除 {deleted_records} 条记录和 {deleted_files} 个文件")
-        
-        # 刷新当前聊天窗口
-        if self.current_chat_device and self.current_chat_device.name in self.active_chats:
-            chat_info = self.active_chats[self.current_chat_device.name]
-            text_widget = chat_info["text_widget"]
-            # 重新加载历史消息
-            self.load_history_messages(self.current_chat_device, text_widget)
-        
-        window.destroy()
-    
-    def filter_devices(self, event=None):
-        # 更新设备列表以应用过滤
-        self.update_devices_listbox()
-    
-    def change_avatar(self):
-        # 选择新头像
-        filepath = filedialog.askopenfilename(
-            title="选择头像图片",
-            filetypes=[("图片文件", "*.png;*.jpg;*.jpeg;*.gif;*.bmp")]
-        )
-        
-        if not filepath:
-            return
-            
-        try:
-            # 加载并处理图片
-            img = Image.open(filepath)
-            img.thumbnail((200, 200))  # 限制头像大小
-            img = self.crop_to_circle(img)
-            
-            # 保存为PNG
-            avatar_path = os.path.join(self.data_dir, "avatar.png")
-            img.save(avatar_path, "PNG", optimize=True, quality=80)
-            
-            # 更新本地设备头像
-            img_byte_arr = io.BytesIO()
-            img.save(img_byte_arr, format='PNG')
-            self.local_device.avatar = img_byte_arr.getvalue()
-            
-            # 更新UI头像
-            self.local_avatar_img = self.create_avatar_image(self.local_device.avatar, 60)
-            
-            # 更新左侧头像
-            for widget in self.title_frame.winfo_children():
-                if isinstance(widget, ttk.Label) and hasattr(widget, 'image'):
-                    widget.configure(image=self.local_avatar_img)
-                    widget.image = self.local_avatar_img
-                    break
-            
-            # 广播头像更新
-            with self.connections_lock:
-                for sock in self.connections.values():
-                    try:
-                        sock.send(pickle.dumps({
-                            'type': 'avatar_update',
-                            'content': self.local_device.avatar_base64(),
-                            'mac': self.local_device.mac
-                        }))
-                    except:
-                        pass
-            
-            messagebox.showinfo("成功", "头像已更新")
-        except Exception as e:
-            messagebox.showerror("错误", f"无法加载图片: {e}")
-    
-    def on_closing(self):
-        self.running = False
-        
-        # 关闭所有连接
-        with self.connections_lock:
-            for sock in self.connections.values():
-                try:
-                    sock.close()
-                except:
-                    pass
-        
-        # 关闭套接字
-        try:
-            self.udp_socket.close()
-        except:
-            pass
-            
-        try:
-            self.tcp_socket.close()
-        except:
-            pass
-            
-        self.root.destroy()
-
-if __name__ == "__main__":
-    root = Tk()
-    app = LanChatApp(root)
-    root.mainloop()
+import os
+import sys
+import socket
+import threading
+import asyncio
+import queue
+import time
+import datetime
+import json
+import uuid
+import platform
+import shutil
+import errno
+import struct
+import hashlib
+import zlib
+import math
+import collections
+import heapq
+import contextlib
+import itertools
+import functools
+import re
+import random
+from array import array
+from tkinter import *
+from tkinter import ttk, messagebox, filedialog, scrolledtext
+from PIL import Image, ImageTk, ImageDraw, ImageOps, ImageFont
+import base64
+import io
+
+# 全局配置
+BROADCAST_PORT = 12345
+TCP_PORT = 54321
+BUFFER_SIZE = 4096
+HEARTBEAT_INTERVAL = 5  # 心跳间隔(秒)
+DISCOVERY_INTERVAL = 10  # 设备发现广播间隔下限(秒)
+DISCOVERY_MAX_INTERVAL = 60  # 设备发现广播间隔上限(秒)，在线设备越多间隔越长
+DISCOVERY_TARGET_RATE = 20  # 全网设备发现广播的目标总速率(包/秒)
+DISCOVERY_JITTER = 0.25  # 广播间隔随机抖动比例，避免多台设备同时广播
+DISCOVERY_REPLY_SPREAD = 0.5  # 单播回复发现查询前的随机延迟上限(秒)
+OFFLINE_TIMEOUT = 30  # 设备超时时间下限(秒)，至少为对方广播间隔的3倍
+DEPARTED_DEVICE_LIMIT = 1024  # 保留的已离线设备对象数量上限，重新上线时沿用
+BEACON_CACHE_SIZE = 1024  # 缓存原始广播的地址数量上限，超出时淘汰最久未收到广播的地址
+MAX_RECORD_FILE_SIZE = 512 * 1024 * 1024  # 512MB
+RETENTION_CHECK_INTERVAL = 6 * 60 * 60  # 自动清理记录的检查间隔(秒)
+RETENTION_STARTUP_DELAY = 60  # 启动后首次自动清理的延迟(秒)
+HISTORY_PAGE_SIZE = 50  # 聊天记录每页条数，打开聊天时只加载最近一页
+SEARCH_RESULT_LIMIT = 200  # 聊天记录搜索结果条数上限
+SEARCH_CATCH_UP_BATCH = 1000  # 补建搜索索引时每批读取的记录数
+
+# 搜索分词：连续的中日韩文字或连续的字母数字
+TOKEN_PATTERN = re.compile(r'[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]+|[0-9a-z_]+')
+CJK_PATTERN = re.compile(r'[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]')
+DEFAULT_AVATAR_SIZE = 100  # 默认头像尺寸
+AVATAR_IMAGE_CACHE_SIZE = 64  # 界面中缓存的已渲染头像数量上限
+RECV_BUFFER_SIZE = 64 * 1024  # TCP单次接收缓冲区大小
+MAX_FRAME_SIZE = 16 * 1024 * 1024  # 单帧负载上限
+FILE_CHUNK_SIZE = 256 * 1024  # 文件数据帧大小
+FILE_IDLE_TIMEOUT = 30  # 文件接收空闲超时(秒)
+FILE_SEND_ROUNDS = 3  # 发送方补发校验失败数据块的最大轮数
+RESUME_STATE_INTERVAL = 1.0  # 接收方保存断点状态的间隔(秒)
+SEND_BUFFER_HIGH_WATER = 256 * 1024  # 传输层发送缓冲区高水位，保持较小使控制消息可以插队
+OUTBOUND_BULK_LIMIT = 1024 * 1024  # 单连接待发送文件数据上限，超过时发送方等待
+OUTBOUND_CONTROL_LIMIT = 16 * 1024 * 1024  # 单连接待发送控制消息上限，超过时视为对方已停止接收
+STREAM_WINDOW = 2 * 1024 * 1024  # 每个传输流未被接收方处理的数据上限，超过时发送方等待对方归还额度
+COMPRESS_LEVEL = 1  # zlib最快档，压缩速度优先
+COMPRESS_MIN_SIZE = 4096  # 小于该大小的数据不压缩
+COMPRESS_MAX_RATIO = 0.9  # 压缩后仍超过原大小该比例时按原样发送
+COMPRESS_ENTROPY_LIMIT = 7.5  # 抽样熵(比特/字节)高于该值视为不可压缩
+COMPRESS_SAMPLE_SIZE = 4096  # 估算熵的抽样大小
+# 本身已压缩的文件格式，直接按原样发送
+COMPRESSED_EXTENSIONS = {
+    '.zip', '.gz', '.tgz', '.bz2', '.xz', '.7z', '.rar', '.zst', '.lz4', '.cab', '.jar', '.apk',
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic', '.mp3', '.aac', '.ogg', '.flac', '.m4a',
+    '.mp4', '.mkv', '.avi', '.mov', '.wmv', '.webm', '.docx', '.xlsx', '.pptx', '.pdf', '.msi',
+}
+CONNECT_TIMEOUT = 10  # 主动连接和握手超时(秒)
+LISTEN_BACKLOG = 128  # 等待接受的TCP连接队列长度
+MAX_CONCURRENT_HANDSHAKES = 32  # 同时进行握手的入站连接数上限
+HANDSHAKE_QUEUE_LIMIT = 64  # 排队等待握手的入站连接数上限，超出时直接关闭新连接
+MAX_CONNECTIONS_PER_PEER = 4  # 同一地址握手中和已建立的入站连接数上限，防止对方反复重连
+TRANSFER_STALL_THRESHOLD = 0.5  # 传输超过该时长(秒)没有进展时计入停顿时间
+TRANSFER_HISTORY_SIZE = 100  # 统计中保留的已结束传输数量
+LATENCY_SMOOTHING = 0.125  # 往返时延平滑系数，与TCP计算SRTT相同
+STATS_WRITE_INTERVAL = 5  # 写出统计文件的间隔(秒)
+METRICS_REFRESH_INTERVAL = 1000  # 传输监控窗口的刷新间隔(毫秒)
+UI_POLL_INTERVAL = 50  # 界面线程处理网络事件的间隔(毫秒)
+
+# 帧协议: 1字节帧类型 + 4字节负载长度(网络字节序) + 负载
+FRAME_HEADER = struct.Struct('!BI')
+FRAME_MESSAGE = 1  # 控制消息
+FRAME_HEARTBEAT = 2  # 心跳
+FRAME_READY = 3  # 文件接收就绪确认
+FRAME_FILE_DATA = 4  # 文件原始数据（协议版本1，按顺序写入）
+FRAME_FILE_CHUNK = 5  # 带序号和SHA-256校验的文件数据块（协议版本2起）
+FRAME_BATCH_CHUNK = 6  # 批量发送中的数据块，附带文件序号（协议版本4起）
+FRAME_COMPRESSED = 7  # zlib压缩的帧：1字节原帧类型 + 压缩后的原负载（协议版本5起，接收时自动还原）
+FRAME_STREAM = 8  # 属于某个传输流的帧：4字节流编号 + 1字节原帧类型 + 原负载（协议版本7起）
+FRAME_HEARTBEAT_ACK = 9  # 心跳回复：原样带回心跳中的发送时间，用于测量往返时延（协议版本8起）
+HEARTBEAT_STAMP = struct.Struct('!d')
+CHUNK_HEADER = struct.Struct('!I32s')
+BATCH_CHUNK_HEADER = struct.Struct('!II32s')
+STREAM_HEADER = struct.Struct('!IB')
+
+def encode_frame(frame_type, payload=b''):
+    """将负载封装为一帧"""
+    return FRAME_HEADER.pack(frame_type, len(payload)) + payload
+
+# 消息编码: 1字节协议版本 + 1字节消息类型 + 按模式顺序排列的类型化字段
+# 字段格式为 (名称, 类型, 起始版本)，编码时只写入当前版本支持的字段，便于后续扩展
+PROTOCOL_VERSION = 8  # 本机支持的最高协议版本
+MIN_PROTOCOL_VERSION = 1  # 本机支持的最低协议版本
+HANDSHAKE_VERSION = 1  # 握手消息固定使用的版本，保证任意版本都能解析
+MESSAGE_HEADER = struct.Struct('!BB')
+
+FIELD_STRUCTS = {
+    'u8': struct.Struct('!B'),
+    'u32': struct.Struct('!I'),
+    'u64': struct.Struct('!Q'),
+    'f64': struct.Struct('!d'),
+    'bool': struct.Struct('!?'),
+}
+FIELD_DEFAULTS = {'u8': 0, 'u32': 0, 'u64': 0, 'f64': 0.0, 'bool': False, 'str': '', 'bytes': b''}
+LENGTH_STRUCT = FIELD_STRUCTS['u32']
+
+MESSAGE_SCHEMAS = {
+    'hello': (1, [('ip', 'str', 1), ('mac', 'str', 1), ('name', 'str', 1),
+                  ('min_version', 'u8', 1), ('max_version', 'u8', 1)]),
+    # 协议版本6起握手和头像更新只携带头像哈希，内容为空，对方未缓存时用avatar_request获取
+    'avatar': (2, [('content', 'bytes', 1), ('avatar_hash', 'str', 6)]),
+    'text': (3, [('content', 'str', 1)]),
+    'name_change': (4, [('old_name', 'str', 1), ('new_name', 'str', 1), ('mac', 'str', 1)]),
+    'avatar_update': (5, [('content', 'bytes', 1), ('mac', 'str', 1), ('avatar_hash', 'str', 6)]),
+    # 协议版本7起每次传输使用发送方分配的流编号，数据帧和结束标志封装在FRAME_STREAM中，多个传输和聊天消息共用连接
+    'file_metadata': (6, [('filename', 'str', 1), ('size', 'u64', 1),
+                          ('file_id', 'str', 2), ('chunk_size', 'u32', 2), ('sha256', 'str', 3),
+                          ('stream_id', 'u32', 7)]),
+    'file_end': (7, []),
+    'file_error': (8, [('message', 'str', 1), ('stream_id', 'u32', 7)]),
+    # 接收方已收到的数据块位图，收到元数据和结束标志后各回复一次；已有相同内容的文件时回复全部已收到
+    'file_resume': (9, [('file_id', 'str', 2), ('received', 'bytes', 2), ('stream_id', 'u32', 7)]),
+    # 批量发送：清单为JSON [[相对路径, 大小, sha256], ...]，之后所有文件的数据块连续发送，不再逐个握手
+    'batch_manifest': (10, [('batch_id', 'str', 4), ('name', 'str', 4), ('manifest', 'str', 4),
+                            ('stream_id', 'u32', 7)]),
+    'batch_resume': (11, [('batch_id', 'str', 4), ('received', 'bytes', 4), ('stream_id', 'u32', 7)]),
+    'batch_end': (12, [('batch_id', 'str', 4)]),
+    'avatar_request': (13, [('avatar_hash', 'str', 6)]),
+    # 接收方处理完数据后归还给发送方的流量额度(字节)
+    'window_update': (14, [('stream_id', 'u32', 7), ('credit', 'u32', 7)]),
+}
+
+def compile_schema(fields, version):
+    """将字段列表编译为编解码步骤：相邻的定长字段合并为一个struct，变长字段单独处理"""
+    steps = []
+    for name, kind, since in fields:
+        if since > version:
+            continue
+        if kind in ('str', 'bytes'):
+            steps.append((None, name, kind == 'str'))
+        elif steps and steps[-1][0] is not None:
+            fmt, names, kinds = steps[-1]
+            steps[-1] = (fmt + FIELD_STRUCTS[kind].format[1:], names + (name,), kinds + (kind,))
+        else:
+            steps.append(('!' + FIELD_STRUCTS[kind].format[1:], (name,), (kind,)))
+    return [(struct.Struct(step[0]),) + step[1:] if step[0] is not None else step for step in steps]
+
+# (类型ID, 版本) -> (消息名, 编解码步骤)，以及消息名未指定版本时的缺省字段
+def build_schema_tables():
+    compiled, defaults = {}, {}
+    for name, (type_id, fields) in MESSAGE_SCHEMAS.items():
+        defaults[name] = {field: FIELD_DEFAULTS[kind] for field, kind, since in fields}
+        for version in range(MIN_PROTOCOL_VERSION, PROTOCOL_VERSION + 1):
+            compiled[(type_id, version)] = (name, compile_schema(fields, version))
+    return compiled, defaults
+
+COMPILED_SCHEMAS, SCHEMA_DEFAULTS = build_schema_tables()
+
+def encode_message(message, version=PROTOCOL_VERSION):
+    """按消息模式编码为二进制"""
+    type_id = MESSAGE_SCHEMAS[message['type']][0]
+    parts = [MESSAGE_HEADER.pack(version, type_id)]
+    for step in COMPILED_SCHEMAS[(type_id, version)][1]:
+        if step[0] is None:
+            value = message.get(step[1])
+            if value is None:
+                value = b''
+            elif step[2]:
+                value = value.encode('utf-8')
+            parts.append(LENGTH_STRUCT.pack(len(value)))
+            parts.append(value)
+        else:
+            fmt, names, kinds = step
+            parts.append(fmt.pack(*[message.get(name) or FIELD_DEFAULTS[kind] for name, kind in zip(names, kinds)]))
+    return b''.join(parts)
+
+def decode_message(payload):
+    """解码二进制消息，数据不合法时抛出ValueError"""
+    try:
+        version, type_id = MESSAGE_HEADER.unpack_from(payload, 0)
+        name, steps = COMPILED_SCHEMAS[(type_id, version)]
+        message = dict(SCHEMA_DEFAULTS[name])
+        message['type'] = name
+        offset = MESSAGE_HEADER.size
+        for step in steps:
+            if step[0] is None:
+                length, = LENGTH_STRUCT.unpack_from(payload, offset)
+                offset += 4
+                end = offset + length
+                if end > len(payload):
+                    raise ValueError("字段长度超出消息范围")
+                value = payload[offset:end]
+                message[step[1]] = value.decode('utf-8') if step[2] else bytes(value)
+                offset = end
+            else:
+                fmt, names = step[0], step[1]
+                message.update(zip(names, fmt.unpack_from(payload, offset)))
+                offset += fmt.size
+        return message
+    except (struct.error, KeyError, UnicodeDecodeError) as e:
+        raise ValueError(f"消息格式错误: {e}")
+
+def is_end_message(frame_type, payload, end_type):
+    """判断传输流中的帧是否为指定的结束标志"""
+    return frame_type == FRAME_MESSAGE and decode_message(bytes(payload))['type'] == end_type
+
+def negotiate_version(hello):
+    """根据对方hello消息协商双方共同支持的最高协议版本"""
+    version = min(PROTOCOL_VERSION, hello.get('max_version') or HANDSHAKE_VERSION)
+    if version < max(MIN_PROTOCOL_VERSION, hello.get('min_version') or HANDSHAKE_VERSION):
+        raise ValueError(f"协议版本不兼容: 对方支持 {hello.get('min_version')}-{hello.get('max_version')}")
+    return version
+
+def make_file_id(filepath):
+    """根据路径、大小和修改时间生成文件ID，文件不变时重新发送可以续传"""
+    stat = os.stat(filepath)
+    key = f"{os.path.abspath(filepath)}|{stat.st_size}|{stat.st_mtime_ns}"
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()[:32]
+
+def estimate_entropy(data):
+    """估算数据中间一段的字节熵(比特/字节)，用于快速判断是否值得压缩"""
+    start = max(0, len(data) // 2 - COMPRESS_SAMPLE_SIZE // 2)
+    sample = bytes(data[start:start + COMPRESS_SAMPLE_SIZE])
+    if not sample:
+        return 0.0
+    n = len(sample)
+    return -sum(c / n * math.log2(c / n) for c in collections.Counter(sample).values())
+
+def decompress_frame(payload):
+    """还原压缩帧，返回 (原帧类型, 原负载)，数据不合法时抛出ValueError"""
+    try:
+        decompressor = zlib.decompressobj()
+        data = decompressor.decompress(memoryview(payload)[1:], MAX_FRAME_SIZE)
+        if decompressor.unconsumed_tail or not decompressor.eof:
+            raise ValueError("压缩帧超出大小限制或不完整")
+        return payload[0], data
+    except (zlib.error, IndexError) as e:
+        raise ValueError(f"压缩帧格式错误: {e}")
+
+class ChunkCompressor:
+    """决定每个数据块是否压缩：已压缩格式和高熵数据直接跳过，压缩效果不明显时按原样发送，并统计压缩效果"""
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self.file_enabled = enabled
+        self.raw_bytes = 0
+        self.wire_bytes = 0
+    
+    def start_file(self, filename):
+        self.file_enabled = self.enabled and os.path.splitext(filename)[1].lower() not in COMPRESSED_EXTENSIONS
+    
+    def pack(self, frame_type, payload):
+        """返回实际发送的 (帧类型, 负载)"""
+        self.raw_bytes += len(payload)
+        if (self.file_enabled and len(payload) >= COMPRESS_MIN_SIZE
+                and estimate_entropy(payload) < COMPRESS_ENTROPY_LIMIT):
+            compressed = zlib.compress(payload, COMPRESS_LEVEL)
+            if len(compressed) + 1 <= len(payload) * COMPRESS_MAX_RATIO:
+                self.wire_bytes += len(compressed) + 1
+                return FRAME_COMPRESSED, bytes([frame_type]) + compressed
+        self.wire_bytes += len(payload)
+        return frame_type, payload
+
+def format_transfer_stats(raw_bytes, wire_bytes, elapsed):
+    """格式化传输统计：数据量、压缩率和有效速度"""
+    speed = raw_bytes / max(elapsed, 1e-6) / 1024 / 1024
+    text = f"{raw_bytes / 1024 / 1024:.1f} MB，用时 {elapsed:.1f} 秒，有效速度 {speed:.1f} MB/s"
+    if raw_bytes and wire_bytes < raw_bytes:
+        text += f"，压缩后 {wire_bytes / 1024 / 1024:.1f} MB ({wire_bytes / raw_bytes:.0%})"
+    return text
+
+def build_manifest(paths):
+    """把选择的文件和文件夹展开为清单 [(相对路径, 本地路径, 大小), ...]，相对路径以/分隔，
+    顶层重名的项目自动加后缀"""
+    entries = []
+    used = set()
+    for path in paths:
+        path = os.path.abspath(path)
+        top = os.path.basename(path)
+        base, ext = os.path.splitext(top)
+        counter = 1
+        while top in used:
+            top = f"{base}_{counter}{ext}"
+            counter += 1
+        used.add(top)
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    full = os.path.join(root, name)
+                    relpath = os.path.relpath(full, path).replace(os.sep, '/')
+                    entries.append((f"{top}/{relpath}", full, os.path.getsize(full)))
+        else:
+            entries.append((top, path, os.path.getsize(path)))
+    return entries
+
+def make_batch_id(entries):
+    """根据清单中各文件的路径、大小和修改时间生成批量发送ID"""
+    h = hashlib.sha256()
+    for entry in entries:
+        relpath, path, size = entry[:3]
+        h.update(f"{relpath}|{path}|{size}|{os.stat(path).st_mtime_ns}\n".encode('utf-8'))
+    return h.hexdigest()[:32]
+
+def safe_relpath(relpath):
+    """校验对方发来的相对路径，防止写到Files目录之外"""
+    parts = relpath.split('/')
+    if any(part in ('', '.', '..') or ':' in part or '\\' in part for part in parts):
+        raise ValueError(f"非法的文件路径: {relpath}")
+    return parts
+
+def chunk_count(size, chunk_size):
+    return (size + chunk_size - 1) // chunk_size
+
+def missing_chunks(bitmap, count):
+    """返回位图中未收到的数据块序号"""
+    return [i for i in range(count) if i >> 3 >= len(bitmap) or not bitmap[i >> 3] >> (i & 7) & 1]
+
+def benchmark_codec(iterations=20000):
+    """对比二进制编码与原pickle方式的编解码耗时和消息大小"""
+    import pickle
+    samples = [
+        {'type': 'text', 'content': '你好，今天下午三点开会'},
+        {'type': 'text', 'content': '日志' * 500},
+        {'type': 'name_change', 'old_name': 'PC-01', 'new_name': '研发部-张工', 'mac': 'aa:bb:cc:dd:ee:ff'},
+        {'type': 'file_metadata', 'filename': 'setup_v1.0.1.exe', 'size': 123456789},
+        {'type': 'avatar', 'content': os.urandom(3000)},
+        {'type': 'file_end'},
+    ]
+    print(f"{'消息类型':<16}{'pickle字节':>10}{'codec字节':>10}{'pickle编码us':>14}{'codec编码us':>14}{'pickle解码us':>14}{'codec解码us':>14}")
+    for message in samples:
+        # 原实现中头像以base64字符串传输
+        legacy = dict(message)
+        if legacy['type'] == 'avatar':
+            legacy['content'] = base64.b64encode(legacy['content']).decode('utf-8')
+        results = []
+        for encode, decode, obj in ((pickle.dumps, pickle.loads, legacy),
+                                    (encode_message, decode_message, message)):
+            data = encode(obj)
+            start = time.perf_counter()
+            for _ in range(iterations):
+                encode(obj)
+            encode_us = (time.perf_counter() - start) / iterations * 1e6
+            start = time.perf_counter()
+            for _ in range(iterations):
+                decode(data)
+            decode_us = (time.perf_counter() - start) / iterations * 1e6
+            results.append((len(data), encode_us, decode_us))
+        (p_size, p_enc, p_dec), (c_size, c_enc, c_dec) = results
+        print(f"{message['type']:<16}{p_size:>10}{c_size:>10}{p_enc:>14.2f}{c_enc:>14.2f}{p_dec:>14.2f}{c_dec:>14.2f}")
+
+class FrameDecoder:
+    """流式帧解码器，从任意边界切分的TCP数据中重组完整帧"""
+    def __init__(self):
+        self.buffer = bytearray()
+    
+    def feed(self, data):
+        """输入新收到的数据，返回已完整的帧列表 [(帧类型, 负载), ...]"""
+        self.buffer += data
+        frames = []
+        offset = 0
+        while len(self.buffer) - offset >= FRAME_HEADER.size:
+            frame_type, length = FRAME_HEADER.unpack_from(self.buffer, offset)
+            if length > MAX_FRAME_SIZE:
+                raise ValueError(f"帧长度超出限制: {length}")
+            end = offset + FRAME_HEADER.size + length
+            if len(self.buffer) < end:
+                break
+            frames.append((frame_type, bytes(self.buffer[offset + FRAME_HEADER.size:end])))
+            offset = end
+        
+        # 丢弃已解码的数据，保留不完整的帧
+        if offset:
+            del self.buffer[:offset]
+        return frames
+
+class FramedConnection:
+    """基于帧协议的TCP连接，只能在网络事件循环线程中使用
+    发送的帧先进入连接自己的队列，由写协程写出：控制消息优先，文件数据在其后逐帧写出"""
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.decoder = FrameDecoder()
+        self.pending_frames = collections.deque()
+        # 握手完成前使用握手版本，协商后更新
+        self.version = HANDSHAKE_VERSION
+        # 本机发起的和对方发起的传输流，两个方向的流编号各自分配；旧版本对方只有编号0的一个流
+        self.outgoing = {}
+        self.incoming = {}
+        self.next_stream_id = 1
+        self.legacy_lock = asyncio.Lock()
+        self.closed = False
+        # 最近一次写入数据的时间，期间有其他数据发送时不再单独发送心跳
+        self.last_sent = time.monotonic()
+        # 待发送的控制帧，以及按流编号分开排队的文件数据帧
+        self.control_queue = collections.deque()
+        self.bulk_queues = collections.OrderedDict()
+        self.control_bytes = 0
+        self.bulk_bytes = 0
+        self.writer_wakeup = asyncio.Event()
+        self.bulk_space = asyncio.Event()
+        self.bulk_space.set()
+        # 限制传输层发送缓冲区大小，写协程通过drain产生背压
+        writer.transport.set_write_buffer_limits(high=SEND_BUFFER_HIGH_WATER)
+        self.writer_task = asyncio.get_running_loop().create_task(self.write_loop())
+    
+    def send_frame(self, frame_type, payload=b''):
+        """把控制帧放入优先队列，不会阻塞；对方长时间不接收导致队列超限时关闭连接"""
+        if self.closed:
+            raise ConnectionError("连接已关闭")
+        if self.control_bytes + len(payload) > OUTBOUND_CONTROL_LIMIT:
+            self.close()
+            raise ConnectionError("对方接收过慢，发送队列已满")
+        self.control_queue.append((FRAME_HEADER.pack(frame_type, len(payload)), payload))
+        self.control_bytes += len(payload)
+        self.writer_wakeup.set()
+    
+    async def send_bulk(self, frame_type, payload, stream_id=0):
+        """把文件数据帧放入所属流的队列，流编号非0时封装为FRAME_STREAM，队列已满时等待写协程发送"""
+        while self.bulk_bytes >= OUTBOUND_BULK_LIMIT and not self.closed:
+            self.bulk_space.clear()
+            await self.bulk_space.wait()
+        if self.closed:
+            raise ConnectionError("连接已关闭")
+        if stream_id:
+            header = (FRAME_HEADER.pack(FRAME_STREAM, STREAM_HEADER.size + len(payload))
+                      + STREAM_HEADER.pack(stream_id, frame_type))
+        else:
+            header = FRAME_HEADER.pack(frame_type, len(payload))
+        queue = self.bulk_queues.get(stream_id)
+        if queue is None:
+            queue = self.bulk_queues[stream_id] = collections.deque()
+        queue.append((header, payload))
+        self.bulk_bytes += len(payload)
+        self.writer_wakeup.set()
+    
+    @contextlib.asynccontextmanager
+    async def open_stream(self):
+        """打开一个发送流，退出时注销；旧版本对方不支持分流，同一时间只允许一个传输"""
+        if self.version >= 7:
+            stream_id = self.next_stream_id
+            self.next_stream_id += 1
+        else:
+            stream_id = 0
+            await self.legacy_lock.acquire()
+        stream = TransferStream(self, stream_id)
+        self.outgoing[stream_id] = stream
+        try:
+            yield stream
+        finally:
+            stream.close()
+            if self.outgoing.get(stream_id) is stream:
+                del self.outgoing[stream_id]
+            if not stream_id:
+                self.legacy_lock.release()
+    
+    async def write_loop(self):
+        """写出队列中的帧：每次先写完全部控制帧，再轮流从各个流写一帧文件数据，传输层缓冲区满时等待"""
+        try:
+            while not self.closed:
+                if not self.control_queue and not self.bulk_queues:
+                    self.writer_wakeup.clear()
+                    await self.writer_wakeup.wait()
+                    continue
+                while self.control_queue:
+                    header, payload = self.control_queue.popleft()
+                    self.control_bytes -= len(payload)
+                    self.writer.write(header + payload)
+                if self.bulk_queues:
+                    stream_id, queue = next(iter(self.bulk_queues.items()))
+                    header, payload = queue.popleft()
+                    # 该流还有数据时排到队尾，使并发的传输公平分享带宽
+                    if queue:
+                        self.bulk_queues.move_to_end(stream_id)
+                    else:
+                        del self.bulk_queues[stream_id]
+                    self.bulk_bytes -= len(payload)
+                    self.writer.write(header)
+                    self.writer.write(payload)
+                    if self.bulk_bytes < OUTBOUND_BULK_LIMIT:
+                        self.bulk_space.set()
+                self.last_sent = time.monotonic()
+                await self.writer.drain()
+        except Exception as e:
+            if not self.closed:
+                print(f"发送数据错误: {e}")
+        finally:
+            self.close()
+    
+    def send_message(self, message):
+        payload = encode_message(message, self.version)
+        # 较长的消息在对方支持时压缩发送
+        if self.version >= 5 and len(payload) >= COMPRESS_MIN_SIZE:
+            compressed = zlib.compress(payload, COMPRESS_LEVEL)
+            if len(compressed) + 1 <= len(payload) * COMPRESS_MAX_RATIO:
+                self.send_frame(FRAME_COMPRESSED, bytes([FRAME_MESSAGE]) + compressed)
+                return
+        self.send_frame(FRAME_MESSAGE, payload)
+    
+    async def recv_frame(self):
+        """接收下一帧，连接关闭时返回None"""
+        while not self.pending_frames:
+            data = await self.reader.read(RECV_BUFFER_SIZE)
+            if not data:
+                return None
+            self.pending_frames.extend(self.decoder.feed(data))
+        frame_type, payload = self.pending_frames.popleft()
+        if frame_type == FRAME_COMPRESSED:
+            return decompress_frame(payload)
+        return frame_type, payload
+    
+    async def recv_message(self):
+        """接收下一条控制消息，跳过心跳等其他帧"""
+        while True:
+            frame = await self.recv_frame()
+            if frame is None:
+                return None
+            frame_type, payload = frame
+            if frame_type == FRAME_MESSAGE:
+                return decode_message(payload)
+    
+    def close(self):
+        self.closed = True
+        # 唤醒写协程、等待队列空间的发送方和各个流上等待的协程，使其退出
+        self.writer_wakeup.set()
+        self.bulk_space.set()
+        for stream in list(self.outgoing.values()) + list(self.incoming.values()):
+            stream.close()
+        try:
+            self.writer.close()
+        except:
+            pass
+
+class TransferStream:
+    """连接中的一个传输流，承载一次文件或批量传输；流编号0表示旧版本对方不分流的传输
+    发送方按对方归还的额度发送数据，接收方的帧由接收循环放入流中，各个传输互不阻塞"""
+    def __init__(self, conn, stream_id):
+        self.conn = conn
+        self.stream_id = stream_id
+        # 发送方：收到对方READY或续传位图时置位；对方接收失败时记录原因
+        self.ready_event = asyncio.Event()
+        self.resume_received = b''
+        self.error = None
+        # 发送方：对方还允许发送的字节数
+        self.credit = STREAM_WINDOW
+        self.credit_event = asyncio.Event()
+        # 接收方：已到达待处理的帧 (帧类型, 负载, 传输字节数)，以及已处理但尚未归还额度的字节数
+        self.frames = collections.deque()
+        self.buffered = 0
+        self.consumed = 0
+        self.frame_event = asyncio.Event()
+        self.space_event = asyncio.Event()
+        # 接收方已收到结束标志，旧版本对方随后可以在编号0上开始下一次传输
+        self.finished = False
+        self.closed = False
+    
+    def send_message(self, message):
+        """发送属于本流的控制消息，对方支持分流时附带流编号"""
+        if self.stream_id:
+            message = dict(message, stream_id=self.stream_id)
+        self.conn.send_message(message)
+    
+    async def send_bulk(self, frame_type, payload):
+        """发送一帧文件数据，额度用完时等待接收方归还"""
+        while self.stream_id and self.credit <= 0 and not self.closed:
+            self.credit_event.clear()
+            await self.credit_event.wait()
+        self.check_error()
+        self.credit -= len(payload)
+        await self.conn.send_bulk(frame_type, payload, self.stream_id)
+    
+    async def send_message_after_bulk(self, message):
+        """在本流已排队的文件数据之后发送控制消息，用于必须在数据之后到达的结束标志"""
+        await self.send_bulk(FRAME_MESSAGE, encode_message(message, self.conn.version))
+    
+    async def wait_ready(self):
+        """等待对方回复READY或续传位图"""
+        await self.ready_event.wait()
+        self.check_error()
+    
+    def check_error(self):
+        if self.error:
+            raise Exception(f"对方接收失败: {self.error}")
+        if self.closed:
+            raise ConnectionError("连接已关闭")
+    
+    def add_credit(self, credit):
+        self.credit += credit
+        self.credit_event.set()
+    
+    def fail(self, error):
+        """对方接收失败，唤醒等待中的发送方"""
+        self.error = error
+        self.ready_event.set()
+        self.credit_event.set()
+    
+    async def put(self, frame_type, payload, size):
+        """接收循环放入一帧；旧版本对方没有流量控制，积压过多时暂停接收，由TCP产生背压"""
+        if self.closed:
+            return
+        if frame_type == FRAME_MESSAGE:
+            self.finished = True
+        self.frames.append((frame_type, payload, size))
+        self.buffered += size
+        self.frame_event.set()
+        if not self.stream_id:
+            while self.buffered > STREAM_WINDOW and not self.closed:
+                self.space_event.clear()
+                await self.space_event.wait()
+        elif self.buffered > STREAM_WINDOW + MAX_FRAME_SIZE:
+            raise ConnectionError("对方发送的数据超出流量额度")
+    
+    async def recv_frame(self):
+        """取出下一帧，连接关闭时返回None；处理过的数据累计到半个窗口时归还额度"""
+        while not self.frames:
+            if self.closed:
+                return None
+            self.frame_event.clear()
+            await self.frame_event.wait()
+        frame_type, payload, size = self.frames.popleft()
+        self.buffered -= size
+        self.space_event.set()
+        if self.stream_id:
+            self.consumed += size
+            if self.consumed >= STREAM_WINDOW // 2:
+                self.conn.send_message({'type': 'window_update', 'stream_id': self.stream_id, 'credit': self.consumed})
+                self.consumed = 0
+        return frame_type, payload
+    
+    def close(self):
+        self.closed = True
+        self.ready_event.set()
+        self.credit_event.set()
+        self.frame_event.set()
+        self.space_event.set()
+
+class DeadlineScheduler:
+    """最小堆实现的定时器，每个键只保留最新的截止时间；
+    重新安排或取消后堆中的旧条目不立即删除，弹出时按截止时间是否一致丢弃"""
+    
+    def __init__(self):
+        self.heap = []
+        self.deadlines = {}  # 键 -> 当前有效的截止时间
+        self.counter = itertools.count()
+    
+    def __len__(self):
+        return len(self.deadlines)
+    
+    def schedule(self, key, deadline):
+        self.deadlines[key] = deadline
+        heapq.heappush(self.heap, (deadline, next(self.counter), key))
+        # 失效条目过多时重建堆
+        if len(self.heap) > 2 * len(self.deadlines) + 64:
+            self.heap = [entry for entry in self.heap if self.deadlines.get(entry[2]) == entry[0]]
+            heapq.heapify(self.heap)
+    
+    def cancel(self, key):
+        self.deadlines.pop(key, None)
+    
+    def next_deadline(self):
+        """返回最早的有效截止时间，没有时返回None"""
+        while self.heap:
+            deadline, _, key = self.heap[0]
+            if self.deadlines.get(key) == deadline:
+                return deadline
+            heapq.heappop(self.heap)
+        return None
+    
+    def pop_due(self, now):
+        """弹出截止时间不晚于now的键"""
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            deadline, _, key = heapq.heappop(self.heap)
+            if self.deadlines.get(key) == deadline:
+                del self.deadlines[key]
+                due.append(key)
+        return due
+
+class DiscoveryProtocol(asyncio.DatagramProtocol):
+    """UDP广播收发，数据报交给应用处理"""
+    def __init__(self, app):
+        self.app = app
+    
+    def datagram_received(self, data, addr):
+        self.app.on_discovery_packet(data, addr)
+    
+    def error_received(self, exc):
+        print(f"UDP监听错误: {exc}")
+
+# 默认头像按名称分桶在进程内共享：Data/Image/headimg1~5.png只读取一次，
+# 生成的头像按 (颜色, 首字母) 缓存，同一桶的设备共用同一份数据
+DEFAULT_AVATAR_COLORS = ['#FF6B6B', '#4ECDC4', '#45B7D1', '#FFA07A', '#98D8C8']
+default_avatar_files = None
+default_avatar_cache = {}
+default_avatar_lock = threading.Lock()
+
+def load_default_avatar_files():
+    """读取自定义默认头像，不存在时返回空列表"""
+    avatars = []
+    img_dir = os.path.join("Data", "Image")
+    for i in range(1, 6):
+        img_path = os.path.join(img_dir, f"headimg{i}.png")
+        if os.path.exists(img_path):
+            try:
+                with open(img_path, 'rb') as f:
+                    avatars.append(f.read())
+            except:
+                continue
+    return avatars
+
+def render_default_avatar(color, letter):
+    """生成指定颜色和首字母的圆形默认头像"""
+    img = Image.new('RGBA', (DEFAULT_AVATAR_SIZE, DEFAULT_AVATAR_SIZE), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(img)
+    draw.ellipse((0, 0, DEFAULT_AVATAR_SIZE-1, DEFAULT_AVATAR_SIZE-1), fill=color)
+    
+    if letter:
+        font = ImageFont.load_default()
+        font = font.font_variant(size=int(DEFAULT_AVATAR_SIZE/2))
+        draw.text((DEFAULT_AVATAR_SIZE/2, DEFAULT_AVATAR_SIZE/2), 
+                  letter, fill="white", font=font, anchor="mm")
+    
+    img_byte_arr = io.BytesIO()
+    img.save(img_byte_arr, format='PNG')
+    return img_byte_arr.getvalue()
+
+def default_avatar(name):
+    """返回名称对应的默认头像，优先使用Data\Image\目录下的headimg1~5.png"""
+    global default_avatar_files
+    # 使用稳定的哈希分桶，同一名称在各设备和每次启动时头像相同
+    bucket = zlib.crc32((name or '').encode('utf-8'))
+    with default_avatar_lock:
+        if default_avatar_files is None:
+            default_avatar_files = load_default_avatar_files()
+        if default_avatar_files:
+            return default_avatar_files[bucket % len(default_avatar_files)]
+        
+        key = (bucket % len(DEFAULT_AVATAR_COLORS), name[0].upper() if name else '')
+        avatar = default_avatar_cache.get(key)
+        if avatar is None:
+            avatar = default_avatar_cache[key] = render_default_avatar(DEFAULT_AVATAR_COLORS[key[0]], key[1])
+        return avatar
+
+class NetworkDevice:
+    def __init__(self, ip, mac, name, avatar=None, timestamp=None):
+        self.ip = ip
+        self.mac = mac
+        self.name = name
+        self.avatar = avatar
+        self.timestamp = timestamp or time.time()
+        self.is_online = True
+        self.unread_messages = 0
+        self.connection = None  # 已建立的FramedConnection，仅在网络线程中访问
+        self.beacon_interval = DISCOVERY_INTERVAL  # 对方声明的广播间隔
+        self.beacon_version = 0  # 对方最近一次广播的版本号
+    
+    @property
+    def avatar(self):
+        """没有自定义头像时在首次使用时取默认头像，设备发现时不生成图片"""
+        return self._avatar or default_avatar(self.name)
+    
+    @avatar.setter
+    def avatar(self, content):
+        """更新头像时同时计算内容哈希，握手时用于比对缓存；默认头像哈希为空，不在网络上传输"""
+        self._avatar = content or None
+        self.avatar_hash = hashlib.sha256(content).hexdigest() if content else ''
+        
+    def update_timestamp(self):
+        self.timestamp = time.time()
+        
+    def offline_timeout(self):
+        return max(OFFLINE_TIMEOUT, 3 * self.beacon_interval)
+    
+    def check_online(self):
+        self.is_online = (time.time() - self.timestamp) < self.offline_timeout()
+        return self.is_online
+        
+    def __str__(self):
+        return f"{self.name} ({self.ip})"
+    
+    def to_dict(self):
+        """只包含基本信息，不包含完整头像，解决广播包过大问题"""
+        return {
+            "ip": self.ip,
+            "mac": self.mac,
+            "name": self.name,
+            "timestamp": self.timestamp
+        }
+    
+    def get_safe_mac(self):
+        """获取安全的MAC地址，用于文件名"""
+        return self.mac.replace(':', '_')
+
+class DeviceRegistry:
+    """在线设备登记表：以MAC为主键，另按名称和IP建立索引（调用方持有devices_lock）
+    设备列表的行ID和聊天窗口都以MAC标识，同名设备互不影响"""
+    
+    def __init__(self):
+        self.by_mac = {}
+        self.by_name = {}  # 名称 -> {MAC}
+        self.by_ip = {}  # IP -> MAC
+        self.departed = {}  # 已离线的设备，重新上线时沿用同一对象，界面持有的引用保持有效
+    
+    def __contains__(self, mac):
+        return mac in self.by_mac
+    
+    def __len__(self):
+        return len(self.by_mac)
+    
+    def get(self, mac):
+        return self.by_mac.get(mac)
+    
+    def values(self):
+        return list(self.by_mac.values())
+    
+    def add(self, device):
+        """登记设备，同一MAC已存在时替换"""
+        if device.mac in self.by_mac:
+            self.unindex(self.by_mac[device.mac])
+        self.departed.pop(device.mac, None)
+        self.by_mac[device.mac] = device
+        self.index(device)
+    
+    def remove(self, mac):
+        """移除设备并保留对象，返回被移除的设备"""
+        device = self.by_mac.pop(mac, None)
+        if device:
+            self.unindex(device)
+            self.departed[mac] = device
+            if len(self.departed) > DEPARTED_DEVICE_LIMIT:
+                self.departed.pop(next(iter(self.departed)))
+        return device
+    
+    def restore(self, mac, ip, name):
+        """返回已登记或曾经登记过的设备并更新名称和IP，没有时返回None"""
+        device = self.by_mac.get(mac)
+        if device:
+            self.update(device, name=name, ip=ip)
+        else:
+            device = self.departed.get(mac)
+            if device:
+                device.name, device.ip = name, ip
+                self.add(device)
+        return device
+    
+    def update(self, device, name=None, ip=None):
+        """修改设备名称或IP并同步索引"""
+        registered = self.by_mac.get(device.mac) is device
+        if registered:
+            self.unindex(device)
+        if name is not None:
+            device.name = name
+        if ip is not None:
+            device.ip = ip
+        if registered:
+            self.index(device)
+    
+    def index(self, device):
+        self.by_name.setdefault(device.name, set()).add(device.mac)
+        self.by_ip[device.ip] = device.mac
+    
+    def unindex(self, device):
+        macs = self.by_name.get(device.name)
+        if macs:
+            macs.discard(device.mac)
+            if not macs:
+                del self.by_name[device.name]
+        if self.by_ip.get(device.ip) == device.mac:
+            del self.by_ip[device.ip]
+    
+    def find_by_name(self, name):
+        return [self.by_mac[mac] for mac in self.by_name.get(name, ())]
+    
+    def find_by_ip(self, ip):
+        return self.by_mac.get(self.by_ip.get(ip))
+    
+    def connected(self):
+        """返回已建立连接的设备"""
+        return [device for device in self.by_mac.values() if device.connection]
+
+class HistoryStore:
+    """聊天记录存储：每个设备目录下 Records<N>.dc 按行追加JSON记录，
+    Records.idx 为定长索引，每条记录对应 (时间戳, 文件编号, 字节偏移)"""
+    
+    INDEX_FILE = "Records.idx"
+    INDEX_ENTRY = struct.Struct('!dII')
+    
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+        self.lock = threading.RLock()
+        self.states = {}  # safe_mac -> 设备记录状态缓存
+    
+    @staticmethod
+    def segment_name(number):
+        return f"Records{number}.dc"
+    
+    def device_dir(self, safe_mac):
+        return os.path.join(self.data_dir, safe_mac)
+    
+    def list_segments(self, safe_mac):
+        """返回设备已有记录文件的编号（升序），只在首次加载和迁移时扫描目录"""
+        device_dir = self.device_dir(safe_mac)
+        if not os.path.isdir(device_dir):
+            return []
+        numbers = []
+        for name in os.listdir(device_dir):
+            if name.startswith("Records") and name.endswith(".dc") and name[7:-3].isdigit():
+                numbers.append(int(name[7:-3]))
+        return sorted(numbers)
+    
+    def get_state(self, safe_mac):
+        """加载设备记录状态；索引缺失或与记录文件不一致时重建（兼容旧版本数据）"""
+        state = self.states.get(safe_mac)
+        if state is not None:
+            return state
+        
+        device_dir = self.device_dir(safe_mac)
+        index_path = os.path.join(device_dir, self.INDEX_FILE)
+        segments = self.list_segments(safe_mac)
+        segment = segments[-1] if segments else 1
+        segment_path = os.path.join(device_dir, self.segment_name(segment))
+        segment_size = os.path.getsize(segment_path) if os.path.exists(segment_path) else 0
+        
+        state = {
+            'segment': segment,
+            'segment_size': segment_size,
+            'count': 0,
+            'device_info': None
+        }
+        try:
+            with open(os.path.join(device_dir, 'device_info.json'), 'r', encoding='utf-8') as f:
+                state['device_info'] = json.load(f)
+        except:
+            pass
+        
+        valid = False
+        if os.path.exists(index_path):
+            index_size = os.path.getsize(index_path)
+            count = index_size // self.INDEX_ENTRY.size
+            state['count'] = count
+            if count == 0:
+                valid = segment_size == 0
+            else:
+                # 索引最后一条必须指向当前记录文件中的最后一行
+                _, last_segment, last_offset = self.read_index_entries(index_path, count - 1, count)[0]
+                valid = last_segment == segment and last_offset < segment_size
+            if valid and index_size % self.INDEX_ENTRY.size:
+                # 截断写入中断留下的不完整索引项
+                with open(index_path, 'r+b') as f:
+                    f.truncate(count * self.INDEX_ENTRY.size)
+        elif not segments:
+            valid = True
+        
+        self.states[safe_mac] = state
+        if not valid:
+            self.rebuild_index(safe_mac)
+        return state
+    
+    def rebuild_index(self, safe_mac):
+        """扫描全部记录文件重建索引，用于迁移旧数据或记录文件被改写之后"""
+        with self.lock:
+            device_dir = self.device_dir(safe_mac)
+            segments = self.list_segments(safe_mac)
+            count = 0
+            tmp_path = os.path.join(device_dir, self.INDEX_FILE + ".tmp")
+            os.makedirs(device_dir, exist_ok=True)
+            with open(tmp_path, 'wb') as index:
+                for number in segments:
+                    with open(os.path.join(device_dir, self.segment_name(number)), 'rb') as f:
+                        offset = 0
+                        for line in f:
+                            try:
+                                timestamp = float(json.loads(line)['timestamp'])
+                            except:
+                                timestamp = None
+                            if timestamp is not None:
+                                index.write(self.INDEX_ENTRY.pack(timestamp, number, offset))
+                                count += 1
+                            offset += len(line)
+            os.replace(tmp_path, os.path.join(device_dir, self.INDEX_FILE))
+            
+            segment = segments[-1] if segments else 1
+            segment_path = os.path.join(device_dir, self.segment_name(segment))
+            state = self.states.setdefault(safe_mac, {'device_info': None})
+            state['segment'] = segment
+            state['segment_size'] = os.path.getsize(segment_path) if os.path.exists(segment_path) else 0
+            state['count'] = count
+            return count
+    
+    def get_device_info(self, safe_mac):
+        """返回保存的设备信息，没有时返回None"""
+        with self.lock:
+            return self.get_state(safe_mac)['device_info']
+    
+    def update_device_info(self, device):
+        """设备信息有变化时才重写device_info.json"""
+        safe_mac = device.get_safe_mac()
+        device_info = {
+            'mac': device.mac,
+            'name': device.name,
+            'last_known_name': device.name,
+            'ip': device.ip
+        }
+        with self.lock:
+            state = self.get_state(safe_mac)
+            if state['device_info'] == device_info:
+                return
+            device_dir = self.device_dir(safe_mac)
+            os.makedirs(device_dir, exist_ok=True)
+            with open(os.path.join(device_dir, 'device_info.json'), 'w', encoding='utf-8') as f:
+                json.dump(device_info, f, ensure_ascii=False)
+            state['device_info'] = device_info
+    
+    def append(self, device, record):
+        """追加一条记录，返回记录序号；不扫描目录，耗时与历史长度无关"""
+        safe_mac = device.get_safe_mac()
+        line = (json.dumps(record, ensure_ascii=False) + "\n").encode('utf-8')
+        with self.lock:
+            self.update_device_info(device)
+            state = self.get_state(safe_mac)
+            
+            # 当前记录文件超过大小则切换到新文件
+            if state['segment_size'] and state['segment_size'] + len(line) > MAX_RECORD_FILE_SIZE:
+                state['segment'] += 1
+                state['segment_size'] = 0
+            
+            device_dir = self.device_dir(safe_mac)
+            offset = state['segment_size']
+            with open(os.path.join(device_dir, self.segment_name(state['segment'])), 'ab') as f:
+                f.write(line)
+            with open(os.path.join(device_dir, self.INDEX_FILE), 'ab') as f:
+                f.write(self.INDEX_ENTRY.pack(record['timestamp'], state['segment'], offset))
+            
+            state['segment_size'] += len(line)
+            state['count'] += 1
+            return state['count'] - 1
+    
+    def count(self, safe_mac):
+        with self.lock:
+            return self.get_state(safe_mac)['count']
+    
+    def read_index_entries(self, index_path, start, end):
+        if end <= start:
+            return []
+        with open(index_path, 'rb') as f:
+            f.seek(start * self.INDEX_ENTRY.size)
+            data = f.read((end - start) * self.INDEX_ENTRY.size)
+        return list(self.INDEX_ENTRY.iter_unpack(data[:len(data) - len(data) % self.INDEX_ENTRY.size]))
+    
+    def find_first_after(self, safe_mac, timestamp):
+        """二分查找第一条时间戳不早于timestamp的记录序号"""
+        with self.lock:
+            count = self.get_state(safe_mac)['count']
+            index_path = os.path.join(self.device_dir(safe_mac), self.INDEX_FILE)
+            low, high = 0, count
+            while low < high:
+                mid = (low + high) // 2
+                if self.read_index_entries(index_path, mid, mid + 1)[0][0] < timestamp:
+                    low = mid + 1
+                else:
+                    high = mid
+            return low
+    
+    def read_at(self, safe_mac, segment, offset):
+        """读取指定位置的一条记录"""
+        path = os.path.join(self.device_dir(safe_mac), self.segment_name(segment))
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            return json.loads(f.readline())
+    
+    def read_range(self, safe_mac, start, end):
+        """按序号读取 [start, end) 范围内的记录，只打开涉及的记录文件"""
+        with self.lock:
+            count = self.get_state(safe_mac)['count']
+            start, end = max(0, start), min(end, count)
+            entries = self.read_index_entries(os.path.join(self.device_dir(safe_mac), self.INDEX_FILE), start, end)
+        
+        records = []
+        handles = {}
+        try:
+            for timestamp, segment, offset in entries:
+                f = handles.get(segment)
+                if f is None:
+                    f = handles[segment] = open(os.path.join(self.device_dir(safe_mac), self.segment_name(segment)), 'rb')
+                f.seek(offset)
+                try:
+                    records.append(json.loads(f.readline()))
+                except:
+                    pass
+        finally:
+            for f in handles.values():
+                f.close()
+        return records
+    
+    def read_numbers(self, safe_mac, numbers):
+        """按任意序号列表读取记录，返回与numbers一一对应的列表（读取失败为None）"""
+        device_dir = self.device_dir(safe_mac)
+        with self.lock:
+            count = self.get_state(safe_mac)['count']
+        records = []
+        handles = {}
+        try:
+            with open(os.path.join(device_dir, self.INDEX_FILE), 'rb') as index:
+                for number in numbers:
+                    record = None
+                    if 0 <= number < count:
+                        index.seek(number * self.INDEX_ENTRY.size)
+                        _, segment, offset = self.INDEX_ENTRY.unpack(index.read(self.INDEX_ENTRY.size))
+                        f = handles.get(segment)
+                        if f is None:
+                            f = handles[segment] = open(os.path.join(device_dir, self.segment_name(segment)), 'rb')
+                        f.seek(offset)
+                        try:
+                            record = json.loads(f.readline())
+                        except:
+                            pass
+                    records.append(record)
+        finally:
+            for f in handles.values():
+                f.close()
+        return records
+    
+    def read_last(self, safe_mac, limit):
+        """读取最近的limit条记录"""
+        count = self.count(safe_mac)
+        return self.read_range(safe_mac, count - limit, count)
+    
+    def list_devices(self):
+        """返回有聊天记录的设备目录名"""
+        devices = []
+        for name in os.listdir(self.data_dir):
+            device_dir = self.device_dir(name)
+            if os.path.isdir(device_dir) and (name in self.states or self.list_segments(name)):
+                devices.append(name)
+        return devices
+    
+    def compact(self, safe_mac, threshold, progress=None):
+        """删除时间戳早于threshold的记录，返回 (删除记录数, 删除文件数)
+        
+        逐行流式读取每个记录文件并写出压缩后的副本，最后在锁内原子替换并生成新索引；
+        整个文件都比阈值新的直接跳过，整个文件都已过期的不再重写而是直接删除。
+        压缩期间追加的新记录会在替换前补写到新文件中。
+        """
+        device_dir = self.device_dir(safe_mac)
+        index_path = os.path.join(device_dir, self.INDEX_FILE)
+        
+        # 在锁内取快照，之后读取的索引项和文件内容不会再被修改
+        with self.lock:
+            state = self.get_state(safe_mac)
+            snapshot_count = state['count']
+            snapshot_segments = self.list_segments(safe_mac)
+            snapshot_sizes = {number: os.path.getsize(os.path.join(device_dir, self.segment_name(number)))
+                              for number in snapshot_segments}
+        if not snapshot_count:
+            return 0, 0
+        
+        # 按记录文件分组统计索引项，用于判断能否跳过
+        entries_by_segment = collections.defaultdict(list)
+        for entry in self.read_index_entries(index_path, 0, snapshot_count):
+            entries_by_segment[entry[1]].append(entry)
+        
+        deleted_records = 0
+        deleted_files = 0
+        new_entries = []
+        replacements = {}  # 文件编号 -> 临时文件路径(None表示删除)
+        new_sizes = {}
+        
+        for i, number in enumerate(snapshot_segments):
+            if progress:
+                progress(i, len(snapshot_segments))
+            entries = entries_by_segment.get(number, [])
+            segment_path = os.path.join(device_dir, self.segment_name(number))
+            
+            # 最早的记录也不早于阈值，整个文件保留
+            if not entries or min(e[0] for e in entries) >= threshold:
+                new_entries.extend(entries)
+                continue
+            
+            all_expired = max(e[0] for e in entries) < threshold
+            tmp_path = segment_path + ".tmp"
+            out = None if all_expired else open(tmp_path, 'wb')
+            try:
+                with open(segment_path, 'rb') as f:
+                    offset = 0
+                    new_offset = 0
+                    while offset < snapshot_sizes[number]:
+                        line = f.readline()
+                        if not line:
+                            break
+                        offset += len(line)
+                        try:
+                            record = json.loads(line)
+                            timestamp = float(record['timestamp'])
+                        except:
+                            # 无法解析的行原样保留，不建立索引
+                            if out:
+                                out.write(line)
+                                new_offset += len(line)
+                            continue
+                        
+                        if timestamp >= threshold:
+                            if out:
+                                out.write(line)
+                                new_entries.append((timestamp, number, new_offset))
+                                new_offset += len(line)
+                            continue
+                        
+                        deleted_records += 1
+                        # 如果是文件记录，删除文件
+                        filepath = record.get('filepath')
+                        if filepath and os.path.exists(filepath):
+                            try:
+                                if os.path.isdir(filepath):
+                                    shutil.rmtree(filepath)
+                                else:
+                                    os.remove(filepath)
+                                deleted_files += 1
+                            except:
+                                pass
+            finally:
+                if out:
+                    out.close()
+            
+            replacements[number] = None if all_expired else tmp_path
+            new_sizes[number] = 0 if all_expired else new_offset
+        
+        if progress:
+            progress(len(snapshot_segments), len(snapshot_segments))
+        if not replacements:
+            return 0, 0
+        
+        with self.lock:
+            state = self.get_state(safe_mac)
+            last_segment = snapshot_segments[-1]
+            
+            # 补写压缩期间新追加的记录，并根据新文件大小调整它们的偏移
+            for timestamp, number, offset in self.read_index_entries(index_path, snapshot_count, state['count']):
+                if number in replacements:
+                    offset = offset - snapshot_sizes[number] + new_sizes[number]
+                new_entries.append((timestamp, number, offset))
+            
+            for number, tmp_path in replacements.items():
+                segment_path = os.path.join(device_dir, self.segment_name(number))
+                current_size = os.path.getsize(segment_path)
+                if current_size > snapshot_sizes[number]:
+                    if tmp_path is None:
+                        tmp_path = segment_path + ".tmp"
+                        open(tmp_path, 'wb').close()
+                    with open(segment_path, 'rb') as src, open(tmp_path, 'ab') as dst:
+                        src.seek(snapshot_sizes[number])
+                        shutil.copyfileobj(src, dst)
+                
+                if tmp_path is None:
+                    # 当前正在追加的文件保留为空文件，其他文件直接删除
+                    if number == last_segment and number == state['segment']:
+                        open(segment_path, 'wb').close()
+                    else:
+                        os.remove(segment_path)
+                else:
+                    os.replace(tmp_path, segment_path)
+            
+            tmp_index = index_path + ".tmp"
+            with open(tmp_index, 'wb') as f:
+                for entry in new_entries:
+                    f.write(self.INDEX_ENTRY.pack(*entry))
+            os.replace(tmp_index, index_path)
+            
+            state['count'] = len(new_entries)
+            segment_path = os.path.join(device_dir, self.segment_name(state['segment']))
+            state['segment_size'] = os.path.getsize(segment_path) if os.path.exists(segment_path) else 0
+        
+        return deleted_records, deleted_files
+
+class BlobStore:
+    """按内容寻址的文件存储：Data/Blobs/<前两位>/<sha256>，
+    设备Files目录中的文件是指向它的硬链接，同一内容无论收发多少次只保存一份"""
+    
+    HASH_BLOCK_SIZE = 1024 * 1024
+    
+    def __init__(self, data_dir):
+        self.blob_dir = os.path.join(data_dir, "Blobs")
+        self.lock = threading.Lock()
+        self.hash_cache = {}  # (路径, 大小, 修改时间) -> sha256，重复发送同一文件时不再计算
+        self.pins = collections.Counter()  # 已存入或将要存入但还没有建立硬链接的内容，清理时跳过
+    
+    def pin(self, digests):
+        """保护这些内容不被清理，直到调用unpin；须在存入存储或检查是否已有之前调用"""
+        with self.lock:
+            self.pins.update(digests)
+    
+    def unpin(self, digests):
+        with self.lock:
+            self.pins.subtract(digests)
+            for digest in digests:
+                if self.pins[digest] <= 0:
+                    del self.pins[digest]
+    
+    @contextlib.contextmanager
+    def pinned(self, digests):
+        """在with块内保护这些内容不被清理，覆盖从存入存储到建立硬链接之间的时间"""
+        digests = list(digests)
+        self.pin(digests)
+        try:
+            yield
+        finally:
+            self.unpin(digests)
+    
+    def blob_path(self, digest):
+        return os.path.join(self.blob_dir, digest[:2], digest)
+    
+    def has(self, digest):
+        return bool(re.fullmatch(r'[0-9a-f]{64}', digest or '')) and os.path.exists(self.blob_path(digest))
+    
+    def hash_file(self, path):
+        """计算文件的SHA-256"""
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(self.HASH_BLOCK_SIZE), b''):
+                h.update(block)
+        return h.hexdigest()
+    
+    def cached_hash(self, path):
+        """计算本地文件的SHA-256，文件未修改时使用缓存"""
+        stat = os.stat(path)
+        key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        digest = self.hash_cache.get(key)
+        if digest is None:
+            digest = self.hash_cache[key] = self.hash_file(path)
+        return digest
+    
+    def add_file(self, src_path, pin=False):
+        """把本地文件加入存储，边复制边计算哈希，已存在时不再复制，返回sha256；
+        pin为真时返回的内容已受保护，建立硬链接后由调用方unpin"""
+        stat = os.stat(src_path)
+        key = (os.path.abspath(src_path), stat.st_size, stat.st_mtime_ns)
+        digest = self.hash_cache.get(key)
+        if digest:
+            if pin:
+                self.pin([digest])
+            if self.has(digest):
+                return digest
+            if pin:
+                self.unpin([digest])
+        
+        os.makedirs(self.blob_dir, exist_ok=True)
+        tmp_path = os.path.join(self.blob_dir, f".{uuid.uuid4().hex}.tmp")
+        h = hashlib.sha256()
+        try:
+            with open(src_path, 'rb') as src, open(tmp_path, 'wb') as dest:
+                for block in iter(lambda: src.read(self.HASH_BLOCK_SIZE), b''):
+                    h.update(block)
+                    dest.write(block)
+            digest = self.hash_cache[key] = h.hexdigest()
+            if pin:
+                self.pin([digest])
+            try:
+                self.store(tmp_path, digest)
+            except:
+                if pin:
+                    self.unpin([digest])
+                raise
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return digest
+    
+    def store(self, path, digest):
+        """把已校验的文件移入存储，内容已存在时删除该文件"""
+        blob_path = self.blob_path(digest)
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        with self.lock:
+            if os.path.exists(blob_path):
+                os.remove(path)
+            else:
+                os.replace(path, blob_path)
+    
+    # 文件系统不支持硬链接或链接数已满时改为复制
+    LINK_FALLBACK_ERRORS = {errno.EXDEV, errno.EPERM, errno.EACCES, errno.ENOTSUP, errno.EOPNOTSUPP,
+                            errno.EMLINK, errno.EINVAL}
+    
+    def link(self, digest, filepath):
+        """在指定位置创建指向存储内容的硬链接，文件系统不支持时复制；
+        指定位置已存在时抛出FileExistsError，不会写入已有的文件"""
+        try:
+            os.link(self.blob_path(digest), filepath)
+            return
+        except FileExistsError:
+            raise
+        except OSError as e:
+            if e.errno not in self.LINK_FALLBACK_ERRORS:
+                raise
+        
+        # 先独占创建目标占住名称，复制到临时文件后再替换这个空文件
+        open(filepath, 'xb').close()
+        tmp_path = f"{filepath}.{uuid.uuid4().hex}.tmp"
+        try:
+            shutil.copyfile(self.blob_path(digest), tmp_path)
+            os.replace(tmp_path, filepath)
+        except:
+            for path in (tmp_path, filepath):
+                if os.path.exists(path):
+                    os.remove(path)
+            raise
+    
+    def collect_garbage(self):
+        """删除没有任何硬链接引用的内容，返回删除数量；正在接收或发送、还没有建立硬链接的内容除外"""
+        removed = 0
+        if not os.path.isdir(self.blob_dir):
+            return 0
+        with self.lock:
+            for prefix in os.listdir(self.blob_dir):
+                prefix_dir = os.path.join(self.blob_dir, prefix)
+                if not os.path.isdir(prefix_dir):
+                    continue
+                for name in os.listdir(prefix_dir):
+                    if name in self.pins:
+                        continue
+                    path = os.path.join(prefix_dir, name)
+                    try:
+                        if os.stat(path).st_nlink <= 1:
+                            os.remove(path)
+                            removed += 1
+                    except OSError:
+                        pass
+        return removed
+
+class AvatarCache:
+    """按内容哈希缓存的对方头像：Data/Image/<sha256>.png，重新连接时不再重复传输"""
+    
+    def __init__(self, image_dir):
+        self.image_dir = image_dir
+    
+    def path(self, avatar_hash):
+        return os.path.join(self.image_dir, f"{avatar_hash}.png")
+    
+    def load(self, avatar_hash):
+        """读取缓存的头像，不存在或内容与哈希不符时返回None"""
+        if not re.fullmatch(r'[0-9a-f]{64}', avatar_hash or ''):
+            return None
+        try:
+            with open(self.path(avatar_hash), 'rb') as f:
+                content = f.read()
+        except OSError:
+            return None
+        return content if hashlib.sha256(content).hexdigest() == avatar_hash else None
+    
+    def store(self, content):
+        """保存头像，已存在时跳过，返回哈希"""
+        avatar_hash = hashlib.sha256(content).hexdigest()
+        path = self.path(avatar_hash)
+        if not os.path.exists(path):
+            tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+        return avatar_hash
+
+class TransferMetrics:
+    """传输和时延统计：每次传输的字节数、用时、速度、停顿时间和重试次数，以及各设备的心跳往返时延
+    网络线程更新，界面线程和写统计文件时读取快照，内部加锁"""
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.active = {}
+        self.finished = collections.deque(maxlen=TRANSFER_HISTORY_SIZE)
+        self.latency = {}
+        self.totals = {'sent_bytes': 0, 'received_bytes': 0, 'completed': 0, 'failed': 0}
+    
+    def start(self, peer, name, direction, total):
+        """开始统计一次传输，direction为send或receive，返回统计编号"""
+        now = time.time()
+        with self.lock:
+            transfer_id = next(self.ids)
+            self.active[transfer_id] = {
+                'id': transfer_id, 'peer': peer, 'name': name, 'direction': direction,
+                'total': total, 'bytes': 0, 'wire_bytes': 0, 'start': now, 'last_progress': now,
+                'stall': 0.0, 'retries': 0
+            }
+        return transfer_id
+    
+    def progress(self, transfer_id, raw_bytes, wire_bytes=None):
+        """记录传输进展，距上次进展超过阈值的间隔计入停顿时间"""
+        now = time.time()
+        with self.lock:
+            transfer = self.active.get(transfer_id)
+            if not transfer:
+                return
+            gap = now - transfer['last_progress']
+            if gap >= TRANSFER_STALL_THRESHOLD:
+                transfer['stall'] += gap
+            transfer['last_progress'] = now
+            transfer['bytes'] += raw_bytes
+            transfer['wire_bytes'] += raw_bytes if wire_bytes is None else wire_bytes
+    
+    def retry(self, transfer_id):
+        with self.lock:
+            if transfer_id in self.active:
+                self.active[transfer_id]['retries'] += 1
+    
+    def finish(self, transfer_id, error=None):
+        """结束统计，error为空表示成功"""
+        now = time.time()
+        with self.lock:
+            transfer = self.active.pop(transfer_id, None)
+            if not transfer:
+                return
+            self.describe(transfer, now)
+            transfer['end'] = now
+            transfer['error'] = error or ''
+            self.finished.appendleft(transfer)
+            self.totals['sent_bytes' if transfer['direction'] == 'send' else 'received_bytes'] += transfer['bytes']
+            self.totals['failed' if error else 'completed'] += 1
+    
+    def record_latency(self, mac, name, rtt):
+        """记录一次心跳往返时延(秒)"""
+        with self.lock:
+            entry = self.latency.get(mac)
+            if entry is None:
+                self.latency[mac] = {'name': name, 'last': rtt, 'smoothed': rtt, 'min': rtt, 'max': rtt, 'samples': 1}
+                return
+            entry['name'] = name
+            entry['last'] = rtt
+            entry['smoothed'] += LATENCY_SMOOTHING * (rtt - entry['smoothed'])
+            entry['min'] = min(entry['min'], rtt)
+            entry['max'] = max(entry['max'], rtt)
+            entry['samples'] += 1
+    
+    @staticmethod
+    def describe(transfer, now):
+        """补充用时、平均速度和截至当前的停顿时间"""
+        gap = now - transfer['last_progress']
+        if gap >= TRANSFER_STALL_THRESHOLD:
+            transfer['stall'] += gap
+            transfer['last_progress'] = now
+        transfer['duration'] = now - transfer['start']
+        transfer['speed'] = transfer['bytes'] / max(transfer['duration'], 1e-6)
+        return transfer
+    
+    def snapshot(self):
+        """返回统计数据的副本"""
+        now = time.time()
+        with self.lock:
+            return {
+                'time': now,
+                'active': [self.describe(dict(transfer), now) for transfer in self.active.values()],
+                'finished': [dict(transfer) for transfer in self.finished],
+                'latency': {mac: dict(entry) for mac, entry in self.latency.items()},
+                'totals': dict(self.totals)
+            }
+    
+    def write(self, path):
+        """把快照原子写入统计文件，排查传输慢的问题时可以直接读取"""
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.snapshot(), f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, path)
+
+def tokenize(text):
+    """分词：英文和数字按单词切分，中日韩文字按单字和相邻二字切分"""
+    tokens = set()
+    for match in TOKEN_PATTERN.finditer(text.lower()):
+        word = match.group()
+        if CJK_PATTERN.match(word):
+            tokens.update(word)
+            tokens.update(word[i:i + 2] for i in range(len(word) - 1))
+        else:
+            tokens.add(word)
+    return tokens
+
+def record_text(record):
+    """返回记录中参与检索的文本"""
+    return record.get('content') or record.get('filename') or ''
+
+class SearchIndex:
+    """全部设备聊天记录的倒排索引
+    
+    内存中保存 词 -> {设备目录名: 记录序号数组}；每个设备目录下的 Search.tok 逐行保存
+    "记录序号\t分词结果"，启动时直接加载分词结果，只对其后新增的记录重新分词。
+    """
+    
+    TOKENS_FILE = "Search.tok"
+    
+    def __init__(self, history):
+        self.history = history
+        self.lock = threading.Lock()
+        self.postings = collections.defaultdict(dict)
+        self.indexed_upto = {}  # safe_mac -> 该序号之前的记录都已索引
+        self.indexed_extra = collections.defaultdict(set)  # safe_mac -> 已索引但不连续的记录序号
+        self.ready = threading.Event()
+    
+    def tokens_path(self, safe_mac):
+        return os.path.join(self.history.device_dir(safe_mac), self.TOKENS_FILE)
+    
+    def index_tokens(self, safe_mac, record_no, tokens):
+        """把记录加入倒排表，已索引过的记录返回False（需持有锁）"""
+        upto = self.indexed_upto.get(safe_mac, 0)
+        extra = self.indexed_extra[safe_mac]
+        if record_no < upto or record_no in extra:
+            return False
+        for token in tokens:
+            numbers = self.postings[token].get(safe_mac)
+            if numbers is None:
+                numbers = self.postings[token][safe_mac] = array('I')
+            numbers.append(record_no)
+        extra.add(record_no)
+        while upto in extra:
+            extra.discard(upto)
+            upto += 1
+        self.indexed_upto[safe_mac] = upto
+        return True
+    
+    def load(self):
+        """加载所有设备的索引并补齐缺失的部分，在后台线程中调用"""
+        try:
+            for safe_mac in self.history.list_devices():
+                self.load_device(safe_mac)
+        except Exception as e:
+            print(f"加载搜索索引失败: {e}")
+        finally:
+            self.ready.set()
+    
+    def load_device(self, safe_mac):
+        path = self.tokens_path(safe_mac)
+        with self.lock:
+            if os.path.exists(path):
+                with open(path, 'r', encoding='utf-8') as f:
+                    for line in f:
+                        number, sep, tokens = line.rstrip("\n").partition("\t")
+                        if sep and number.isdigit():
+                            self.index_tokens(safe_mac, int(number), tokens.split())
+        self.catch_up(safe_mac)
+    
+    def catch_up(self, safe_mac):
+        """为尚未索引的记录（旧版本数据、异常退出或压缩之后）补建索引"""
+        start = 0
+        while True:
+            with self.lock:
+                start = max(start, self.indexed_upto.get(safe_mac, 0))
+            end = min(self.history.count(safe_mac), start + SEARCH_CATCH_UP_BATCH)
+            if start >= end:
+                return
+            for offset, record in enumerate(self.history.read_range(safe_mac, start, end)):
+                self.add(safe_mac, start + offset, record)
+            start = end
+    
+    def add(self, safe_mac, record_no, record):
+        """索引一条记录，record_no为HistoryStore.append返回的记录序号"""
+        tokens = tokenize(record_text(record))
+        with self.lock:
+            if self.index_tokens(safe_mac, record_no, tokens):
+                with open(self.tokens_path(safe_mac), 'a', encoding='utf-8') as f:
+                    f.write(f"{record_no}\t{' '.join(tokens)}\n")
+    
+    def rebuild_device(self, safe_mac):
+        """记录被压缩后序号发生变化，重建该设备的索引"""
+        with self.lock:
+            for token in list(self.postings):
+                devices = self.postings[token]
+                devices.pop(safe_mac, None)
+                if not devices:
+                    del self.postings[token]
+            self.indexed_upto[safe_mac] = 0
+            self.indexed_extra[safe_mac] = set()
+            try:
+                os.remove(self.tokens_path(safe_mac))
+            except FileNotFoundError:
+                pass
+        self.catch_up(safe_mac)
+    
+    def search(self, query, limit=SEARCH_RESULT_LIMIT):
+        """返回 [(设备目录名, 记录序号, 记录), ...]，按时间从新到旧排列"""
+        query = query.strip().lower()
+        tokens = tokenize(query)
+        if not tokens:
+            return []
+        
+        candidates = []
+        with self.lock:
+            posting_lists = [self.postings.get(token, {}) for token in tokens]
+            for safe_mac in set.intersection(*(set(p) for p in posting_lists)):
+                # 从最短的倒排列表开始求交集
+                lists = sorted((p[safe_mac] for p in posting_lists), key=len)
+                numbers = set(lists[0])
+                for other in lists[1:]:
+                    numbers.intersection_update(other)
+                candidates.extend((safe_mac, number) for number in numbers)
+        
+        # 二字切分可能误匹配，读取原记录确认包含全部查询词；
+        # 每个设备从最新的记录开始确认，够数后即停止，常见词也不会读取大量记录
+        terms = query.split()
+        by_device = collections.defaultdict(list)
+        for safe_mac, number in candidates:
+            by_device[safe_mac].append(number)
+        
+        results = []
+        for safe_mac, numbers in by_device.items():
+            numbers.sort(reverse=True)
+            found = 0
+            for i in range(0, len(numbers), limit):
+                batch = numbers[i:i + limit]
+                for number, record in zip(batch, self.history.read_numbers(safe_mac, batch)):
+                    text = record_text(record).lower() if record else ''
+                    if text and all(term in text for term in terms):
+                        results.append((safe_mac, number, record))
+                        found += 1
+                if found >= limit:
+                    break
+        results.sort(key=lambda r: -r[2].get('timestamp', 0))
+        return results[:limit]
+
+class LanChatApp:
+    def __init__(self, root):
+        self.root = root
+        self.root.title("DCChatting | 局域网通信工具")
+        self.root.geometry("1000x700")
+        self.root.resizable(True, True)
+        
+        # 设置窗口图标
+        self.set_window_icon()
+        
+        # 创建数据目录和图片目录
+        self.data_dir = "Data"
+        self.image_dir = os.path.join(self.data_dir, "Image")
+        os.makedirs(self.data_dir, exist_ok=True)
+        os.makedirs(self.image_dir, exist_ok=True)
+        
+        # 聊天记录存储（内部加锁，可在界面线程和网络线程中使用）
+        self.history = HistoryStore(self.data_dir)
+        
+        # 收发的文件按内容存储，各设备的Files目录中是硬链接
+        self.blobs = BlobStore(self.data_dir)
+        
+        # 对方头像按哈希缓存在图片目录，已渲染的头像按 (哈希, 尺寸) 缓存（仅在界面线程中访问）
+        self.avatars = AvatarCache(self.image_dir)
+        self.avatar_images = {}
+        
+        # 聊天记录全文索引，在后台线程中加载
+        self.search_index = SearchIndex(self.history)
+        threading.Thread(target=self.search_index.load, daemon=True).start()
+        
+        # 传输和时延统计，定期写入统计文件
+        self.metrics = TransferMetrics()
+        self.stats_path = os.path.join(self.data_dir, "stats.json")
+        
+        # 未完成的文件发送，对方重新连接后续传（仅在网络线程中修改）
+        self.pending_sends_path = os.path.join(self.data_dir, "pending_sends.json")
+        self.pending_sends = self.load_pending_sends()
+        
+        # 线程锁，确保界面线程与网络线程共享的数据安全
+        self.devices_lock = threading.Lock()
+        
+        # 获取本地设备信息
+        self.local_device = self.get_local_device()
+        self.devices = DeviceRegistry()  # 设备连接挂在device.connection上
+        self.active_chats = {}  # MAC -> chat_info
+        
+        # 当前选中的聊天设备
+        self.current_chat_device = None
+        
+        # 网络线程通过该队列把界面操作交给Tk主循环执行
+        self.ui_queue = queue.Queue()
+        
+        # 创建主界面
+        self.create_main_interface()
+        
+        # 启动网络服务（单独线程中的asyncio事件循环负责所有套接字和定时器）
+        self.running = True
+        self.start_networking()
+        self.process_ui_queue()
+        
+        # 按自动清理策略在后台压缩聊天记录
+        self.compaction_running = False
+        self.root.after(RETENTION_STARTUP_DELAY * 1000, self.schedule_retention)
+        
+        # 关闭窗口时的清理
+        self.root.protocol("WM_DELETE_WINDOW", self.on_closing)
+    
+    def set_window_icon(self):
+        """设置窗口图标为当前目录下的icon.ico"""
+        try:
+            if os.path.exists("icon.ico"):
+                self.root.iconbitmap("icon.ico")
+        except Exception as e:
+            print(f"设置图标失败: {e}")
+    
+    def get_local_ip(self):
+        """获取非本地的IP地址"""
+        try:
+            # 尝试连接到外部服务器获取IP
+            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            s.connect(("8.8.8.8", 80))
+            ip = s.getsockname()[0]
+            s.close()
+            if not ip.startswith("127."):
+                return ip
+        except:
+            pass
+            
+        # 如果连接外部失败，遍历所有网络接口
+        for interface in socket.if_nameindex():
+            try:
+                sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                sock.bind((interface[1], 0))
+                sock.connect(("8.8.8.8", 80))
+                ip = sock.getsockname()[0]
+                sock.close()
+                if not ip.startswith("127."):
+                    return ip
+            except:
+                continue
+                
+        return "127.0.0.1"
+    
+    def get_local_device(self):
+        # 获取本机IP地址
+        ip = self.get_local_ip()
+        
+        # 获取MAC地址
+        mac = ':'.join(['{:02x}'.format((uuid.getnode() >> elements) & 0xff) 
+                       for elements in range(0,2*6,2)][::-1])
+        
+        # 获取计算机名作为默认名称
+        name = platform.node()
+        
+        # 尝试从配置文件加载用户设置的名称
+        name_config_path = os.path.join(self.data_dir, "username.txt")
+        if os.path.exists(name_config_path):
+            try:
+                with open(name_config_path, 'r', encoding='utf-8') as f:
+                    saved_name = f.read().strip()
+                    if saved_name:
+                        name = saved_name
+            except:
+                pass
+        
+        # 创建默认头像
+        avatar = None
+        
+        # 尝试加载自定义头像
+        avatar_path = os.path.join(self.data_dir, "avatar.png")
+        if os.path.exists(avatar_path):
+            try:
+                img = Image.open(avatar_path)
+                img = self.crop_to_circle(img)
+                img_byte_arr = io.BytesIO()
+                img.save(img_byte_arr, format='PNG')
+                avatar = img_byte_arr.getvalue()
+            except:
+                pass
+        
+        return NetworkDevice(ip, mac, name, avatar)
+    
+    def save_username(self, username):
+        """保存用户名到配置文件"""
+        try:
+            name_config_path = os.path.join(self.data_dir, "username.txt")
+            with open(name_config_path, 'w', encoding='utf-8') as f:
+                f.write(username)
+            return True
+        except Exception as e:
+            print(f"保存用户名失败: {e}")
+            return False
+    
+    def change_username(self):
+        """修改用户名对话框"""
+        def apply_change():
+            new_name = entry.get().strip()
+            if new_name and new_name != self.local_device.name:
+                old_name = self.local_device.name
+                self.local_device.name = new_name
+                # 保存到配置文件
+                self.save_username(new_name)
+                # 更新UI显示
+                self.local_name_label.config(text=new_name)
+                # 广播名称更新
+                self.broadcast_name_change(old_name, new_name)
+                top.destroy()
+        
+        top = Toplevel(self.root)
+        top.title("修改用户名")
+        top.geometry("300x150")
+        top.resizable(False, False)
+        top.transient(self.root)
+        top.grab_set()
+        
+        frame = ttk.Frame(top, padding=20)
+        frame.pack(fill=BOTH, expand=True)
+        
+        ttk.Label(frame, text="请输入新的用户名:").pack(anchor=W, pady=5)
+        
+        entry = ttk.Entry(frame)
+        entry.pack(fill=X, pady=10)
+        entry.insert(0, self.local_device.name)
+        entry.focus()
+        
+        btn_frame = ttk.Frame(frame)
+        btn_frame.pack(fill=X)
+        
+        ttk.Button(btn_frame, text="取消", command=top.destroy).pack(side=RIGHT, padx=5)
+        ttk.Button(btn_frame, text="确定", command=apply_change).pack(side=RIGHT)
+        
+        # 按Enter键确认
+        entry.bind("<Return>", lambda e: apply_change())
+    
+    def broadcast_name_change(self, old_name, new_name):
+        """广播名称变更信息给所有在线计算机"""
+        # 立即广播设备信息
+        self.call_in_network(self.broadcast_device_info)
+        
+        # 向所有已连接设备发送名称变更消息
+        self.call_in_network(self.send_to_all, {
+            'type': 'name_change',
+            'old_name': old_name,
+            'new_name': new_name,
+            'mac': self.local_device.mac
+        })
+        
+    
+    def crop_to_circle(self, img):
+        """将图像裁剪为圆形"""
+        size = min(img.size)
+        mask = Image.new('L', (size, size), 0)
+        draw = ImageDraw.Draw(mask)
+        draw.ellipse((0, 0, size, size), fill=255)
+        
+        output = ImageOps.fit(img, (size, size), centering=(0.5, 0.5))
+        output.putalpha(mask)
+        return output
+    
+    def create_main_interface(self):
+        # 创建主框架
+        main_frame = ttk.Frame(self.root)
+        main_frame.pack(fill=BOTH, expand=True, padx=10, pady=10)
+        
+        # 分割左右面板
+        paned_window = ttk.PanedWindow(main_frame, orient=HORIZONTAL)
+        paned_window.pack(fill=BOTH, expand=True)
+        
+        # 左侧设备面板
+        left_frame = ttk.Frame(paned_window, width=250)
+        paned_window.add(left_frame, weight=0)
+        
+        # 标题、头像和名称修改按钮
+        self.title_frame = ttk.Frame(left_frame)
+        self.title_frame.pack(fill=X, pady=(0, 10))
+        
+        # 显示本地头像
+        self.local_avatar_img = self.create_avatar_image(self.local_device.avatar, 60)
+        avatar_label = ttk.Label(self.title_frame, image=self.local_avatar_img)
+        avatar_label.image = self.local_avatar_img
+        avatar_label.pack(side=LEFT, padx=(0, 10))
+        
+        # 名称和修改按钮
+        name_frame = ttk.Frame(self.title_frame)
+        name_frame.pack(side=LEFT, fill=X, expand=True)
+        
+        # 设备名称 - 使用单独的变量引用以便更新
+        self.local_name_label = ttk.Label(name_frame, text=self.local_device.name, 
+                 font=("Arial", 12, "bold"))
+        self.local_name_label.pack(anchor=W)
+        
+        # 修改名称按钮
+        ttk.Button(name_frame, text="修改名称", width=8, 
+                  command=self.change_username).pack(anchor=W)
+        
+        # 更改头像按钮
+        ttk.Button(self.title_frame, text="更改头像", width=10, 
+                  command=self.change_avatar).pack(side=RIGHT, padx=(10, 0))
+        
+        # 搜索框
+        search_frame = ttk.Frame(left_frame)
+        search_frame.pack(fill=X, pady=(0, 10))
+        
+        self.search_var = StringVar()
+        search_entry = ttk.Entry(search_frame, textvariable=self.search_var)
+        search_entry.pack(side=LEFT, fill=X, expand=True, padx=(0, 5))
+        search_entry.bind("<KeyRelease>", self.filter_devices)
+        
+        ttk.Button(search_frame, text="搜索", 
+                  command=self.filter_devices).pack(side=LEFT)
+        
+        ttk.Button(search_frame, text="搜索记录", 
+                  command=self.search_records).pack(side=LEFT, padx=(5, 0))
+        
+        ttk.Button(search_frame, text="传输监控", 
+                  command=self.show_transfer_monitor).pack(side=LEFT, padx=(5, 0))
+        
+        # 在线设备列表
+        devices_frame = ttk.LabelFrame(left_frame, text="在线设备")
+        devices_frame.pack(fill=BOTH, expand=True)
+        
+        # 创建Treeview
+        self.devices_tree = ttk.Treeview(devices_frame, columns=["name"], show="headings")
+        self.devices_tree.column("name", width=180)
+        self.devices_tree.heading("name", text="设备名称")
+        self.devices_tree.tag_configure("unread", font=("Arial", 10, "bold"), foreground="blue")
+        self.devices_tree.tag_configure("offline", font=("Arial", 10), foreground="gray")
+        self.devices_tree.tag_configure("online", font=("Arial", 10), foreground="black")
+        
+        # 列表中已显示的行（行ID为MAC），刷新时只更新有变化的行
+        self.device_rows = {}  # MAC -> (显示文本, 标签)
+        self.device_order = []
+        self.devices_refresh_pending = False
+        
+        scrollbar = ttk.Scrollbar(devices_frame, orient=VERTICAL, 
+                                 command=self.devices_tree.yview)
+        self.devices_tree.configure(yscrollcommand=scrollbar.set)
+        
+        scrollbar.pack(side=RIGHT, fill=Y)
+        self.devices_tree.pack(fill=BOTH, expand=True, padx=0, pady=0)
+        
+        # 绑定选择事件
+        self.devices_tree.bind('<<TreeviewSelect>>', self.on_device_select)
+        
+        # 右侧聊天面板
+        self.right_frame = ttk.Frame(paned_window)
+        paned_window.add(self.right_frame, weight=1)
+        
+        # 创建初始聊天界面
+        self.create_chat_placeholder()
+        
+        # 状态栏
+        self.status_var = StringVar()
+        self.status_var.set("就绪")
+        status_bar = ttk.Label(self.root, textvariable=self.status_var, relief=SUNKEN, anchor=W)
+        status_bar.pack(side=BOTTOM, fill=X)
+    
+    def create_chat_placeholder(self):
+        # 清除右侧面板
+        for widget in self.right_frame.winfo_children():
+            widget.destroy()
+        
+        # 创建占位界面
+        placeholder_frame = ttk.Frame(self.right_frame)
+        placeholder_frame.pack(fill=BOTH, expand=True, padx=50, pady=50)
+        
+        # 添加提示信息
+        ttk.Label(placeholder_frame, text="局域网通信工具", 
+                 font=("Arial", 24, "bold"), foreground="#4e8cff").pack(pady=20)
+        
+        # 添加图标
+        try:
+            img = Image.open("chat_icon.png")
+        except:
+            # 创建默认图标
+            img = Image.new('RGB', (256, 256), color='white')
+            draw = ImageDraw.Draw(img)
+            draw.ellipse((50, 50, 206, 206), outline='#4e8cff', width=10)
+            draw.line((80, 180, 176, 180), fill='#4e8cff', width=10)
+        
+        img = img.resize((200, 200), Image.LANCZOS)
+        self.chat_img = ImageTk.PhotoImage(img)
+        
+        ttk.Label(placeholder_frame, image=self.chat_img).pack(pady=20)
+        
+        info_text = "请从左侧设备列表中选择一个设备开始聊天\n\n"
+        info_text += "功能说明:\n"
+        info_text += "- 搜索框可以按名称过滤设备\n"
+        info_text += "- 点击设备可以开始聊天\n"
+        info_text += "- 支持文本消息和文件传输\n"
+        info_text += "- 聊天记录自动保存并分页存储\n"
+        info_text += "- 可以更改个人头像和用户名"
+        
+        ttk.Label(placeholder_frame, text=info_text, 
+                 font=("Arial", 11), justify=LEFT).pack(pady=10)
+    
+    def create_chat_interface(self, device):
+        # 清除右侧面板
+        for widget in self.right_frame.winfo_children():
+            widget.destroy()
+        
+        # 创建聊天主框架
+        chat_frame = ttk.Frame(self.right_frame)
+        chat_frame.pack(fill=BOTH, expand=True, padx=10, pady=10)
+        
+        # 聊天头部 (显示对方信息)
+        header_frame = ttk.Frame(chat_frame)
+        header_frame.pack(fill=X, pady=(0, 10))
+        
+        # 显示对方头像
+        avatar_img = self.create_avatar_image(device.avatar, 50)
+        avatar_label = ttk.Label(header_frame, image=avatar_img)
+        avatar_label.image = avatar_img
+        avatar_label.pack(side=LEFT, padx=(0, 10))
+        
+        # 对方信息
+        info_frame = ttk.Frame(header_frame)
+        info_frame.pack(side=LEFT, fill=X, expand=True)
+        
+        # 对方名称标签 - 使用变量以便后续更新
+        self.current_chat_name_label = ttk.Label(info_frame, text=device.name, 
+                 font=("Arial", 14, "bold"))
+        self.current_chat_name_label.pack(anchor=W)
+        
+        status_text = "在线" if device.is_online else "离线"
+        status_color = "green" if device.is_online else "gray"
+        ttk.Label(info_frame, text=status_text, 
+                 font=("Arial", 10), foreground=status_color).pack(anchor=W)
+        
+        # 聊天记录区域
+        chat_history_frame = ttk.LabelFrame(chat_frame, text="聊天记录")
+        chat_history_frame.pack(fill=BOTH, expand=True, pady=(0, 10))
+        
+        chat_text = scrolledtext.ScrolledText(chat_history_frame, wrap=WORD, state="disabled")
+        chat_text.pack(fill=BOTH, expand=True, padx=5, pady=5)
+        
+        # 滚动到顶部时按需加载更早的记录
+        def on_scroll(first, last):
+            chat_text.vbar.set(first, last)
+            if float(first) <= 0.0:
+                self.root.after_idle(self.load_older_history, device, chat_text)
+        chat_text.configure(yscrollcommand=on_scroll)
+        
+        # 输入区域
+        input_frame = ttk.Frame(chat_frame)
+        input_frame.pack(fill=X, pady=(0, 10))
+        
+        input_entry = ttk.Entry(input_frame)
+        input_entry.pack(side=LEFT, fill=X, expand=True, padx=(0, 5))
+        input_entry.bind("<Return>", lambda e: self.send_message(device, input_entry))
+        
+        send_btn = ttk.Button(input_frame, text="发送", 
+                             command=lambda: self.send_message(device, input_entry))
+        send_btn.pack(side=LEFT)
+        
+        # 文件发送按钮
+        file_btn = ttk.Button(input_frame, text="发送文件", 
+                             command=lambda: self.send_file(device))
+        file_btn.pack(side=LEFT, padx=(5, 0))
+        
+        folder_btn = ttk.Button(input_frame, text="发送文件夹", 
+                               command=lambda: self.send_folder(device))
+        folder_btn.pack(side=LEFT, padx=(5, 0))
+        
+        # 管理记录按钮
+        manage_btn = ttk.Button(input_frame, text="管理记录", 
+                              command=self.manage_records)
+        manage_btn.pack(side=RIGHT, padx=(5, 0))
+        
+        # 保存聊天界面引用
+        self.active_chats[device.mac] = {
+            "text_widget": chat_text,
+            "input_entry": input_entry,
+            "device": device,
+            "name_label": self.current_chat_name_label,
+            "history_start": 0  # 已加载的最早一条记录的序号
+        }
+        
+        # 加载历史消息
+        self.load_history_messages(device, chat_text)
+        
+        # 重置未读消息计数
+        with self.devices_lock:
+            device.unread_messages = 0
+        self.update_devices_listbox()
+    
+    def create_avatar_image(self, avatar_data, size):
+        """从字节数据创建头像图像，同一头像同一尺寸只解码和缩放一次"""
+        key = (hashlib.sha256(avatar_data).hexdigest() if avatar_data else '', size)
+        image = self.avatar_images.get(key)
+        if image is None:
+            image = self.render_avatar_image(avatar_data, size)
+            if len(self.avatar_images) >= AVATAR_IMAGE_CACHE_SIZE:
+                self.avatar_images.pop(next(iter(self.avatar_images)))
+            self.avatar_images[key] = image
+        return image
+    
+    def render_avatar_image(self, avatar_data, size):
+        """解码头像并缩放、裁剪为圆形"""
+        try:
+            if avatar_data:
+                img = Image.open(io.BytesIO(avatar_data))
+            else:
+                # 创建默认头像
+                img = Image.new('RGBA', (size, size), (0, 0, 0, 0))
+                draw = ImageDraw.Draw(img)
+                draw.ellipse((0, 0, size-1, size-1), fill="#4e8cff")
+        except:
+            # 创建默认头像
+            img = Image.new('RGBA', (size, size), (0, 0, 0, 0))
+            draw = ImageDraw.Draw(img)
+            draw.ellipse((0, 0, size-1, size-1), fill="#4e8cff")
+        
+        # 调整大小并转换为圆形
+        img = img.resize((size, size), Image.LANCZOS)
+        img = self.crop_to_circle(img)
+        return ImageTk.PhotoImage(img)
+    
+    def start_networking(self):
+        # 创建UDP广播套接字
+        self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        self.udp_socket.bind(('0.0.0.0', BROADCAST_PORT))
+        
+        # 创建TCP服务器套接字
+        self.tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.tcp_socket.bind(('0.0.0.0', TCP_PORT))
+        self.tcp_socket.listen(LISTEN_BACKLOG)
+        
+        # 设备发现广播状态：名称或IP变化时递增版本号，接收方缓存各地址最近一次的原始广播
+        self.beacon_version = int(time.time())
+        self.beacon_fields = None
+        self.beacon_interval = DISCOVERY_INTERVAL
+        self.beacon_cache = collections.OrderedDict()  # IP -> (原始数据, MAC)，按最近收到顺序排列
+        
+        # 套接字交给独立线程中的事件循环统一管理
+        self.connecting = set()  # 正在主动连接的设备MAC
+        self.loop = asyncio.new_event_loop()
+        self.network_thread = threading.Thread(target=self.run_network_loop, daemon=True)
+        self.network_thread.start()
+    
+    def run_network_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.create_task(self.network_main())
+        try:
+            self.loop.run_forever()
+        finally:
+            self.loop.close()
+    
+    async def network_main(self):
+        """在事件循环中启动UDP、TCP服务以及发现、心跳和超时检查定时任务"""
+        self.udp_transport, _ = await self.loop.create_datagram_endpoint(
+            lambda: DiscoveryProtocol(self), sock=self.udp_socket)
+        # 入站连接的接纳控制：握手并发数、排队数和同一地址的连接数都有上限
+        self.handshake_slots = asyncio.Semaphore(MAX_CONCURRENT_HANDSHAKES)
+        self.handshakes_waiting = 0
+        self.inbound_peers = collections.Counter()  # IP -> 握手中和已建立的入站连接数
+        self.tcp_server = await asyncio.start_server(self.handle_tcp_connection, sock=self.tcp_socket,
+                                                     backlog=LISTEN_BACKLOG)
+        
+        # 设备离线检查和心跳发送共用一个定时器
+        self.timers = DeadlineScheduler()
+        self.timer_wakeup = asyncio.Event()
+        
+        self.schedule_timer(('stats', None), STATS_WRITE_INTERVAL)
+        
+        self.loop.create_task(self.discovery_loop())
+        self.loop.create_task(self.timer_loop())
+    
+    def call_in_network(self, func, *args):
+        """从任意线程把普通函数交给网络线程执行"""
+        if self.running:
+            self.loop.call_soon_threadsafe(func, *args)
+    
+    def run_in_network(self, coro):
+        """从任意线程把协程交给网络线程执行"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+    
+    def call_in_ui(self, func, *args):
+        """从网络线程把界面操作交给Tk主循环执行"""
+        self.ui_queue.put((func, args))
+    
+    def process_ui_queue(self):
+        """在Tk主循环中执行网络线程提交的界面操作"""
+        while True:
+            try:
+                func, args = self.ui_queue.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                func(*args)
+            except Exception as e:
+                print(f"界面更新错误: {e}")
+        if self.running:
+            self.root.after(UI_POLL_INTERVAL, self.process_ui_queue)
+    
+    def cache_beacon(self, ip, data, mac):
+        """记录该地址最近一次的原始广播，超出上限时淘汰最久未收到广播的地址"""
+        self.beacon_cache[ip] = (data, mac)
+        self.beacon_cache.move_to_end(ip)
+        while len(self.beacon_cache) > BEACON_CACHE_SIZE:
+            self.beacon_cache.popitem(last=False)
+    
+    def on_discovery_packet(self, data, addr):
+        """处理UDP广播的设备信息（网络线程）"""
+        try:
+            # 与该地址上次的广播完全相同时只刷新时间戳，不再解析
+            cached = self.beacon_cache.get(addr[0])
+            if cached and cached[0] == data:
+                self.beacon_cache.move_to_end(addr[0])
+                if cached[1] == self.local_device.mac:
+                    return
+                with self.devices_lock:
+                    device = self.devices.get(cached[1])
+                    if device:
+                        device.update_timestamp()
+                        return
+            
+            device_info = json.loads(data.decode('utf-8'))
+            if not device_info.get('query'):
+                self.cache_beacon(addr[0], bytes(data), device_info['mac'])
+            
+            # 忽略自己的广播
+            if device_info['mac'] == self.local_device.mac:
+                return
+            
+            # 新上线的设备发送查询，随机延迟后单播回复本机信息
+            if device_info.get('query'):
+                self.loop.call_later(random.uniform(0, DISCOVERY_REPLY_SPREAD), self.send_device_info, addr[0])
+            
+            # 更新设备列表
+            with self.devices_lock:
+                device = self.devices.get(device_info['mac'])
+                # 忽略乱序到达的旧版本广播
+                version = device_info.get('version', 0)
+                if device and version < device.beacon_version:
+                    return
+                # 已在列表中的设备只更新时间戳、名称和IP，名称未变时不刷新界面
+                changed = not device or device.name != device_info['name']
+                device = self.devices.restore(device_info['mac'], device_info['ip'], device_info['name'])
+                if device:
+                    device.update_timestamp()
+                else:
+                    # 创建新设备
+                    device = NetworkDevice(
+                        device_info['ip'],
+                        device_info['mac'],
+                        device_info['name'],
+                        timestamp=time.time()
+                    )
+                    self.devices.add(device)
+                device.beacon_version = version
+                device.beacon_interval = min(DISCOVERY_MAX_INTERVAL,
+                                             device_info.get('interval') or DISCOVERY_INTERVAL)
+            self.watch_device(device)
+            
+            if changed:
+                self.call_in_ui(self.update_devices_listbox)
+            
+        except Exception as e:
+            print(f"UDP监听错误: {e}")
+    
+    def make_hello(self):
+        """构造握手消息，携带本机支持的协议版本范围"""
+        return {
+            'type': 'hello',
+            'ip': self.local_device.ip,
+            'mac': self.local_device.mac,
+            'name': self.local_device.name,
+            'min_version': MIN_PROTOCOL_VERSION,
+            'max_version': PROTOCOL_VERSION
+        }
+    
+    def make_avatar_message(self, conn, message_type='avatar'):
+        """构造本机头像消息，协议版本6起只携带哈希"""
+        return {
+            'type': message_type,
+            'content': self.local_device.avatar if conn.version < 6 else b'',
+            'avatar_hash': self.local_device.avatar_hash,
+            'mac': self.local_device.mac
+        }
+    
+    def apply_peer_avatar(self, conn, device, message):
+        """处理对方发来的头像或头像哈希，未缓存时向对方请求内容，返回头像是否已更新（网络线程）"""
+        content = message.get('content')
+        if content:
+            try:
+                self.avatars.store(content)
+            except Exception as e:
+                print(f"保存头像缓存失败: {e}")
+        elif message.get('avatar_hash') and message['avatar_hash'] != device.avatar_hash:
+            content = self.avatars.load(message['avatar_hash'])
+            if content is None:
+                conn.send_message({'type': 'avatar_request', 'avatar_hash': message['avatar_hash']})
+                return False
+        if not content:
+            return False
+        with self.devices_lock:
+            device.avatar = content
+        return True
+    
+    async def handle_tcp_connection(self, reader, writer):
+        """接纳对方主动建立的连接：同一地址连接过多或等待握手的连接过多时直接关闭，连接突增时不影响已有连接"""
+        ip = writer.get_extra_info('peername')[0]
+        if self.inbound_peers[ip] >= MAX_CONNECTIONS_PER_PEER or self.handshakes_waiting >= HANDSHAKE_QUEUE_LIMIT:
+            print(f"连接过多，拒绝来自 {ip} 的连接")
+            writer.transport.abort()
+            return
+        self.inbound_peers[ip] += 1
+        try:
+            self.handshakes_waiting += 1
+            try:
+                await self.handshake_slots.acquire()
+            finally:
+                self.handshakes_waiting -= 1
+            try:
+                accepted = await self.accept_connection(reader, writer)
+            finally:
+                self.handshake_slots.release()
+            if accepted:
+                await self.receive_loop(*accepted)
+        finally:
+            self.inbound_peers[ip] -= 1
+            if not self.inbound_peers[ip]:
+                del self.inbound_peers[ip]
+    
+    async def accept_connection(self, reader, writer):
+        """完成入站连接的握手并保存连接，返回 (连接, 设备)，失败时返回None"""
+        conn = FramedConnection(reader, writer)
+        addr = writer.get_extra_info('peername')
+        try:
+            # 接收设备信息
+            hello = await asyncio.wait_for(conn.recv_message(), CONNECT_TIMEOUT)
+            if not hello or hello.get('type') != 'hello':
+                conn.close()
+                return None
+            mac = hello['mac']
+            version = negotiate_version(hello)
+            
+            # 检查是否已知设备
+            with self.devices_lock:
+                device = self.devices.restore(mac, addr[0], hello['name'])
+                if not device:
+                    device = NetworkDevice(addr[0], mac, hello['name'])
+                    self.devices.add(device)
+            
+            # 回复本地设备信息，之后的消息使用协商后的版本
+            conn.send_message(self.make_hello())
+            conn.version = version
+            
+            # 发送本地头像
+            conn.send_message(self.make_avatar_message(conn))
+            
+            # 接收对方头像，对方在握手中断开时不保存连接
+            avatar_msg = await asyncio.wait_for(conn.recv_message(), CONNECT_TIMEOUT)
+            if not avatar_msg or avatar_msg.get('type') != 'avatar':
+                raise Exception("握手失败")
+            self.apply_peer_avatar(conn, device, avatar_msg)
+        except Exception as e:
+            print(f"TCP连接处理错误: {e}")
+            conn.close()
+            return None
+        
+        # 保存连接，并继续上次中断的文件发送
+        self.attach_connection(device, conn)
+        self.call_in_ui(self.on_peer_connected, device)
+        self.resume_pending_sends(device)
+        return conn, device
+    
+    def on_peer_connected(self, device):
+        """对方连接成功后更新界面（界面线程）"""
+        # 更新设备列表
+        self.update_devices_listbox()
+        
+        # 打开聊天窗口
+        if device.mac in self.active_chats and self.current_chat_device == device:
+            self.create_chat_interface(device)
+        elif not self.current_chat_device:
+            self.create_chat_interface(device)
+            self.current_chat_device = device
+    
+    async def connect_to_device(self, device):
+        """主动连接设备并完成握手（网络线程）"""
+        if device.connection or device.mac in self.connecting:
+            return
+        self.connecting.add(device.mac)
+        conn = None
+        try:
+            # 创建TCP连接
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(device.ip, TCP_PORT), CONNECT_TIMEOUT)
+            conn = FramedConnection(reader, writer)
+            
+            # 发送本地设备信息，并根据对方回复协商协议版本
+            conn.send_message(self.make_hello())
+            hello = await asyncio.wait_for(conn.recv_message(), CONNECT_TIMEOUT)
+            if not hello or hello.get('type') != 'hello':
+                raise Exception("握手失败")
+            conn.version = negotiate_version(hello)
+            
+            # 接收对方头像，先回复本机头像再处理，保证握手消息顺序；对方在握手中断开时不保存连接
+            avatar_msg = await asyncio.wait_for(conn.recv_message(), CONNECT_TIMEOUT)
+            if not avatar_msg or avatar_msg.get('type') != 'avatar':
+                raise Exception("握手失败")
+            conn.send_message(self.make_avatar_message(conn))
+            self.apply_peer_avatar(conn, device, avatar_msg)
+        except Exception as e:
+            # 握手失败时关闭连接，释放套接字和写协程
+            if conn:
+                conn.close()
+            self.call_in_ui(messagebox.showerror, "连接失败", f"无法连接到设备: {e}")
+            return
+        finally:
+            self.connecting.discard(device.mac)
+        
+        # 保存连接，由单独的协程处理这个连接
+        self.attach_connection(device, conn)
+        self.loop.create_task(self.receive_loop(conn, device))
+        self.call_in_ui(self.on_peer_connected, device)
+        self.resume_pending_sends(device)
+    
+    async def receive_loop(self, conn, device):
+        """持续接收并分发对方发来的消息（网络线程）"""
+        try:
+            while self.running:
+                try:
+                    frame = await conn.recv_frame()
+                    if frame is None:
+                        break
+                except Exception as e:
+                    print(f"接收数据错误: {e}")
+                    break
+                
+                frame_type, payload = frame
+                
+                # 传输数据交给所属的流，由各自的接收协程处理，控制消息在这里直接处理
+                try:
+                    if frame_type == FRAME_HEARTBEAT:
+                        # 带发送时间的心跳原样回复，对方据此计算往返时延
+                        if payload:
+                            conn.send_frame(FRAME_HEARTBEAT_ACK, payload)
+                    elif frame_type == FRAME_HEARTBEAT_ACK:
+                        rtt = time.monotonic() - HEARTBEAT_STAMP.unpack(payload)[0]
+                        self.metrics.record_latency(device.mac, device.name, rtt)
+                    elif frame_type == FRAME_STREAM:
+                        stream_id, inner_type = STREAM_HEADER.unpack_from(payload)
+                        await self.feed_stream(conn, stream_id, inner_type,
+                                               memoryview(payload)[STREAM_HEADER.size:])
+                    elif frame_type in (FRAME_FILE_DATA, FRAME_FILE_CHUNK, FRAME_BATCH_CHUNK):
+                        # 旧版本对方不分流，数据帧属于当前唯一的传输
+                        await self.feed_stream(conn, 0, frame_type, payload)
+                    elif frame_type == FRAME_READY:
+                        stream = conn.outgoing.get(0)
+                        if stream:
+                            stream.ready_event.set()
+                    elif frame_type == FRAME_MESSAGE:
+                        message = decode_message(payload)
+                        if message['type'] in ('file_end', 'batch_end'):
+                            await self.feed_stream(conn, 0, frame_type, payload)
+                        else:
+                            self.handle_control_message(conn, device, message)
+                except ConnectionError as e:
+                    print(f"接收数据错误: {e}")
+                    break
+                except Exception as e:
+                    print(f"解析消息错误: {e}")
+                
+        finally:
+            if device.connection is conn:
+                device.connection = None
+            conn.close()
+    
+    def handle_control_message(self, conn, device, message):
+        """处理文件传输以外的控制消息，文件接收过程中穿插到达的消息也在这里处理（网络线程）"""
+        if message['type'] == 'text':
+            self.call_in_ui(self.receive_message, device, message['content'])
+        elif message['type'] == 'name_change':
+            # 处理名称变更
+            self.call_in_ui(self.handle_name_change, message['old_name'], message['new_name'], message['mac'])
+        elif message['type'] == 'avatar_update':
+            # 处理头像更新，只收到哈希且未缓存时等对方回复内容后再刷新
+            with self.devices_lock:
+                peer = self.devices.get(message['mac'])
+            if peer and self.apply_peer_avatar(conn, peer, message):
+                self.call_in_ui(self.on_avatar_updated, message['mac'])
+        elif message['type'] == 'avatar_request':
+            # 对方没有缓存本机头像，回复完整内容
+            conn.send_message({
+                'type': 'avatar_update',
+                'content': self.local_device.avatar,
+                'avatar_hash': self.local_device.avatar_hash,
+                'mac': self.local_device.mac
+            })
+        elif message['type'] in ('file_metadata', 'batch_manifest'):
+            self.open_incoming_stream(conn, device, message)
+        elif message['type'] in ('file_resume', 'batch_resume', 'file_error', 'window_update'):
+            # 接收方的回复按流编号交给对应的发送协程，旧版本对方的流编号总是0
+            stream = conn.outgoing.get(message['stream_id'])
+            if message['type'] == 'file_error':
+                print(f"对方接收文件失败: {message['message']}")
+                if stream:
+                    stream.fail(message['message'])
+            elif not stream:
+                return
+            elif message['type'] == 'window_update':
+                stream.add_credit(message['credit'])
+            else:
+                stream.resume_received = message['received']
+                stream.ready_event.set()
+    
+    def open_incoming_stream(self, conn, device, message):
+        """为对方发起的文件或批量传输建立接收流，由单独的协程接收，不阻塞其他消息和传输（网络线程）"""
+        stream_id = message['stream_id'] if conn.version >= 7 else 0
+        previous = conn.incoming.get(stream_id)
+        if previous and not previous.finished:
+            print(f"文件接收过程中收到重复的文件请求，已忽略: {message['type']}")
+            return
+        stream = TransferStream(conn, stream_id)
+        conn.incoming[stream_id] = stream
+        if message['type'] == 'file_metadata':
+            handler = self.handle_file_reception
+        else:
+            handler = self.handle_batch_reception
+        
+        async def receive():
+            try:
+                await handler(stream, device, message)
+            finally:
+                stream.close()
+                if conn.incoming.get(stream_id) is stream:
+                    del conn.incoming[stream_id]
+        
+        self.loop.create_task(receive())
+    
+    async def feed_stream(self, conn, stream_id, frame_type, payload):
+        """把收到的传输帧放入所属的接收流，压缩帧在此还原，流已结束时丢弃（网络线程）"""
+        stream = conn.incoming.get(stream_id)
+        if not stream:
+            return
+        size = len(payload)
+        if frame_type == FRAME_COMPRESSED:
+            frame_type, payload = decompress_frame(payload)
+        await stream.put(frame_type, payload, size)
+    
+    def on_avatar_updated(self, mac):
+        """对方头像更新后刷新界面（界面线程）"""
+        self.update_devices_listbox()
+        if self.current_chat_device and self.current_chat_device.mac == mac:
+            self.create_chat_interface(self.current_chat_device)
+    
+    def send_to_device(self, device, message):
+        """向指定设备发送控制消息（网络线程）"""
+        conn = device.connection
+        if not conn:
+            return
+        try:
+            conn.send_message(message)
+        except Exception as e:
+            print(f"发送消息失败: {e}")
+            self.call_in_ui(messagebox.showerror, "发送失败", "无法发送消息")
+    
+    def connected_devices(self):
+        """返回已建立连接的设备（网络线程）"""
+        with self.devices_lock:
+            return self.devices.connected()
+    
+    def send_to_all(self, message):
+        """向所有已连接设备发送控制消息（网络线程）"""
+        for device in self.connected_devices():
+            try:
+                device.connection.send_message(message)
+            except Exception as e:
+                print(f"发送消息失败: {e}")
+    
+    def broadcast_avatar(self):
+        """通知所有已连接设备本机头像已更新（网络线程）"""
+        for device in self.connected_devices():
+            try:
+                conn = device.connection
+                conn.send_message(self.make_avatar_message(conn, 'avatar_update'))
+            except Exception as e:
+                print(f"发送消息失败: {e}")
+    
+    def handle_name_change(self, old_name, new_name, mac):
+        """处理接收到的名称变更消息"""
+        with self.devices_lock:
+            device = self.devices.get(mac)
+            if device:
+                self.devices.update(device, name=new_name)
+        
+        # 更新设备列表显示
+        self.update_devices_listbox()
+        
+        # 更新聊天窗口中的名称
+        chat_info = self.active_chats.get(mac)
+        if chat_info:
+            chat_info['device'].name = new_name
+            
+            # 更新聊天窗口中的名称标签
+            if 'name_label' in chat_info:
+                chat_info['name_label'].config(text=new_name)
+            else:
+                # 如果找不到标签引用，重新创建聊天界面
+                if self.current_chat_device and self.current_chat_device.mac == mac:
+                    self.create_chat_interface(self.current_chat_device)
+        
+        # 如果正在聊天，刷新聊天窗口
+        if self.current_chat_device and self.current_chat_device.mac == mac:
+            self.current_chat_device.name = new_name
+            self.create_chat_interface(self.current_chat_device)
+    
+    def broadcast_device_info(self, query=False):
+        """立即广播设备信息（网络线程），query为True时请求其他设备单播回复"""
+        self.send_device_info('<broadcast>', query)
+    
+    def send_device_info(self, ip, query=False):
+        """向指定地址发送设备信息，名称或IP变化时递增版本号（网络线程）"""
+        fields = (self.local_device.ip, self.local_device.name)
+        if fields != self.beacon_fields:
+            self.beacon_fields = fields
+            self.beacon_version += 1
+        device_info = {
+            'ip': self.local_device.ip,
+            'mac': self.local_device.mac,
+            'name': self.local_device.name,
+            'timestamp': self.local_device.timestamp,
+            'version': self.beacon_version,
+            'interval': self.beacon_interval
+        }
+        if query:
+            device_info['query'] = True
+        
+        try:
+            self.udp_transport.sendto(
+                json.dumps(device_info).encode('utf-8'),
+                (ip, BROADCAST_PORT)
+            )
+        except Exception as e:
+            print(f"广播错误: {e}")
+    
+    def discovery_interval(self):
+        """按在线设备数计算广播间隔，使全网广播总速率约为DISCOVERY_TARGET_RATE"""
+        with self.devices_lock:
+            count = len(self.devices) + 1
+        return min(DISCOVERY_MAX_INTERVAL, max(DISCOVERY_INTERVAL, count / DISCOVERY_TARGET_RATE))
+    
+    async def discovery_loop(self):
+        # 启动时先发送查询，在线设备单播回复，无需等待各自的周期广播
+        query = True
+        while self.running:
+            # 广播设备信息，间隔随设备数调整并加入随机抖动
+            self.beacon_interval = self.discovery_interval()
+            self.broadcast_device_info(query)
+            query = False
+            await asyncio.sleep(self.beacon_interval * random.uniform(1 - DISCOVERY_JITTER, 1 + DISCOVERY_JITTER))
+    
+    def schedule_timer(self, key, delay):
+        """安排定时任务，键相同时覆盖之前的安排（网络线程）"""
+        deadline = time.monotonic() + delay
+        next_deadline = self.timers.next_deadline()
+        self.timers.schedule(key, deadline)
+        if next_deadline is None or deadline < next_deadline:
+            self.timer_wakeup.set()
+    
+    def watch_device(self, device):
+        """开始或继续检查设备是否离线（网络线程）"""
+        if ('offline', device) not in self.timers.deadlines:
+            self.schedule_timer(('offline', device), device.offline_timeout())
+    
+    def attach_connection(self, device, conn):
+        """保存设备连接并开始定时发送心跳（网络线程）"""
+        device.connection = conn
+        self.schedule_timer(('heartbeat', device), HEARTBEAT_INTERVAL)
+        self.watch_device(device)
+    
+    async def timer_loop(self):
+        """等待最早的截止时间并执行到期的定时任务，开销只与到期的事件数有关"""
+        while self.running:
+            removed = False
+            for kind, device in self.timers.pop_due(time.monotonic()):
+                try:
+                    if kind == 'offline':
+                        removed = self.check_device_offline(device) or removed
+                    elif kind == 'heartbeat':
+                        self.send_heartbeat(device)
+                    elif kind == 'stats':
+                        self.loop.run_in_executor(None, self.write_stats)
+                        self.schedule_timer(('stats', None), STATS_WRITE_INTERVAL)
+                except Exception as e:
+                    print(f"定时任务错误: {e}")
+            if removed:
+                self.call_in_ui(self.update_devices_listbox)
+            
+            next_deadline = self.timers.next_deadline()
+            self.timer_wakeup.clear()
+            timeout = None if next_deadline is None else max(0, next_deadline - time.monotonic())
+            try:
+                await asyncio.wait_for(self.timer_wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+    
+    def check_device_offline(self, device):
+        """离线检查到期：期间收到过广播或仍有连接时按最新时间重新安排，否则移除设备，返回是否已移除"""
+        with self.devices_lock:
+            if self.devices.get(device.mac) is not device:
+                return False
+            # 仍有连接的设备由心跳判断，不因广播中断而移除
+            if device.check_online() or device.connection:
+                remaining = device.timestamp + device.offline_timeout() - time.time()
+                self.schedule_timer(('offline', device), remaining if remaining > 0 else device.offline_timeout())
+                return False
+            self.devices.remove(device.mac)
+        return True
+    
+    def send_heartbeat(self, device):
+        """心跳到期：最近一个间隔内没有发送过数据时发送心跳，只写入发送缓冲区
+        对方支持时心跳携带发送时间，传输过程中也照常发送，用于持续测量往返时延"""
+        conn = device.connection
+        if not conn:
+            return
+        idle = time.monotonic() - conn.last_sent
+        if idle < HEARTBEAT_INTERVAL and conn.version < 8:
+            self.schedule_timer(('heartbeat', device), HEARTBEAT_INTERVAL - idle)
+            return
+        try:
+            if conn.version >= 8:
+                conn.send_frame(FRAME_HEARTBEAT, HEARTBEAT_STAMP.pack(time.monotonic()))
+            else:
+                conn.send_frame(FRAME_HEARTBEAT)
+            self.schedule_timer(('heartbeat', device), HEARTBEAT_INTERVAL)
+        except:
+            if device.connection is conn:
+                device.connection = None
+            conn.close()
+    
+    def update_devices_listbox(self):
+        """请求刷新设备列表，同一轮事件处理中的多次请求合并为一次（界面线程）"""
+        if not self.devices_refresh_pending:
+            self.devices_refresh_pending = True
+            self.root.after_idle(self.refresh_devices_tree)
+    
+    def refresh_devices_tree(self):
+        """按MAC增量更新设备列表：只插入、修改、删除有变化的行"""
+        self.devices_refresh_pending = False
+        
+        # 获取搜索关键词
+        search_term = self.search_var.get().lower()
+        
+        rows = {}
+        with self.devices_lock:
+            # 按名称排序设备
+            for device in sorted(self.devices.values(), key=lambda d: d.name):
+                # 过滤搜索结果
+                if search_term and search_term not in device.name.lower():
+                    continue
+                
+                # 创建显示文本（同名设备附带IP区分，包含未读消息计数）
+                display_text = device.name
+                if len(self.devices.find_by_name(device.name)) > 1:
+                    display_text += f" [{device.ip}]"
+                if device.unread_messages > 0:
+                    display_text += f" ({device.unread_messages})"
+                
+                # 设置字体样式
+                if device.unread_messages > 0:
+                    tag = "unread"
+                elif not device.is_online:
+                    tag = "offline"
+                else:
+                    tag = "online"
+                rows[device.mac] = (display_text, tag)
+        
+        # 删除已离线或被过滤的设备
+        for mac in [mac for mac in self.device_rows if mac not in rows]:
+            self.devices_tree.delete(mac)
+            del self.device_rows[mac]
+        
+        # 插入新设备（追加到末尾），更新有变化的行
+        current_order = [mac for mac in self.device_order if mac in rows]
+        for mac, row in rows.items():
+            old_row = self.device_rows.get(mac)
+            if old_row is None:
+                self.devices_tree.insert("", END, iid=mac, values=[row[0]], tags=[row[1]])
+                current_order.append(mac)
+            elif old_row != row:
+                self.devices_tree.item(mac, values=[row[0]], tags=[row[1]])
+            self.device_rows[mac] = row
+        
+        # 顺序变化时（新设备或改名）才调整位置
+        order = list(rows)
+        if order != current_order:
+            for index, mac in enumerate(order):
+                if current_order[index] != mac:
+                    self.devices_tree.move(mac, "", index)
+                    current_order.remove(mac)
+                    current_order.insert(index, mac)
+        self.device_order = order
+    
+    def on_device_select(self, event):
+        # 获取选中的设备，行ID即设备MAC
+        selection = self.devices_tree.selection()
+        if not selection:
+            return
+        
+        with self.devices_lock:
+            device = self.devices.get(selection[0])
+        
+        if not device:
+            return
+            
+        # 尝试连接到设备（如果尚未连接），连接在网络线程中异步完成
+        self.run_in_network(self.connect_to_device(device))
+        
+        # 设置当前聊天设备
+        self.current_chat_device = device
+        
+        # 创建聊天界面
+        self.create_chat_interface(device)
+    
+    def send_message(self, device, input_entry):
+        message = input_entry.get().strip()
+        if not message:
+            return
+            
+        input_entry.delete(0, END)
+        
+        # 保存消息到本地
+        self.save_message(device, message, sent=True)
+        
+        # 更新聊天窗口
+        if device.mac in self.active_chats:
+            chat = self.active_chats[device.mac]
+            self.append_message(chat["text_widget"], 
+                              f"我 ({datetime.datetime.now().strftime('%H:%M:%S')}): {message}")
+        
+        # 发送消息
+        self.call_in_network(self.send_to_device, device, {
+            'type': 'text',
+            'content': message
+        })
+    
+    def receive_message(self, device, message):
+        # 保存消息
+        self.save_message(device, message, sent=False)
+        
+        # 更新聊天窗口
+        if device.mac in self.active_chats and self.current_chat_device == device:
+            chat = self.active_chats[device.mac]
+            self.append_message(chat["text_widget"], 
+                              f"{device.name} ({datetime.datetime.now().strftime('%H:%M:%S')}): {message}")
+        else:
+            # 增加未读消息计数
+            with self.devices_lock:
+                device.unread_messages += 1
+            self.update_devices_listbox()
+    
+    def send_file(self, device):
+        filepaths = filedialog.askopenfilenames(title="选择要发送的文件")
+        if not filepaths:
+            return
+        if len(filepaths) > 1:
+            self.send_batch(device, list(filepaths))
+            return
+        filepath = filepaths[0]
+            
+        filename = os.path.basename(filepath)
+        
+        try:
+            file_size = os.path.getsize(filepath)
+        except Exception as e:
+            error_msg = f"读取文件失败: {e}"
+            print(error_msg)
+            messagebox.showerror("错误", error_msg)
+            return
+        
+        # 更新聊天窗口
+        if device.mac in self.active_chats:
+            chat = self.active_chats[device.mac]
+            self.append_message(chat["text_widget"], 
+                              f"我 ({datetime.datetime.now().strftime('%H:%M:%S')}): 发送文件 '{filename}'")
+        
+        # 在网络线程中流式发送，避免阻塞界面
+        self.run_in_network(self.send_file_task(device, filepath, file_size))
+    
+    def send_folder(self, device):
+        folder = filedialog.askdirectory(title="选择要发送的文件夹")
+        if folder:
+            self.send_batch(device, [folder])
+    
+    def send_batch(self, device, paths):
+        """把多个文件或整个文件夹作为一批发送"""
+        names = "、".join(os.path.basename(os.path.abspath(path)) for path in paths[:3])
+        if len(paths) > 3:
+            names += f" 等 {len(paths)} 项"
+        if device.mac in self.active_chats:
+            chat = self.active_chats[device.mac]
+            self.append_message(chat["text_widget"], 
+                              f"我 ({datetime.datetime.now().strftime('%H:%M:%S')}): 发送 '{names}'")
+        
+        self.run_in_network(self.send_batch_task(device, paths, names))
+    
+    def append_chat_notice(self, device, text):
+        """在设备的聊天窗口中追加一行提示（界面线程）"""
+        if device.mac in self.active_chats:
+            chat = self.active_chats[device.mac]
+            self.append_message(chat["text_widget"], text)
+    
+    async def send_file_task(self, device, filepath, file_size, resume=False):
+        """从磁盘分块读取文件并发送，只发送对方缺少的数据块，内存占用与文件大小无关，
+        返回是否发送成功（网络线程）"""
+        filename = os.path.basename(filepath)
+        
+        digest = ''
+        pinned = []
+        try:
+            # 在线程池中把文件加入内容存储，同时得到对方查重用的哈希；续传时只计算哈希。
+            # 对方确认收齐后才建立本地副本并记录为已发送
+            if resume:
+                digest = await self.loop.run_in_executor(None, self.blobs.cached_hash, filepath)
+            else:
+                digest = await self.loop.run_in_executor(None, functools.partial(self.blobs.add_file, filepath, pin=True))
+                pinned.append(digest)
+        except Exception as e:
+            print(f"保存文件副本失败: {e}")
+        
+        conn = None
+        transfer_id = None
+        try:
+            file_id = make_file_id(filepath)
+            if os.path.getsize(filepath) != file_size:
+                raise Exception("文件在发送前已被修改")
+            # 先登记为未完成发送，连接中断后对方重新上线时继续
+            self.add_pending_send(device, file_id, filepath)
+            
+            conn = device.connection
+            if not conn:
+                return False
+            
+            metadata = {
+                'type': 'file_metadata',
+                'filename': filename,
+                'size': file_size,
+                'file_id': file_id,
+                'chunk_size': FILE_CHUNK_SIZE,
+                'sha256': digest
+            }
+            count = chunk_count(file_size, FILE_CHUNK_SIZE)
+            compressor = ChunkCompressor(conn.version >= 5)
+            compressor.start_file(filename)
+            start_time = time.time()
+            transfer_id = self.metrics.start(device.name, filename, 'send', file_size)
+            
+            for round_no in range(FILE_SEND_ROUNDS):
+                # 每轮使用一个新的发送流，先发送文件元数据，对方回复已收到的数据块
+                async with conn.open_stream() as stream:
+                    await self.wait_file_reply(stream, metadata, transfer_id)
+                    if conn.version >= 2:
+                        chunks = missing_chunks(stream.resume_received, count)
+                    else:
+                        chunks = range(count)
+                    if round_no == 0 and count and not chunks and conn.version >= 3:
+                        self.call_in_ui(self.append_chat_notice, device, f"对方已有文件 '{filename}'，无需重新传输")
+                    
+                    # 在线程池中读取数据块、计算校验并按需压缩，发送队列满或流量额度用完时等待
+                    with open(filepath, 'rb') as f:
+                        for index in chunks:
+                            if conn.version >= 2:
+                                frame_type, payload = await self.loop.run_in_executor(
+                                    None, self.read_file_chunk, f, index, file_size, compressor)
+                                await stream.send_bulk(frame_type, payload)
+                                self.metrics.progress(transfer_id, min(FILE_CHUNK_SIZE, file_size - index * FILE_CHUNK_SIZE),
+                                                      len(payload))
+                            else:
+                                payload = await self.loop.run_in_executor(None, f.read, FILE_CHUNK_SIZE)
+                                if len(payload) != min(FILE_CHUNK_SIZE, file_size - index * FILE_CHUNK_SIZE):
+                                    raise Exception("文件在发送过程中被修改")
+                                compressor.raw_bytes += len(payload)
+                                compressor.wire_bytes += len(payload)
+                                await stream.send_bulk(FRAME_FILE_DATA, payload)
+                                self.metrics.progress(transfer_id, len(payload))
+                    
+                    # 发送结束标志，新版本对方校验后回复最终位图
+                    if conn.version < 2:
+                        await stream.send_message_after_bulk({'type': 'file_end'})
+                        break
+                    stream.ready_event.clear()
+                    await stream.send_message_after_bulk({'type': 'file_end'})
+                    try:
+                        await asyncio.wait_for(stream.wait_ready(), FILE_IDLE_TIMEOUT)
+                    except asyncio.TimeoutError:
+                        raise Exception("等待接收方确认超时")
+                    if not missing_chunks(stream.resume_received, count):
+                        break
+                print(f"部分数据块校验失败，补发第 {round_no + 1}/{FILE_SEND_ROUNDS - 1} 轮")
+                self.metrics.retry(transfer_id)
+            else:
+                raise Exception("多次补发后数据仍不完整")
+            
+            self.remove_pending_send(device, file_id)
+            self.metrics.finish(transfer_id)
+            try:
+                await self.loop.run_in_executor(None, self.save_file_copy, device, filepath, True)
+            except Exception as e:
+                print(f"保存文件记录失败: {e}")
+            
+            # 更新聊天窗口，显示发送成功和传输统计
+            stats = format_transfer_stats(compressor.raw_bytes, compressor.wire_bytes, time.time() - start_time)
+            self.call_in_ui(self.append_chat_notice, device, f"文件 '{filename}' 发送成功，{stats}")
+            return True
+                
+        except Exception as e:
+            # 连接中断时保留未完成记录等待续传，其他错误不再重试
+            if conn and (conn.closed or isinstance(e, ConnectionError)):
+                error_msg = f"连接中断，对方重新上线后将继续发送: {e}"
+            else:
+                error_msg = f"无法发送文件: {e}"
+                self.remove_pending_send(device, None, filepath)
+                self.call_in_ui(messagebox.showerror, "发送失败", error_msg)
+            print(error_msg)
+            self.metrics.finish(transfer_id, error_msg)
+            
+            # 更新聊天窗口，显示发送失败
+            self.call_in_ui(self.append_chat_notice, device, f"文件 '{filename}' 发送失败: {error_msg}")
+            return False
+        finally:
+            self.blobs.unpin(pinned)
+    
+    async def send_batch_task(self, device, paths, names, resume=False):
+        """批量发送：一次发送清单，对方回复已有的文件后，所有缺少的文件数据连续发送（网络线程）"""
+        conn = None
+        transfer_id = None
+        pinned = []
+        try:
+            # 在线程池中展开文件夹并把文件加入内容存储，得到清单中各文件的哈希；续传时只计算哈希。
+            # 对方确认收齐后才建立本地副本并记录为已发送
+            entries = await self.loop.run_in_executor(None, self.prepare_batch, paths, not resume)
+            if not resume:
+                pinned = [entry[3] for entry in entries]
+            if not entries:
+                raise Exception("没有可发送的文件")
+            batch_id = make_batch_id(entries)
+            self.add_pending_send(device, batch_id, paths)
+            
+            conn = device.connection
+            if not conn:
+                return
+            
+            if conn.version < 4:
+                # 对方不支持批量发送时逐个发送，批量记录换成发送失败的各个文件的记录，下次连接时只重发这些文件
+                failed = []
+                for relpath, path, size, digest in entries:
+                    if not await self.send_file_task(device, path, size, resume=True):
+                        failed.append(path)
+                for path in failed:
+                    try:
+                        self.add_pending_send(device, make_file_id(path), path)
+                    except OSError:
+                        pass
+                self.remove_pending_send(device, batch_id)
+                if failed:
+                    self.call_in_ui(self.append_chat_notice, device,
+                                    f"'{names}' 共 {len(entries)} 个文件，其中 {len(failed)} 个发送失败，下次连接时重新发送")
+                return
+            
+            message = {
+                'type': 'batch_manifest',
+                'batch_id': batch_id,
+                'name': names,
+                'manifest': json.dumps([[relpath, size, digest] for relpath, path, size, digest in entries],
+                                       ensure_ascii=False)
+            }
+            sent_files = 0
+            compressor = ChunkCompressor(conn.version >= 5)
+            start_time = time.time()
+            transfer_id = self.metrics.start(device.name, names, 'send', sum(entry[2] for entry in entries))
+            for round_no in range(FILE_SEND_ROUNDS):
+                async with conn.open_stream() as stream:
+                    await self.wait_file_reply(stream, message, transfer_id)
+                    for file_no in missing_chunks(stream.resume_received, len(entries)):
+                        relpath, path, size, digest = entries[file_no]
+                        compressor.start_file(relpath)
+                        with open(path, 'rb') as f:
+                            for index in range(chunk_count(size, FILE_CHUNK_SIZE)):
+                                frame_type, payload = await self.loop.run_in_executor(
+                                    None, self.read_file_chunk, f, index, size, compressor, file_no)
+                                await stream.send_bulk(frame_type, payload)
+                                self.metrics.progress(transfer_id, min(FILE_CHUNK_SIZE, size - index * FILE_CHUNK_SIZE),
+                                                      len(payload))
+                        sent_files += 1
+                    
+                    # 发送结束标志，对方回复最终收到的文件
+                    stream.ready_event.clear()
+                    await stream.send_message_after_bulk({'type': 'batch_end', 'batch_id': batch_id})
+                    try:
+                        await asyncio.wait_for(stream.wait_ready(), FILE_IDLE_TIMEOUT)
+                    except asyncio.TimeoutError:
+                        raise Exception("等待接收方确认超时")
+                    if not missing_chunks(stream.resume_received, len(entries)):
+                        break
+                print(f"部分文件校验失败，补发第 {round_no + 1}/{FILE_SEND_ROUNDS - 1} 轮")
+                self.metrics.retry(transfer_id)
+            else:
+                raise Exception("多次补发后数据仍不完整")
+            
+            self.remove_pending_send(device, batch_id)
+            self.metrics.finish(transfer_id)
+            try:
+                await self.loop.run_in_executor(None, self.save_sent_batch, device, entries)
+            except Exception as e:
+                print(f"保存文件记录失败: {e}")
+            skipped = f"，其中 {len(entries) - sent_files} 个对方已有" if sent_files < len(entries) else ""
+            stats = format_transfer_stats(compressor.raw_bytes, compressor.wire_bytes, time.time() - start_time)
+            self.call_in_ui(self.append_chat_notice, device,
+                            f"'{names}' 共 {len(entries)} 个文件发送成功{skipped}，{stats}")
+                
+        except Exception as e:
+            # 连接中断时保留未完成记录等待续传，其他错误不再重试
+            if conn and (conn.closed or isinstance(e, ConnectionError)):
+                error_msg = f"连接中断，对方重新上线后将继续发送: {e}"
+            else:
+                error_msg = f"无法发送文件: {e}"
+                self.remove_pending_send(device, None, paths)
+                self.call_in_ui(messagebox.showerror, "发送失败", error_msg)
+            print(error_msg)
+            self.metrics.finish(transfer_id, error_msg)
+            self.call_in_ui(self.append_chat_notice, device, f"'{names}' 发送失败: {error_msg}")
+        finally:
+            self.blobs.unpin(pinned)
+    
+    def find_batch_blobs(self, files_dir, entries):
+        """返回清单中本地已有内容的文件位图，缺少的空文件直接放入存储（线程池）"""
+        received = bytearray((len(entries) + 7) // 8)
+        for file_no, (relpath, size, digest) in enumerate(entries):
+            if size == 0 and not self.blobs.has(digest):
+                empty_path = os.path.join(files_dir, f".{uuid.uuid4().hex}.part")
+                open(empty_path, 'wb').close()
+                self.blobs.store(empty_path, self.blobs.hash_file(empty_path))
+            if self.blobs.has(digest):
+                received[file_no >> 3] |= 1 << (file_no & 7)
+        return received
+    
+    def prepare_batch(self, paths, store):
+        """展开清单并计算各文件哈希，store为真时同时把文件加入内容存储，
+        这些内容受保护直到调用方unpin（线程池）"""
+        entries = []
+        try:
+            for relpath, path, size in build_manifest(paths):
+                digest = self.blobs.add_file(path, pin=True) if store else self.blobs.cached_hash(path)
+                entries.append((relpath, path, size, digest))
+        except:
+            if store:
+                self.blobs.unpin([entry[3] for entry in entries])
+            raise
+        return entries
+    
+    def save_sent_batch(self, device, entries):
+        """对方确认收齐后为发送的文件建立本地副本并记录（线程池）"""
+        digests = []
+        try:
+            for relpath, path, size, digest in entries:
+                digests.append(self.blobs.add_file(path, pin=True))
+            self.save_batch_files(device, [(entry[0], digest) for entry, digest in zip(entries, digests)], True)
+        finally:
+            self.blobs.unpin(digests)
+    
+    def save_batch_files(self, device, items, sent):
+        """按顶层项目在Files目录中建立硬链接并各记录一条，返回 [(名称, 路径), ...]"""
+        groups = collections.OrderedDict()
+        for relpath, digest in items:
+            groups.setdefault(relpath.split('/')[0], []).append((relpath, digest))
+        
+        files_dir = self.prepare_files_dir(device)
+        results = []
+        for top, group in groups.items():
+            if len(group) == 1 and group[0][0] == top:
+                filename, filepath = self.link_blob_file(device, group[0][1], top)
+                self.record_file_transfer(device, filename, filepath, sent, group[0][1])
+            else:
+                while True:
+                    filename, filepath = self.unique_file_path(files_dir, top)
+                    try:
+                        # 创建目录占住名称，同时保存的另一批文件会选择其他名称
+                        os.mkdir(filepath)
+                        break
+                    except FileExistsError:
+                        continue
+                for relpath, digest in group:
+                    target = os.path.join(filepath, *relpath.split('/')[1:])
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                    self.blobs.link(digest, target)
+                self.record_file_transfer(device, filename, filepath, sent)
+            results.append((filename, filepath))
+        return results
+    
+    async def wait_file_reply(self, stream, metadata, transfer_id=None):
+        """在发送流上发送文件元数据并等待对方回复READY或续传位图，超时后重发并计入重试次数（网络线程）"""
+        stream.ready_event.clear()
+        stream.resume_received = b''
+        stream.send_message(metadata)
+        
+        retries = 3
+        timeout = 5  # 5秒超时
+        for attempt in range(retries):
+            try:
+                await asyncio.wait_for(stream.wait_ready(), timeout)
+                return
+            except asyncio.TimeoutError:
+                print(f"等待READY超时，尝试 {attempt + 1}/{retries}")
+                # 重新发送元数据
+                self.metrics.retry(transfer_id)
+                stream.send_message(metadata)
+        raise Exception("接收方未准备好或超时")
+    
+    def read_file_chunk(self, f, index, file_size, compressor, file_no=None):
+        """读取一个数据块并在前面加上（文件序号、）序号和SHA-256校验，按需压缩，返回 (帧类型, 负载)（线程池）"""
+        header = CHUNK_HEADER if file_no is None else BATCH_CHUNK_HEADER
+        offset = index * FILE_CHUNK_SIZE
+        length = min(FILE_CHUNK_SIZE, file_size - offset)
+        payload = bytearray(header.size + length)
+        view = memoryview(payload)
+        f.seek(offset)
+        if f.readinto(view[header.size:]) != length:
+            raise Exception("文件在发送过程中被修改")
+        digest = hashlib.sha256(view[header.size:]).digest()
+        if file_no is None:
+            header.pack_into(payload, 0, index, digest)
+            return compressor.pack(FRAME_FILE_CHUNK, payload)
+        header.pack_into(payload, 0, file_no, index, digest)
+        return compressor.pack(FRAME_BATCH_CHUNK, payload)
+    
+    def load_pending_sends(self):
+        """读取未完成的文件发送：mac -> {file_id: 文件路径}"""
+        try:
+            with open(self.pending_sends_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except:
+            return {}
+    
+    def save_pending_sends(self):
+        try:
+            tmp_path = self.pending_sends_path + ".tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.pending_sends, f, ensure_ascii=False)
+            os.replace(tmp_path, self.pending_sends_path)
+        except Exception as e:
+            print(f"保存未完成发送记录失败: {e}")
+    
+    def write_stats(self):
+        """写出传输和时延统计文件（线程池）"""
+        try:
+            self.metrics.write(self.stats_path)
+        except Exception as e:
+            print(f"保存统计文件失败: {e}")
+    
+    def add_pending_send(self, device, file_id, filepath):
+        pending = self.pending_sends.setdefault(device.mac, {})
+        if pending.get(file_id) != filepath:
+            pending[file_id] = filepath
+            self.save_pending_sends()
+    
+    def remove_pending_send(self, device, file_id, filepath=None):
+        """按文件ID或路径删除未完成发送记录"""
+        pending = self.pending_sends.get(device.mac, {})
+        keys = [key for key, path in pending.items() if key == file_id or path == filepath]
+        for key in keys:
+            del pending[key]
+        if not pending:
+            self.pending_sends.pop(device.mac, None)
+        if keys:
+            self.save_pending_sends()
+    
+    def resume_pending_sends(self, device):
+        """对方重新连接后依次继续未完成的发送（网络线程）"""
+        pending = list(self.pending_sends.get(device.mac, {}).values())
+        if not pending:
+            return
+        
+        async def resume_all():
+            for filepath in pending:
+                if isinstance(filepath, list):
+                    names = "、".join(os.path.basename(path) for path in filepath)
+                    self.call_in_ui(self.append_chat_notice, device, f"继续发送 '{names}'")
+                    await self.send_batch_task(device, filepath, names, resume=True)
+                    continue
+                try:
+                    file_size = os.path.getsize(filepath)
+                except OSError:
+                    # 原文件已不存在，放弃续传
+                    self.remove_pending_send(device, None, filepath)
+                    continue
+                self.call_in_ui(self.append_chat_notice, device,
+                                f"继续发送文件 '{os.path.basename(filepath)}'")
+                await self.send_file_task(device, filepath, file_size, resume=True)
+        
+        self.loop.create_task(resume_all())
+    
+    async def handle_file_reception(self, stream, device, metadata):
+        """处理文件接收：从接收流读取数据块，校验后按位置写入临时文件，断点状态持久化，收齐后原子重命名（网络线程）"""
+        conn = stream.conn
+        part_path = None
+        state = None
+        transfer_id = None
+        try:
+            # 只保留文件名部分，防止对方构造路径
+            filename = os.path.basename(metadata['filename']) or "unnamed"
+            file_size = metadata['size']
+            file_id = metadata.get('file_id', '')
+            chunk_size = metadata.get('chunk_size') or FILE_CHUNK_SIZE
+            if conn.version >= 2 and not re.fullmatch(r'[0-9a-f]{32}', file_id):
+                raise Exception("文件ID不合法")
+            
+            count = chunk_count(file_size, chunk_size)
+            transfer_id = self.metrics.start(device.name, filename, 'receive', file_size)
+            if conn.version >= 3:
+                # 检查是否已有之前先保护该内容，建立硬链接前不会被后台清理删除
+                with self.blobs.pinned([metadata['sha256']]):
+                    if self.blobs.has(metadata['sha256']):
+                        await self.receive_known_blob(stream, device, filename, file_id, count, metadata['sha256'])
+                        self.metrics.finish(transfer_id)
+                        return
+            
+            files_dir = await self.loop.run_in_executor(None, self.prepare_files_dir, device)
+            if conn.version >= 2:
+                # 按文件ID读取上次中断时保存的状态，回复已收到的数据块
+                state = await self.loop.run_in_executor(
+                    None, self.load_partial_file, files_dir, file_id, file_size, chunk_size)
+                part_path = state['part_path']
+                stream.send_message({
+                    'type': 'file_resume',
+                    'file_id': file_id,
+                    'received': bytes(state['received'])
+                })
+            else:
+                part_path = os.path.join(files_dir, f".{uuid.uuid4().hex}.part")
+                with open(part_path, 'wb'):
+                    pass
+                conn.send_frame(FRAME_READY)
+            
+            # 接收文件内容，超过空闲超时时间没有收到数据才判定失败
+            received = state['received'] if state else bytearray((count + 7) // 8)
+            next_index = 0
+            last_save = time.monotonic()
+            with open(part_path, 'r+b') as f:
+                try:
+                    while True:
+                        try:
+                            frame = await asyncio.wait_for(stream.recv_frame(), FILE_IDLE_TIMEOUT)
+                        except asyncio.TimeoutError:
+                            raise Exception(f"文件接收超时，{FILE_IDLE_TIMEOUT}秒内未收到数据")
+                        if frame is None:
+                            raise Exception("连接中断")
+                        
+                        frame_type, payload = frame
+                        if frame_type == FRAME_FILE_CHUNK:
+                            index, digest = CHUNK_HEADER.unpack_from(payload)
+                            data = memoryview(payload)[CHUNK_HEADER.size:]
+                        elif frame_type == FRAME_FILE_DATA:
+                            index, digest, data = next_index, None, payload
+                            next_index += 1
+                        elif is_end_message(frame_type, payload, 'file_end'):
+                            break
+                        else:
+                            continue
+                        
+                        if index >= count or len(data) != min(chunk_size, file_size - index * chunk_size):
+                            print(f"丢弃无效数据块 {index}")
+                            continue
+                        if await self.loop.run_in_executor(None, self.write_file_chunk, f, index * chunk_size, data, digest):
+                            received[index >> 3] |= 1 << (index & 7)
+                            self.metrics.progress(transfer_id, len(data))
+                        else:
+                            print(f"数据块 {index} 校验失败，等待补发")
+                        
+                        if state and time.monotonic() - last_save >= RESUME_STATE_INTERVAL:
+                            await self.loop.run_in_executor(None, self.save_partial_state, f, state)
+                            last_save = time.monotonic()
+                finally:
+                    # 连接中断时也保存已收到的数据块，下次只需补发其余部分
+                    if state:
+                        await self.loop.run_in_executor(None, self.save_partial_state, f, state)
+            
+            # 检查文件完整性，新版本对方回复位图后补发缺失的数据块
+            missing = missing_chunks(received, count)
+            if missing and not state:
+                raise Exception(f"文件不完整，缺少 {len(missing)} 个数据块")
+            if not missing:
+                # 放入内容存储前校验整个文件的哈希，防止错误内容占用该哈希
+                file_digest = await self.loop.run_in_executor(None, self.blobs.hash_file, part_path)
+                if metadata.get('sha256') and file_digest != metadata['sha256']:
+                    if not state:
+                        raise Exception("文件校验失败")
+                    print("文件整体校验失败，重新接收全部数据")
+                    received[:] = bytes(len(received))
+                    await self.loop.run_in_executor(None, self.save_partial_state, None, state)
+                    missing = True
+            if state:
+                stream.send_message({
+                    'type': 'file_resume',
+                    'file_id': file_id,
+                    'received': bytes(received)
+                })
+                if missing:
+                    part_path = None
+                    self.metrics.finish(transfer_id, "部分数据块校验失败，等待补发")
+                    return
+            
+            # 移入内容存储后在Files目录中建立硬链接，期间该内容不会被后台清理删除
+            with self.blobs.pinned([file_digest]):
+                await self.loop.run_in_executor(None, self.blobs.store, part_path, file_digest)
+                part_path = None
+                if state:
+                    await self.loop.run_in_executor(None, self.remove_partial_state, state)
+                filename, filepath = await self.loop.run_in_executor(
+                    None, self.save_received_file, device, file_digest, filename)
+            self.metrics.finish(transfer_id)
+            
+            self.call_in_ui(self.on_file_received, device, filename, filepath)
+                
+        except Exception as e:
+            error_msg = f"文件接收错误: {e}"
+            print(error_msg)
+            self.metrics.finish(transfer_id, error_msg)
+            # 可续传的临时文件保留到下次连接，其余清理
+            if part_path and not state and os.path.exists(part_path):
+                try:
+                    os.remove(part_path)
+                except:
+                    pass
+            # 发送错误通知给发送方
+            try:
+                stream.send_message({
+                    'type': 'file_error',
+                    'message': error_msg
+                })
+            except:
+                pass
+    
+    async def receive_known_blob(self, stream, device, filename, file_id, count, digest):
+        """本地已有相同内容：回复全部已收到，等对方的结束标志后直接建立硬链接（网络线程）"""
+        received = b'\xff' * ((count + 7) // 8)
+        stream.send_message({'type': 'file_resume', 'file_id': file_id, 'received': received})
+        while True:
+            try:
+                frame = await asyncio.wait_for(stream.recv_frame(), FILE_IDLE_TIMEOUT)
+            except asyncio.TimeoutError:
+                raise Exception(f"文件接收超时，{FILE_IDLE_TIMEOUT}秒内未收到结束标志")
+            if frame is None:
+                raise Exception("连接中断")
+            if is_end_message(frame[0], frame[1], 'file_end'):
+                break
+        stream.send_message({'type': 'file_resume', 'file_id': file_id, 'received': received})
+        
+        filename, filepath = await self.loop.run_in_executor(None, self.save_received_file, device, digest, filename)
+        self.call_in_ui(self.on_file_received, device, filename, filepath)
+    
+    async def handle_batch_reception(self, stream, device, message):
+        """批量接收：回复已有的文件，之后从接收流连续读取各文件的数据块，每个文件收齐校验后放入内容存储（网络线程）"""
+        part_path = None
+        f = None
+        transfer_id = None
+        pinned = []
+        try:
+            batch_id = message['batch_id']
+            entries = json.loads(message['manifest'])
+            for relpath, size, digest in entries:
+                safe_relpath(relpath)
+                if not isinstance(size, int) or size < 0 or not re.fullmatch(r'[0-9a-f]{64}', digest):
+                    raise ValueError("清单格式错误")
+            # 已有和收齐的文件在全部建立硬链接之前不会被后台清理删除
+            pinned = [digest for relpath, size, digest in entries]
+            self.blobs.pin(pinned)
+            
+            # 本地已有相同内容的文件不需要再传，空文件直接创建
+            files_dir = await self.loop.run_in_executor(None, self.prepare_files_dir, device)
+            received = await self.loop.run_in_executor(None, self.find_batch_blobs, files_dir, entries)
+            stream.send_message({'type': 'batch_resume', 'batch_id': batch_id, 'received': bytes(received)})
+            transfer_id = self.metrics.start(device.name, message['name'], 'receive',
+                                             sum(entries[i][1] for i in missing_chunks(received, len(entries))))
+            
+            # 数据块按文件顺序连续到达，同一时间只打开一个临时文件；按顺序到达时边收边算整体哈希
+            current = None
+            while True:
+                try:
+                    frame = await asyncio.wait_for(stream.recv_frame(), FILE_IDLE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    raise Exception(f"文件接收超时，{FILE_IDLE_TIMEOUT}秒内未收到数据")
+                if frame is None:
+                    raise Exception("连接中断")
+                
+                frame_type, payload = frame
+                if frame_type != FRAME_BATCH_CHUNK:
+                    if is_end_message(frame_type, payload, 'batch_end'):
+                        break
+                    continue
+                file_no, index, chunk_digest = BATCH_CHUNK_HEADER.unpack_from(payload)
+                data = memoryview(payload)[BATCH_CHUNK_HEADER.size:]
+                if file_no >= len(entries):
+                    continue
+                relpath, size, digest = entries[file_no]
+                count = chunk_count(size, FILE_CHUNK_SIZE)
+                if index >= count or len(data) != min(FILE_CHUNK_SIZE, size - index * FILE_CHUNK_SIZE):
+                    print(f"丢弃无效数据块 {file_no}:{index}")
+                    continue
+                
+                if current is None or current['file_no'] != file_no:
+                    # 上一个文件未收齐则放弃，由发送方下一轮补发
+                    if f:
+                        f.close()
+                        os.remove(part_path)
+                    part_path = os.path.join(files_dir, f".{uuid.uuid4().hex}.part")
+                    f = open(part_path, 'wb')
+                    current = {'file_no': file_no, 'done': set(), 'hash': hashlib.sha256(), 'in_order': True}
+                
+                if not await self.loop.run_in_executor(None, self.write_file_chunk, f, index * FILE_CHUNK_SIZE, data, chunk_digest):
+                    print(f"数据块 {file_no}:{index} 校验失败，等待补发")
+                    continue
+                self.metrics.progress(transfer_id, len(data))
+                if current['in_order'] and index == len(current['done']):
+                    current['hash'].update(data)
+                else:
+                    current['in_order'] = False
+                current['done'].add(index)
+                
+                if len(current['done']) == count:
+                    f.close()
+                    f = None
+                    # 放入内容存储前校验整个文件的哈希
+                    if current['in_order']:
+                        file_digest = current['hash'].hexdigest()
+                    else:
+                        file_digest = await self.loop.run_in_executor(None, self.blobs.hash_file, part_path)
+                    if file_digest == digest:
+                        await self.loop.run_in_executor(None, self.blobs.store, part_path, digest)
+                        received[file_no >> 3] |= 1 << (file_no & 7)
+                    else:
+                        print(f"文件 '{relpath}' 整体校验失败，等待补发")
+                        os.remove(part_path)
+                    part_path = None
+                    current = None
+            
+            # 回复最终收到的文件，全部收齐后在Files目录中建立硬链接
+            stream.send_message({'type': 'batch_resume', 'batch_id': batch_id, 'received': bytes(received)})
+            if missing_chunks(received, len(entries)):
+                self.metrics.finish(transfer_id, "部分文件校验失败，等待补发")
+                return
+            results = await self.loop.run_in_executor(
+                None, self.save_batch_files, device, [(relpath, digest) for relpath, size, digest in entries], False)
+            self.metrics.finish(transfer_id)
+            for filename, filepath in results:
+                self.call_in_ui(self.on_file_received, device, filename, filepath)
+                
+        except Exception as e:
+            error_msg = f"批量接收错误: {e}"
+            print(error_msg)
+            self.metrics.finish(transfer_id, error_msg)
+            try:
+                stream.send_message({
+                    'type': 'file_error',
+                    'message': error_msg
+                })
+            except:
+                pass
+        finally:
+            self.blobs.unpin(pinned)
+            # 清理未收齐的临时文件，已收齐的文件已在内容存储中，下次不会重传
+            if f:
+                f.close()
+            if part_path and os.path.exists(part_path):
+                try:
+                    os.remove(part_path)
+                except:
+                    pass
+    
+    def load_partial_file(self, files_dir, file_id, file_size, chunk_size):
+        """读取或新建续传状态，临时文件预先设置为完整大小（线程池）"""
+        part_path = os.path.join(files_dir, f".{file_id}.part")
+        state_path = os.path.join(files_dir, f".{file_id}.json")
+        count = chunk_count(file_size, chunk_size)
+        received = None
+        try:
+            with open(state_path, 'r', encoding='utf-8') as f:
+                saved = json.load(f)
+            if (saved['size'] == file_size and saved['chunk_size'] == chunk_size
+                    and os.path.getsize(part_path) == file_size):
+                received = bytearray.fromhex(saved['received'])
+        except:
+            pass
+        if received is None or len(received) != (count + 7) // 8:
+            received = bytearray((count + 7) // 8)
+            with open(part_path, 'wb') as f:
+                f.truncate(file_size)
+        return {'part_path': part_path, 'state_path': state_path, 'size': file_size,
+                'chunk_size': chunk_size, 'received': received}
+    
+    def write_file_chunk(self, f, offset, data, digest):
+        """校验并写入一个数据块，校验失败返回False（线程池）"""
+        if digest is not None and hashlib.sha256(data).digest() != digest:
+            return False
+        f.seek(offset)
+        f.write(data)
+        return True
+    
+    def save_partial_state(self, f, state):
+        """先写出数据再原子更新续传状态，程序中断时状态中记录的数据块都已写入（线程池）"""
+        try:
+            if f:
+                f.flush()
+            tmp_path = state['state_path'] + ".tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as sf:
+                json.dump({'size': state['size'], 'chunk_size': state['chunk_size'],
+                           'received': state['received'].hex()}, sf)
+            os.replace(tmp_path, state['state_path'])
+        except Exception as e:
+            print(f"保存续传状态失败: {e}")
+    
+    def remove_partial_state(self, state):
+        try:
+            os.remove(state['state_path'])
+        except OSError:
+            pass
+    
+    def on_file_received(self, device, filename, filepath):
+        """文件接收完成后更新界面（界面线程）"""
+        # 更新聊天窗口
+        if device.mac in self.active_chats and self.current_chat_device == device:
+            chat = self.active_chats[device.mac]
+            self.append_message(chat["text_widget"], 
+                              f"{device.name} ({datetime.datetime.now().strftime('%H:%M:%S')}): 发送文件 '{filename}'")
+            
+            # 添加另存为按钮
+            save_frame = Frame(chat["text_widget"].master)
+            save_frame.pack(fill=X, padx=5, pady=2)
+            
+            ttk.Label(save_frame, text=f"收到文件: {filename}").pack(side=LEFT, padx=(0, 10))
+            ttk.Button(save_frame, text="另存为", 
+                      command=lambda: self.save_file_from_history(filepath, filename)).pack(side=LEFT)
+            
+            # 将小部件插入到文本区域
+            chat["text_widget"].window_create(END, window=save_frame)
+            chat["text_widget"].insert(END, "\n")
+            chat["text_widget"].see(END)
+        else:
+            # 增加未读消息计数
+            with self.devices_lock:
+                device.unread_messages += 1
+            self.update_devices_listbox()
+    
+    def save_message(self, device, message, sent):
+        # 创建消息记录
+        record = {
+            'timestamp': time.time(),
+            'sent': sent,
+            'content': message,
+            'sender_name': self.local_device.name if sent else device.name
+        }
+        
+        # 追加到设备的记录文件（使用MAC地址而不是名称作为目录名）并建立搜索索引
+        record_no = self.history.append(device, record)
+        self.search_index.add(device.get_safe_mac(), record_no, record)
+    
+    def prepare_files_dir(self, device):
+        """创建设备目录并更新设备信息，返回该设备的Files目录"""
+        self.history.update_device_info(device)
+        
+        # 创建文件目录
+        files_dir = os.path.join(self.data_dir, device.get_safe_mac(), "Files")
+        os.makedirs(files_dir, exist_ok=True)
+        return files_dir
+    
+    def unique_file_path(self, files_dir, filename):
+        """如果文件已存在，添加后缀；只列一次目录，不逐个探测文件名"""
+        filepath = os.path.join(files_dir, filename)
+        if not os.path.lexists(filepath):
+            return filename, filepath
+        existing = set(os.listdir(files_dir))
+        counter = 1
+        base, ext = os.path.splitext(filename)
+        while f"{base}_{counter}{ext}" in existing:
+            counter += 1
+        filename = f"{base}_{counter}{ext}"
+        return filename, os.path.join(files_dir, filename)
+    
+    def link_blob_file(self, device, digest, filename):
+        """在设备的Files目录中为存储内容建立硬链接；每条记录使用各自的链接，
+        同名同内容的文件也另加后缀，清理旧记录时不会删掉新记录引用的文件"""
+        files_dir = self.prepare_files_dir(device)
+        while True:
+            name, filepath = self.unique_file_path(files_dir, filename)
+            try:
+                self.blobs.link(digest, filepath)
+                return name, filepath
+            except FileExistsError:
+                # 选出名称后被同时保存的其他文件占用，重新选择
+                continue
+    
+    def save_received_file(self, device, digest, filename):
+        """为收到的内容在Files目录中建立硬链接并记录，返回 (名称, 路径)（线程池）"""
+        filename, filepath = self.link_blob_file(device, digest, filename)
+        self.record_file_transfer(device, filename, filepath, False, digest)
+        return filename, filepath
+    
+    def record_file_transfer(self, device, filename, filepath, sent, digest=None):
+        """记录文件传输到消息记录"""
+        record = {
+            'timestamp': time.time(),
+            'sent': sent,
+            'filename': filename,
+            'filepath': filepath,
+            'sender_name': self.local_device.name if sent else device.name
+        }
+        if digest:
+            record['sha256'] = digest
+        
+        # 添加到消息记录
+        record_no = self.history.append(device, record)
+        self.search_index.add(device.get_safe_mac(), record_no, record)
+    
+    def save_file_copy(self, device, src_path, sent):
+        """把本地文件加入内容存储并记录，同一内容只保存一份，返回sha256"""
+        digest = self.blobs.add_file(src_path, pin=True)
+        try:
+            filename, filepath = self.link_blob_file(device, digest, os.path.basename(src_path))
+        finally:
+            self.blobs.unpin([digest])
+        self.record_file_transfer(device, filename, filepath, sent, digest)
+        return digest
+    
+    def load_history_messages(self, device, text_widget):
+        """清空聊天窗口并只加载最近一页记录，打开速度与历史长度无关"""
+        safe_mac = device.get_safe_mac()
+        count = self.history.count(safe_mac)
+        start = max(0, count - HISTORY_PAGE_SIZE)
+        records = self.history.read_range(safe_mac, start, count)
+        
+        chat = self.active_chats.get(device.mac)
+        if chat and chat["text_widget"] is text_widget:
+            chat["history_start"] = start
+        
+        # 清空当前显示
+        text_widget.config(state=NORMAL)
+        text_widget.delete(1.0, END)
+        text_widget.mark_set("history_insert", END)
+        
+        self.insert_history_records(text_widget, records)
+                
+        text_widget.see(END)
+        text_widget.config(state="disabled")
+    
+    def load_older_history(self, device, text_widget):
+        """在聊天窗口顶部插入更早的一页记录，并保持当前可见位置不变"""
+        chat = self.active_chats.get(device.mac)
+        if not chat or chat["text_widget"] is not text_widget or not text_widget.winfo_exists():
+            return
+        end = chat["history_start"]
+        if end <= 0:
+            return
+        start = max(0, end - HISTORY_PAGE_SIZE)
+        chat["history_start"] = start
+        records = self.history.read_range(device.get_safe_mac(), start, end)
+        
+        text_widget.config(state=NORMAL)
+        # 右重力标记会随插入内容后移，使本页记录按顺序插入到顶部
+        text_widget.mark_set("history_insert", "1.0")
+        text_widget.mark_gravity("history_insert", RIGHT)
+        self.insert_history_records(text_widget, records)
+        # 让原来的第一行仍然显示在顶部
+        text_widget.yview("history_insert")
+        text_widget.config(state="disabled")
+    
+    def insert_history_records(self, text_widget, records):
+        """在history_insert标记处按顺序插入记录"""
+        for record in records:
+            try:
+                timestamp = datetime.datetime.fromtimestamp(record['timestamp']).strftime('%Y-%m-%d %H:%M:%S')
+                sender_name = record.get('sender_name', '未知')
+                
+                if 'content' in record:
+                    # 文本消息
+                    text_widget.insert("history_insert", f"{sender_name} ({timestamp}): {record['content']}\n")
+                elif 'filename' in record:
+                    # 文件消息
+                    text_widget.insert("history_insert", f"{sender_name} ({timestamp}): 发送文件 '{record['filename']}'\n")
+                    
+                    if not record['sent']:
+                        # 添加另存为按钮，只为已加载的页面创建控件
+                        save_frame = Frame(text_widget.master)
+                        ttk.Label(save_frame, text=f"收到文件: {record['filename']}").pack(side=LEFT, padx=(0, 10))
+                        ttk.Button(save_frame, text="另存为", 
+                                  command=lambda f=record['filepath'], n=record['filename']: self.save_file_from_history(f, n)).pack(side=LEFT)
+                        
+                        text_widget.window_create("history_insert", window=save_frame)
+                        text_widget.insert("history_insert", "\n")
+            except:
+                pass
+    
+    def save_file_from_history(self, filepath, filename):
+        if not os.path.exists(filepath):
+            messagebox.showerror("错误", "文件不存在或已被删除")
+            return
+            
+        save_path = filedialog.asksaveasfilename(
+            title="保存文件",
+            initialfile=filename
+        )
+        
+        if save_path:
+            try:
+                if os.path.isdir(filepath):
+                    shutil.copytree(filepath, save_path)
+                else:
+                    shutil.copyfile(filepath, save_path)
+                messagebox.showinfo("成功", "文件保存成功")
+            except Exception as e:
+                messagebox.showerror("错误", f"保存文件失败: {e}")
+    
+    def append_message(self, text_widget, message):
+        text_widget.config(state=NORMAL)
+        text_widget.insert(END, message + "\n")
+        text_widget.config(state="disabled")
+        text_widget.see(END)
+    
+    def manage_records(self):
+        # 创建记录管理窗口
+        manage_win = Toplevel(self.root)
+        manage_win.title("管理聊天记录")
+        manage_win.geometry("400x380")
+        
+        # 时间选项
+        ttk.Label(manage_win, text="删除超过以下时间的记录:").pack(pady=(10, 5))
+        
+        time_options = [
+            ("7天之前", 7),
+            ("14天之前", 14),
+            ("30天之前", 30),
+            ("60天之前", 60),
+            ("180天之前", 180),
+            ("所有记录", -1)
+        ]
+        
+        policy_days = self.load_retention_policy()
+        selected_time = IntVar(value=policy_days or 7)
+        
+        for text, days in time_options:
+            ttk.Radiobutton(manage_win, text=text, variable=selected_time, value=days).pack(anchor=W, padx=20)
+        
+        # 自动清理策略
+        auto_var = BooleanVar(value=policy_days > 0)
+        ttk.Checkbutton(manage_win, text="自动定期删除超过所选时间的记录", 
+                       variable=auto_var).pack(anchor=W, padx=20, pady=(15, 0))
+        
+        def apply_policy():
+            days = selected_time.get()
+            if auto_var.get() and days == -1:
+                messagebox.showerror("错误", "自动清理不能选择\"所有记录\"", parent=manage_win)
+                return
+            self.save_retention_policy(days if auto_var.get() else 0)
+            messagebox.showinfo("完成", "自动清理策略已保存", parent=manage_win)
+        
+        btn_frame = ttk.Frame(manage_win)
+        btn_frame.pack(pady=20)
+        
+        # 删除按钮
+        ttk.Button(btn_frame, text="立即删除", 
+                  command=lambda: self.delete_records(manage_win, selected_time.get())).pack(side=LEFT, padx=5)
+        ttk.Button(btn_frame, text="保存策略", command=apply_policy).pack(side=LEFT, padx=5)
+    
+    def delete_records(self, window, days):
+        if days == -1:
+            # 删除所有记录
+            confirm = messagebox.askyesno("确认", "确定要删除所有聊天记录吗？")
+            if not confirm:
+                return
+        else:
+            confirm = messagebox.askyesno("确认", f"确定要删除{days}天之前的所有聊天记录吗？")
+            if not confirm:
+                return
+        
+        if self.start_compaction(days, manual=True):
+            window.destroy()
+        else:
+            messagebox.showinfo("提示", "正在清理记录，请稍后再试")
+    
+    def load_retention_policy(self):
+        """读取自动清理策略，返回保留天数，0表示不自动清理"""
+        try:
+            with open(os.path.join(self.data_dir, "retention.json"), 'r', encoding='utf-8') as f:
+                return int(json.load(f).get('days', 0))
+        except:
+            return 0
+    
+    def save_retention_policy(self, days):
+        try:
+            with open(os.path.join(self.data_dir, "retention.json"), 'w', encoding='utf-8') as f:
+                json.dump({'days': days}, f)
+        except Exception as e:
+            print(f"保存清理策略失败: {e}")
+    
+    def schedule_retention(self):
+        """按自动清理策略定期在后台压缩记录"""
+        if not self.running:
+            return
+        days = self.load_retention_policy()
+        if days > 0:
+            self.start_compaction(days, manual=False)
+        self.root.after(RETENTION_CHECK_INTERVAL * 1000, self.schedule_retention)
+    
+    def start_compaction(self, days, manual):
+        """启动后台压缩线程，已有压缩任务在运行时返回False"""
+        if self.compaction_running:
+            return False
+        self.compaction_running = True
+        
+        # 计算时间阈值，删除所有记录时阈值为无穷大
+        threshold = time.time() - (days * 24 * 60 * 60) if days > 0 else float('inf')
+        threading.Thread(target=self.run_compaction, args=(threshold, manual), daemon=True).start()
+        return True
+    
+    def run_compaction(self, threshold, manual):
+        """后台逐个设备压缩记录文件，通过状态栏报告进度"""
+        deleted_records = 0
+        deleted_files = 0
+        try:
+            devices = self.history.list_devices()
+            for i, safe_mac in enumerate(devices):
+                def progress(done, total, i=i):
+                    self.call_in_ui(self.status_var.set, 
+                                    f"正在清理聊天记录: 设备 {i + 1}/{len(devices)}，文件 {done}/{total}")
+                records, files = self.history.compact(safe_mac, threshold, progress)
+                if records:
+                    self.search_index.rebuild_device(safe_mac)
+                deleted_records += records
+                deleted_files += files
+            # 删除文件后清理不再被任何设备引用的存储内容
+            if deleted_files:
+                self.blobs.collect_garbage()
+        except Exception as e:
+            print(f"清理记录失败: {e}")
+        finally:
+            self.compaction_running = False
+        
+        result = f"已删除 {deleted_records} 条记录和 {deleted_files} 个文件"
+        self.call_in_ui(self.status_var.set, f"聊天记录清理完成，{result}")
+        if manual:
+            self.call_in_ui(messagebox.showinfo, "完成", result)
+        if deleted_records:
+            self.call_in_ui(self.reload_current_chat)
+    
+    def reload_current_chat(self):
+        """刷新当前聊天窗口的历史消息"""
+        if self.current_chat_device and self.current_chat_device.mac in self.active_chats:
+            chat_info = self.active_chats[self.current_chat_device.mac]
+            self.load_history_messages(self.current_chat_device, chat_info["text_widget"])
+    
+    def search_records(self):
+        """聊天记录全文搜索窗口"""
+        search_win = Toplevel(self.root)
+        search_win.title("搜索聊天记录")
+        search_win.geometry("700x450")
+        
+        top_frame = ttk.Frame(search_win, padding=10)
+        top_frame.pack(fill=X)
+        
+        query_var = StringVar()
+        entry = ttk.Entry(top_frame, textvariable=query_var)
+        entry.pack(side=LEFT, fill=X, expand=True, padx=(0, 5))
+        entry.focus()
+        
+        result_var = StringVar()
+        ttk.Label(search_win, textvariable=result_var, anchor=W).pack(fill=X, padx=10)
+        
+        tree = ttk.Treeview(search_win, columns=["device", "time", "text"], show="headings")
+        tree.heading("device", text="设备")
+        tree.heading("time", text="时间")
+        tree.heading("text", text="内容")
+        tree.column("device", width=120)
+        tree.column("time", width=140)
+        tree.column("text", width=400)
+        tree.pack(fill=BOTH, expand=True, padx=10, pady=10)
+        results = {}
+        
+        def do_search(event=None):
+            tree.delete(*tree.get_children())
+            results.clear()
+            start = time.perf_counter()
+            matches = self.search_index.search(query_var.get())
+            elapsed = (time.perf_counter() - start) * 1000
+            
+            for safe_mac, record_no, record in matches:
+                info = self.history.get_device_info(safe_mac) or {}
+                timestamp = datetime.datetime.fromtimestamp(record['timestamp']).strftime('%Y-%m-%d %H:%M:%S')
+                text = record.get('content') or f"文件 '{record.get('filename', '')}'"
+                item = tree.insert("", END, values=[info.get('name', safe_mac), timestamp, text])
+                results[item] = info.get('mac')
+            
+            status = f"找到 {len(matches)} 条记录，用时 {elapsed:.1f} 毫秒"
+            if not self.search_index.ready.is_set():
+                status += "（索引仍在加载中，结果可能不完整）"
+            result_var.set(status)
+        
+        def open_result(event=None):
+            selection = tree.selection()
+            if selection:
+                self.open_chat_by_mac(results.get(selection[0]))
+        
+        entry.bind("<Return>", do_search)
+        tree.bind("<Double-1>", open_result)
+        ttk.Button(top_frame, text="搜索", command=do_search).pack(side=LEFT)
+    
+    def show_transfer_monitor(self):
+        """传输监控窗口：进行中和最近结束的传输，以及各设备的往返时延，定时刷新"""
+        monitor_win = Toplevel(self.root)
+        monitor_win.title("传输监控")
+        monitor_win.geometry("900x500")
+        
+        totals_var = StringVar()
+        ttk.Label(monitor_win, textvariable=totals_var, anchor=W).pack(fill=X, padx=10, pady=(10, 0))
+        
+        columns = [("peer", "设备", 100), ("name", "文件", 180), ("direction", "方向", 50),
+                   ("progress", "进度", 130), ("speed", "速度", 90), ("duration", "用时", 70),
+                   ("stall", "停顿", 70), ("retries", "重试", 50), ("status", "状态", 150)]
+        transfer_tree = ttk.Treeview(monitor_win, columns=[c[0] for c in columns], show="headings")
+        for name, text, width in columns:
+            transfer_tree.heading(name, text=text)
+            transfer_tree.column(name, width=width)
+        transfer_tree.pack(fill=BOTH, expand=True, padx=10, pady=10)
+        
+        columns = [("device", "设备", 160), ("last", "最近时延", 100), ("smoothed", "平滑时延", 100),
+                   ("min", "最小", 100), ("max", "最大", 100), ("samples", "样本数", 80)]
+        latency_tree = ttk.Treeview(monitor_win, columns=[c[0] for c in columns], show="headings", height=5)
+        for name, text, width in columns:
+            latency_tree.heading(name, text=text)
+            latency_tree.column(name, width=width)
+        latency_tree.pack(fill=X, padx=10, pady=(0, 10))
+        
+        def refresh():
+            if not monitor_win.winfo_exists():
+                return
+            snapshot = self.metrics.snapshot()
+            transfer_tree.delete(*transfer_tree.get_children())
+            for transfer in snapshot['active'] + snapshot['finished']:
+                if 'end' not in transfer:
+                    status = "进行中"
+                else:
+                    status = transfer['error'] or "完成"
+                transfer_tree.insert("", END, values=[
+                    transfer['peer'], transfer['name'],
+                    "发送" if transfer['direction'] == 'send' else "接收",
+                    f"{transfer['bytes'] / 1024 / 1024:.1f}/{transfer['total'] / 1024 / 1024:.1f} MB",
+                    f"{transfer['speed'] / 1024 / 1024:.1f} MB/s",
+                    f"{transfer['duration']:.1f} 秒", f"{transfer['stall']:.1f} 秒",
+                    transfer['retries'], status])
+            
+            latency_tree.delete(*latency_tree.get_children())
+            for mac, entry in snapshot['latency'].items():
+                latency_tree.insert("", END, values=[
+                    entry['name'], *(f"{entry[key] * 1000:.1f} 毫秒" for key in ('last', 'smoothed', 'min', 'max')),
+                    entry['samples']])
+            
+            totals = snapshot['totals']
+            totals_var.set(f"已发送 {totals['sent_bytes'] / 1024 / 1024:.1f} MB，已接收 "
+                           f"{totals['received_bytes'] / 1024 / 1024:.1f} MB，完成 {totals['completed']} 次，"
+                           f"失败 {totals['failed']} 次；统计文件: {os.path.abspath(self.stats_path)}")
+            monitor_win.after(METRICS_REFRESH_INTERVAL, refresh)
+        
+        refresh()
+    
+    def open_chat_by_mac(self, mac):
+        """打开指定设备的聊天窗口，设备不在线时提示"""
+        with self.devices_lock:
+            device = self.devices.get(mac)
+        if not device:
+            messagebox.showinfo("提示", "该设备当前不在线")
+            return
+        self.run_in_network(self.connect_to_device(device))
+        self.current_chat_device = device
+        self.create_chat_interface(device)
+    
+    def filter_devices(self, event=None):
+        # 更新设备列表以应用过滤
+        self.update_devices_listbox()
+    
+    def change_avatar(self):
+        # 选择新头像
+        filepath = filedialog.askopenfilename(
+            title="选择头像图片",
+            filetypes=[("图片文件", "*.png;*.jpg;*.jpeg;*.gif;*.bmp")]
+        )
+        
+        if not filepath:
+            return
+            
+        try:
+            # 加载并处理图片
+            img = Image.open(filepath)
+            img.thumbnail((200, 200))  # 限制头像大小
+            img = self.crop_to_circle(img)
+            
+            # 保存为PNG
+            avatar_path = os.path.join(self.data_dir, "avatar.png")
+            img.save(avatar_path, "PNG", optimize=True, quality=80)
+            
+            # 更新本地设备头像
+            img_byte_arr = io.BytesIO()
+            img.save(img_byte_arr, format='PNG')
+            self.local_device.avatar = img_byte_arr.getvalue()
+            
+            # 更新UI头像
+            self.local_avatar_img = self.create_avatar_image(self.local_device.avatar, 60)
+            
+            # 更新左侧头像
+            for widget in self.title_frame.winfo_children():
+                if isinstance(widget, ttk.Label) and hasattr(widget, 'image'):
+                    widget.configure(image=self.local_avatar_img)
+                    widget.image = self.local_avatar_img
+                    break
+            
+            # 广播头像更新
+            self.call_in_network(self.broadcast_avatar)
+            
+            messagebox.showinfo("成功", "头像已更新")
+        except Exception as e:
+            messagebox.showerror("错误", f"无法加载图片: {e}")
+    
+    async def stop_networking(self):
+        """关闭所有连接、套接字和网络任务（网络线程）"""
+        # 关闭所有连接
+        for device in self.connected_devices():
+            device.connection.close()
+            device.connection = None
+        
+        # 取消定时任务和连接处理协程
+        tasks = [task for task in asyncio.all_tasks(self.loop) if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        
+        # 关闭套接字
+        try:
+            self.udp_transport.close()
+        except:
+            pass
+            
+        try:
+            self.tcp_server.close()
+        except:
+            pass
+    
+    def on_closing(self):
+        try:
+            self.run_in_network(self.stop_networking()).result(timeout=2)
+        except Exception as e:
+            print(f"关闭网络服务错误: {e}")
+        self.write_stats()
+        self.running = False
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.root.destroy()
+
+if __name__ == "__main__":
+    if "--bench-codec" in sys.argv:
+        benchmark_codec()
+        sys.exit(0)
+    root = Tk()
+    app = LanChatApp(root)
+    root.mainloop()
@@ -0,0 +1,492 @@
+import asyncio
+import contextlib
+import errno
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import DCChatting as D
+
+
+def make_app(data_dir):
+    """只建立记录和内容存储，不启动界面和网络"""
+    app = D.LanChatApp.__new__(D.LanChatApp)
+    app.data_dir = data_dir
+    app.history = D.HistoryStore(data_dir)
+    app.blobs = D.BlobStore(data_dir)
+    app.search_index = D.SearchIndex(app.history)
+    app.local_device = D.NetworkDevice('127.0.0.1', 'aa:aa:aa:aa:aa:aa', 'A')
+    app.metrics = D.TransferMetrics()
+    app.pending_sends_path = os.path.join(data_dir, "pending_sends.json")
+    app.pending_sends = {}
+    return app
+
+
+class LegacyConnection:
+    """不支持批量发送的旧版本连接，打开发送流时抛出指定的错误"""
+    version = 3
+    closed = False
+    
+    def __init__(self, error):
+        self.error = error
+    
+    @contextlib.asynccontextmanager
+    async def open_stream(self):
+        self.closed = isinstance(self.error, ConnectionError)
+        raise self.error
+        yield
+
+
+class FramingTest(unittest.TestCase):
+    def setUp(self):
+        self.frames = [(D.FRAME_MESSAGE, b'hello'), (D.FRAME_HEARTBEAT, b''),
+                       (D.FRAME_FILE_DATA, os.urandom(70000)), (D.FRAME_READY, b'\x00' * 3)]
+        self.data = b''.join(D.encode_frame(*frame) for frame in self.frames)
+
+    def test_decoder_reassembles_frames_split_at_any_boundary(self):
+        # 无论TCP数据在哪里切分，解码结果都与发送的帧相同
+        for step in (1, 2, 5, 4096, len(self.data)):
+            with self.subTest(step=step):
+                decoder = D.FrameDecoder()
+                frames = []
+                for offset in range(0, len(self.data), step):
+                    frames += decoder.feed(self.data[offset:offset + step])
+                self.assertEqual(frames, self.frames)
+                self.assertFalse(decoder.buffer)
+
+    def test_decoder_rejects_oversized_frame(self):
+        with self.assertRaises(ValueError):
+            D.FrameDecoder().feed(D.FRAME_HEADER.pack(D.FRAME_MESSAGE, D.MAX_FRAME_SIZE + 1))
+
+    def test_frames_round_trip_over_connection(self):
+        async def run():
+            received = asyncio.Queue()
+            async def peer(reader, writer):
+                conn = D.FramedConnection(reader, writer)
+                for i in range(len(self.frames)):
+                    await received.put(await conn.recv_frame())
+                conn.close()
+            server = await asyncio.start_server(peer, '127.0.0.1', 0)
+            reader, writer = await asyncio.open_connection('127.0.0.1', server.sockets[0].getsockname()[1])
+            conn = D.FramedConnection(reader, writer)
+            for frame in self.frames:
+                conn.send_frame(*frame)
+            frames = [await asyncio.wait_for(received.get(), 5) for frame in self.frames]
+            conn.close()
+            server.close()
+            return frames
+        self.assertEqual(asyncio.run(run()), self.frames)
+
+
+class MessageCodecTest(unittest.TestCase):
+    def test_round_trip_keeps_fields_of_each_version(self):
+        # 按某一版本编码时只保留该版本支持的字段，其余字段解码为缺省值
+        message = {'type': 'file_metadata', 'filename': '报告.pdf', 'size': 2 ** 40,
+                   'file_id': 'abc', 'chunk_size': 65536, 'sha256': 'f' * 64, 'stream_id': 7}
+        for version in range(D.MIN_PROTOCOL_VERSION, D.PROTOCOL_VERSION + 1):
+            with self.subTest(version=version):
+                decoded = D.decode_message(D.encode_message(message, version))
+                expected = {name: message[name] if since <= version else D.SCHEMA_DEFAULTS['file_metadata'][name]
+                            for name, kind, since in D.MESSAGE_SCHEMAS['file_metadata'][1]}
+                expected['type'] = 'file_metadata'
+                self.assertEqual(decoded, expected)
+
+    def test_every_message_type_round_trips(self):
+        samples = {'str': '中文 text', 'bytes': b'\x00\xff', 'u8': 200, 'u32': 2 ** 31,
+                   'u64': 2 ** 50, 'f64': 1.5, 'bool': True}
+        for name, (type_id, fields) in D.MESSAGE_SCHEMAS.items():
+            with self.subTest(type=name):
+                message = {field: samples[kind] for field, kind, since in fields}
+                message['type'] = name
+                self.assertEqual(D.decode_message(D.encode_message(message)), message)
+
+    def test_malformed_payload_raises_value_error(self):
+        payload = D.encode_message({'type': 'text', 'content': 'hello'})
+        for bad in (payload[:1], payload[:-1], bytes([99]) + payload[1:], payload[:2] + b'\xff' * 4):
+            with self.subTest(bad=bad):
+                with self.assertRaises(ValueError):
+                    D.decode_message(bad)
+
+
+class HistoryStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.data_dir = os.path.join(self.tmp.name, "Data")
+        self.device = D.NetworkDevice('127.0.0.2', 'bb:bb:bb:bb:bb:bb', 'B')
+        self.safe_mac = self.device.get_safe_mac()
+        self.records = [{'timestamp': 1000.0 + i, 'type': 'text', 'content': f'消息{i}'} for i in range(40)]
+        # 记录文件很小，使记录分布在多个文件中
+        with mock.patch.object(D, 'MAX_RECORD_FILE_SIZE', 400):
+            store = D.HistoryStore(self.data_dir)
+            for i, record in enumerate(self.records):
+                self.assertEqual(store.append(self.device, record), i)
+        self.index_path = os.path.join(self.data_dir, self.safe_mac, D.HistoryStore.INDEX_FILE)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_records_span_several_segments(self):
+        self.assertGreater(len(D.HistoryStore(self.data_dir).list_segments(self.safe_mac)), 3)
+
+    def test_read_range_pages_through_records(self):
+        store = D.HistoryStore(self.data_dir)
+        self.assertEqual(store.count(self.safe_mac), 40)
+        pages = [store.read_range(self.safe_mac, start, start + 15) for start in range(0, 40, 15)]
+        self.assertEqual([len(page) for page in pages], [15, 15, 10])
+        self.assertEqual(sum(pages, []), self.records)
+        self.assertEqual(store.read_last(self.safe_mac, 5), self.records[-5:])
+        self.assertEqual(store.read_range(self.safe_mac, -5, 3), self.records[:3])
+        self.assertEqual(store.read_numbers(self.safe_mac, [39, 0, 40]), [self.records[39], self.records[0], None])
+        self.assertEqual(store.find_first_after(self.safe_mac, 1010.5), 11)
+
+    def test_missing_index_is_rebuilt(self):
+        os.remove(self.index_path)
+        store = D.HistoryStore(self.data_dir)
+        self.assertEqual(store.count(self.safe_mac), 40)
+        self.assertEqual(store.read_range(self.safe_mac, 0, 40), self.records)
+        self.assertTrue(os.path.exists(self.index_path))
+
+    def test_stale_or_torn_index_is_repaired(self):
+        # 索引落后于记录文件时重建，末尾有不完整的索引项时截断
+        with open(self.index_path, 'r+b') as f:
+            f.truncate(30 * D.HistoryStore.INDEX_ENTRY.size)
+        self.assertEqual(D.HistoryStore(self.data_dir).read_range(self.safe_mac, 0, 40), self.records)
+        with open(self.index_path, 'ab') as f:
+            f.write(b'\x00' * 5)
+        store = D.HistoryStore(self.data_dir)
+        self.assertEqual(store.count(self.safe_mac), 40)
+        self.assertEqual(os.path.getsize(self.index_path), 40 * D.HistoryStore.INDEX_ENTRY.size)
+        record = {'timestamp': 2000.0, 'type': 'text', 'content': 'new'}
+        self.assertEqual(store.append(self.device, record), 40)
+        self.assertEqual(D.HistoryStore(self.data_dir).read_last(self.safe_mac, 2), [self.records[-1], record])
+
+
+class SearchIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.data_dir = os.path.join(self.tmp.name, "Data")
+        self.history = D.HistoryStore(self.data_dir)
+        self.index = D.SearchIndex(self.history)
+        self.devices = [D.NetworkDevice('127.0.0.2', 'bb:bb:bb:bb:bb:bb', 'B'),
+                        D.NetworkDevice('127.0.0.3', 'cc:cc:cc:cc:cc:cc', 'C')]
+        self.timestamp = 1000.0
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def add(self, device, content):
+        self.timestamp += 1
+        record = {'timestamp': self.timestamp, 'type': 'text', 'content': content}
+        self.index.add(device.get_safe_mac(), self.history.append(device, record), record)
+        return record
+
+    def contents(self, query, **kwargs):
+        return [record['content'] for safe_mac, number, record in self.index.search(query, **kwargs)]
+
+    def test_tokenize_splits_cjk_into_characters_and_bigrams(self):
+        self.assertEqual(D.tokenize("Hello 天气很好 v2_beta"),
+                         {'hello', 'v2_beta', '天', '气', '很', '好', '天气', '气很', '很好'})
+
+    def test_bigram_matches_are_verified_against_record_text(self):
+        # 记录包含查询的全部二字词但不包含连续的查询词时不作为结果
+        self.add(self.devices[0], "今天气很热，心情很好")
+        self.add(self.devices[0], "天气很好")
+        self.assertEqual(self.contents("气很好"), ["天气很好"])
+        self.assertEqual(self.contents("很好"), ["天气很好", "今天气很热，心情很好"])
+        self.assertEqual(self.contents("HELLO"), [])
+
+    def test_results_are_newest_first_across_devices_and_segments(self):
+        with mock.patch.object(D, 'MAX_RECORD_FILE_SIZE', 200):
+            for i in range(30):
+                self.add(self.devices[i % 2], f"会议纪要 第{i}次 meeting")
+                self.add(self.devices[i % 2], f"无关消息 {i}")
+        self.assertGreater(len(self.history.list_segments(self.devices[0].get_safe_mac())), 3)
+        expected = [f"会议纪要 第{i}次 meeting" for i in reversed(range(30))]
+        self.assertEqual(self.contents("纪要 meeting"), expected)
+        self.assertEqual(self.contents("会议", limit=4), expected[:4])
+
+    def test_reload_uses_token_file_and_indexes_missing_records(self):
+        self.add(self.devices[0], "第一条消息")
+        safe_mac = self.devices[0].get_safe_mac()
+        # 模拟异常退出：记录已写入但没有写入分词结果
+        self.history.append(self.devices[0], {'timestamp': 2000.0, 'type': 'text', 'content': '第二条消息'})
+        index = D.SearchIndex(D.HistoryStore(self.data_dir))
+        index.load()
+        self.assertTrue(index.ready.is_set())
+        self.assertEqual(index.indexed_upto[safe_mac], 2)
+        self.assertEqual([r[2]['content'] for r in index.search("消息")], ["第二条消息", "第一条消息"])
+        with open(index.tokens_path(safe_mac), encoding='utf-8') as f:
+            self.assertEqual([line.split("\t")[0] for line in f], ['0', '1'])
+
+
+class DeadlineSchedulerTest(unittest.TestCase):
+    def test_due_keys_pop_in_deadline_order(self):
+        scheduler = D.DeadlineScheduler()
+        for key, deadline in (('c', 30), ('a', 10), ('b', 20), ('d', 20)):
+            scheduler.schedule(key, deadline)
+        self.assertEqual(scheduler.next_deadline(), 10)
+        self.assertEqual(scheduler.pop_due(5), [])
+        self.assertEqual(scheduler.pop_due(20), ['a', 'b', 'd'])
+        self.assertEqual(len(scheduler), 1)
+        self.assertEqual(scheduler.pop_due(100), ['c'])
+        self.assertIsNone(scheduler.next_deadline())
+
+    def test_reschedule_and_cancel_replace_old_deadline(self):
+        # 只有最新的截止时间有效，重新安排和取消前的旧条目弹出时丢弃
+        scheduler = D.DeadlineScheduler()
+        scheduler.schedule('late', 10)
+        scheduler.schedule('late', 50)
+        scheduler.schedule('early', 40)
+        scheduler.schedule('early', 5)
+        scheduler.schedule('gone', 1)
+        scheduler.cancel('gone')
+        scheduler.cancel('missing')
+        self.assertEqual(scheduler.next_deadline(), 5)
+        self.assertEqual(scheduler.pop_due(45), ['early'])
+        self.assertEqual(scheduler.next_deadline(), 50)
+        self.assertEqual(scheduler.pop_due(50), ['late'])
+        self.assertEqual(len(scheduler), 0)
+
+    def test_stale_entries_do_not_accumulate(self):
+        scheduler = D.DeadlineScheduler()
+        for i in range(10000):
+            scheduler.schedule(i % 10, i)
+        self.assertEqual(len(scheduler), 10)
+        self.assertLessEqual(len(scheduler.heap), 2 * 10 + 65)
+        self.assertEqual(scheduler.pop_due(10 ** 6), list(range(10)))
+
+
+class ReceivedFileTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.app = make_app(os.path.join(self.tmp.name, "Data"))
+        self.device = D.NetworkDevice('127.0.0.2', 'bb:bb:bb:bb:bb:bb', 'B')
+        self.src = os.path.join(self.tmp.name, "report.bin")
+        with open(self.src, 'wb') as f:
+            f.write(os.urandom(4096))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_compact_keeps_file_of_newer_record(self):
+        # 同名同内容的文件收到两次，清理第一条记录后第二条记录的文件和存储内容仍然存在
+        digest = self.app.save_file_copy(self.device, self.src, False)
+        threshold = time.time()
+        time.sleep(0.01)
+        self.app.save_file_copy(self.device, self.src, False)
+        safe_mac = self.device.get_safe_mac()
+        first, second = self.app.history.read_range(safe_mac, 0, 2)
+        self.assertNotEqual(first['filepath'], second['filepath'])
+        
+        self.assertEqual(self.app.history.compact(safe_mac, threshold), (1, 1))
+        self.assertTrue(os.path.exists(second['filepath']))
+        self.assertEqual(self.app.blobs.collect_garbage(), 0)
+        self.assertTrue(os.path.exists(self.app.blobs.blob_path(digest)))
+
+
+    def test_link_never_writes_through_existing_file(self):
+        # 不支持硬链接时复制，目标已存在时都不会改动已有文件
+        digest = self.app.blobs.add_file(self.src)
+        existing = os.path.join(self.tmp.name, "existing.bin")
+        with open(existing, 'wb') as f:
+            f.write(b'keep')
+        copied = os.path.join(self.tmp.name, "copied.bin")
+        with mock.patch.object(D.os, 'link', side_effect=OSError(errno.EXDEV, "跨设备")):
+            with self.assertRaises(FileExistsError):
+                self.app.blobs.link(digest, existing)
+            self.app.blobs.link(digest, copied)
+        with self.assertRaises(FileExistsError):
+            self.app.blobs.link(digest, existing)
+        with open(existing, 'rb') as f:
+            self.assertEqual(f.read(), b'keep')
+        with open(copied, 'rb') as f, open(self.src, 'rb') as src:
+            self.assertEqual(f.read(), src.read())
+
+    def test_link_blob_file_retries_when_name_is_taken(self):
+        # 选出名称后被同时保存的其他文件占用，改用下一个名称
+        digest = self.app.blobs.add_file(self.src)
+        unique_file_path = self.app.unique_file_path
+        def racing_unique_file_path(files_dir, filename):
+            name, path = unique_file_path(files_dir, filename)
+            if name == filename:
+                with open(path, 'wb') as f:
+                    f.write(b'other')
+            return name, path
+        self.app.unique_file_path = racing_unique_file_path
+        name, path = self.app.link_blob_file(self.device, digest, "report.bin")
+        self.assertEqual(name, "report_1.bin")
+        with open(os.path.join(os.path.dirname(path), "report.bin"), 'rb') as f:
+            self.assertEqual(f.read(), b'other')
+
+
+    def test_garbage_collection_skips_blobs_not_yet_linked(self):
+        # 后台清理发生在存入存储和建立硬链接之间时，该内容不会被删除
+        link_blob_file = self.app.link_blob_file
+        def link_after_gc(device, digest, filename):
+            self.assertEqual(self.app.blobs.collect_garbage(), 0)
+            return link_blob_file(device, digest, filename)
+        self.app.link_blob_file = link_after_gc
+        digest = self.app.save_file_copy(self.device, self.src, True)
+        self.assertTrue(os.path.exists(self.app.blobs.blob_path(digest)))
+        self.assertFalse(self.app.blobs.pins)
+        
+        # 解除保护后没有硬链接引用的内容照常清理
+        other = os.path.join(self.tmp.name, "other.bin")
+        with open(other, 'wb') as f:
+            f.write(b'unlinked')
+        with self.app.blobs.pinned([self.app.blobs.add_file(other)]):
+            self.assertEqual(self.app.blobs.collect_garbage(), 0)
+        self.assertEqual(self.app.blobs.collect_garbage(), 1)
+
+
+    def test_known_blob_is_linked_off_the_event_loop(self):
+        # 本地已有相同内容时建立硬链接和记录在线程池中完成，不阻塞网络线程
+        digest = self.app.blobs.add_file(self.src)
+        threads = []
+        for name in ('link_blob_file', 'record_file_transfer'):
+            def wrapper(*args, original=getattr(self.app, name)):
+                threads.append(threading.get_ident())
+                return original(*args)
+            setattr(self.app, name, wrapper)
+        received = []
+        self.app.call_in_ui = lambda func, *args: received.append(args[1:])
+        
+        class EndingStream:
+            def send_message(self, message):
+                pass
+            async def recv_frame(self):
+                return D.FRAME_MESSAGE, D.encode_message({'type': 'file_end'})
+        async def receive():
+            self.app.loop = asyncio.get_running_loop()
+            await self.app.receive_known_blob(EndingStream(), self.device, "report.bin", "0" * 32, 1, digest)
+        asyncio.run(receive())
+        
+        self.assertEqual(len(threads), 2)
+        self.assertNotIn(threading.get_ident(), threads)
+        filename, filepath = received[0]
+        self.assertEqual(filename, "report.bin")
+        self.assertTrue(os.path.samefile(filepath, self.app.blobs.blob_path(digest)))
+
+
+class LegacyBatchSendTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.app = make_app(os.path.join(self.tmp.name, "Data"))
+        self.notices = []
+        self.app.call_in_ui = lambda func, *args: self.notices.append(args[1:])
+        self.device = D.NetworkDevice('127.0.0.2', 'bb:bb:bb:bb:bb:bb', 'B')
+        self.folder = os.path.join(self.tmp.name, "photos")
+        os.makedirs(self.folder)
+        for name in ("1.bin", "2.bin"):
+            with open(os.path.join(self.folder, name), 'wb') as f:
+                f.write(os.urandom(1024))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def send_batch(self, error):
+        self.device.connection = LegacyConnection(error)
+        async def send():
+            self.app.loop = asyncio.get_running_loop()
+            await self.app.send_batch_task(self.device, [self.folder], "photos")
+        asyncio.run(send())
+
+    def test_failed_files_stay_pending(self):
+        # 逐个发送时失败的文件各自保留续传记录，失败数量显示在聊天窗口
+        for error in (ConnectionError("连接已关闭"), Exception("对方拒绝接收")):
+            with self.subTest(error=error):
+                self.app.pending_sends = {}
+                self.notices.clear()
+                self.send_batch(error)
+                pending = self.app.pending_sends[self.device.mac]
+                self.assertEqual(sorted(pending.values()),
+                                 [os.path.join(self.folder, "1.bin"), os.path.join(self.folder, "2.bin")])
+                self.assertIn(("'photos' 共 2 个文件，其中 2 个发送失败，下次连接时重新发送",), self.notices)
+                # 没有发送成功的文件不记录为已发送
+                self.assertEqual(self.app.history.count(self.device.get_safe_mac()), 0)
+                self.assertFalse(self.app.blobs.pins)
+
+    def test_failed_single_send_is_not_recorded(self):
+        self.device.connection = LegacyConnection(ConnectionError("连接已关闭"))
+        path = os.path.join(self.folder, "1.bin")
+        async def send():
+            self.app.loop = asyncio.get_running_loop()
+            return await self.app.send_file_task(self.device, path, os.path.getsize(path))
+        self.assertFalse(asyncio.run(send()))
+        self.assertEqual(self.app.history.count(self.device.get_safe_mac()), 0)
+        self.assertFalse(os.path.exists(os.path.join(self.app.data_dir, self.device.get_safe_mac(), "Files", "1.bin")))
+        self.assertFalse(self.app.blobs.pins)
+
+
+
+class HandshakeTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.app = make_app(os.path.join(self.tmp.name, "Data"))
+        self.app.connecting = set()
+        self.errors = []
+        self.app.call_in_ui = lambda func, *args: self.errors.append(args)
+        self.device = D.NetworkDevice('127.0.0.1', 'bb:bb:bb:bb:bb:bb', 'B')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def connect(self, close_after_hello):
+        """对方回复hello后断开或不再回复头像，返回对方是否看到连接已关闭"""
+        async def run():
+            self.app.loop = asyncio.get_running_loop()
+            peer_closed = asyncio.Event()
+            async def peer(reader, writer):
+                conn = D.FramedConnection(reader, writer)
+                hello = await conn.recv_message()
+                conn.send_message({'type': 'hello', 'mac': self.device.mac, 'name': 'B',
+                                   'min_version': hello['min_version'], 'max_version': hello['max_version']})
+                if close_after_hello:
+                    await asyncio.sleep(0.05)
+                    conn.close()
+                while await reader.read(65536):
+                    pass
+                peer_closed.set()
+            server = await asyncio.start_server(peer, '127.0.0.1', 0)
+            with mock.patch.object(D, 'TCP_PORT', server.sockets[0].getsockname()[1]), \
+                    mock.patch.object(D, 'CONNECT_TIMEOUT', 0.3):
+                await self.app.connect_to_device(self.device)
+            try:
+                await asyncio.wait_for(peer_closed.wait(), 2)
+            finally:
+                server.close()
+            return peer_closed.is_set()
+        return asyncio.run(run())
+
+    def test_failed_avatar_exchange_closes_connection(self):
+        # 对方在头像交换前断开或超时不回复，连接被关闭且不保存为设备连接
+        for close_after_hello in (True, False):
+            with self.subTest(close_after_hello=close_after_hello):
+                self.errors.clear()
+                self.assertTrue(self.connect(close_after_hello))
+                self.assertIsNone(self.device.connection)
+                self.assertEqual(len(self.errors), 1)
+
+
+class BeaconCacheTest(unittest.TestCase):
+    def test_cache_evicts_least_recent_address(self):
+        # 广播缓存超出上限时淘汰最久未收到广播的地址
+        app = D.LanChatApp.__new__(D.LanChatApp)
+        app.beacon_cache = D.collections.OrderedDict()
+        with mock.patch.object(D, 'BEACON_CACHE_SIZE', 3):
+            for i in range(3):
+                app.cache_beacon(f'10.0.0.{i}', b'x', f'mac{i}')
+            app.cache_beacon('10.0.0.0', b'y', 'mac0')
+            for i in range(3, 100):
+                app.cache_beacon(f'10.0.0.{i}', b'x', f'mac{i}')
+                self.assertLessEqual(len(app.beacon_cache), 3)
+        self.assertEqual(list(app.beacon_cache), ['10.0.0.97', '10.0.0.98', '10.0.0.99'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,184 @@
+import os
+import socket
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+lan = __import__('局域网闪传文件')
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class SplitChunksTest(unittest.TestCase):
+    def test_parts_are_contiguous_and_balanced(self):
+        chunks = list(range(3, 40))
+        for streams in (1, 2, 4, 7, 16):
+            with self.subTest(streams=streams):
+                parts = lan.split_chunks(chunks, streams)
+                self.assertEqual(sum(parts, []), chunks)
+                self.assertEqual(len(parts), min(streams, len(chunks) // lan.MIN_STREAM_CHUNKS))
+                self.assertLessEqual(max(map(len, parts)) - min(map(len, parts)), 1)
+
+    def test_small_transfers_use_one_connection(self):
+        self.assertEqual(lan.split_chunks([0, 1, 2], 8), [[0, 1, 2]])
+        self.assertEqual(lan.split_chunks([], 4), [[]])
+
+
+class BatchLayoutTest(unittest.TestCase):
+    def test_locate_maps_stream_offsets_to_files(self):
+        layout = lan.BatchLayout([10, 0, 5, 0, 0, 20])
+        self.assertEqual(layout.total, 35)
+        self.assertEqual(layout.locate(0, 10), [(0, 0, 10)])
+        # 跨越多个文件的范围按顺序拆分，中间的空文件被跳过
+        self.assertEqual(layout.locate(8, 10), [(0, 8, 2), (2, 0, 5), (5, 0, 3)])
+        self.assertEqual(layout.locate(10, 5), [(2, 0, 5)])
+        self.assertEqual(layout.locate(34, 1), [(5, 19, 1)])
+
+    def test_locate_covers_every_byte_once(self):
+        sizes = [3, 0, 7, 1, 0, 12]
+        layout = lan.BatchLayout(sizes)
+        for length in (1, 4, 9, layout.total):
+            with self.subTest(length=length):
+                covered = [[0] * size for size in sizes]
+                for offset in range(0, layout.total, length):
+                    for index, start, n in layout.locate(offset, min(length, layout.total - offset)):
+                        for i in range(start, start + n):
+                            covered[index][i] += 1
+                self.assertEqual(covered, [[1] * size for size in sizes])
+
+
+class DropDirTest(unittest.TestCase):
+    """无人值守接收：本机同时作为发送方和接收方"""
+    
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.saved_paths = lan.RESUME_STATE_FILE, lan.STATS_FILE
+        lan.RESUME_STATE_FILE = os.path.join(self.tmp.name, "resume.json")
+        lan.STATS_FILE = os.path.join(self.tmp.name, "stats.json")
+        self.drop_dir = os.path.join(self.tmp.name, "drop")
+        os.makedirs(self.drop_dir)
+        self.messages = []
+        notify = lambda level, title, text: self.messages.append((level, text))
+        self.server = lan.NetworkManager(save_dir=self.drop_dir, naming="overwrite", notify=notify)
+        self.port = free_port()
+        self.assertTrue(self.server.start_server("test", self.port))
+        self.client = lan.NetworkManager(notify=notify)
+        self.target = {'ip': '127.0.0.1', 'port': self.port, 'name': 'test'}
+
+    def tearDown(self):
+        self.server.stop()
+        lan.RESUME_STATE_FILE, lan.STATS_FILE = self.saved_paths
+        self.tmp.cleanup()
+
+    def make_file(self, folder, name, fill, size):
+        os.makedirs(os.path.join(self.tmp.name, folder), exist_ok=True)
+        path = os.path.join(self.tmp.name, folder, name)
+        with open(path, 'wb') as f:
+            f.write(fill * size)
+        return path
+
+    def offer(self, path):
+        entries = lan.build_manifest([path])
+        return {'transfer_id': lan.make_transfer_id(entries), 'name': entries[0][0],
+                'files': [[relpath, size] for relpath, p, size in entries],
+                'filesize': sum(size for relpath, p, size in entries), 'chunk_size': lan.CHUNK_SIZE}
+
+    def test_file_is_sent_over_parallel_connections(self):
+        path = os.path.join(self.tmp.name, "big.bin")
+        with open(path, 'wb') as f:
+            f.write(os.urandom(16 * lan.CHUNK_SIZE + 123))
+        stats = self.client.send_files(self.target, [path], 4, compress=False)
+        self.assertIsNotNone(stats, self.messages)
+        self.assertEqual(stats['streams'], 4)
+        self.assertEqual(stats['sent'], os.path.getsize(path))
+        with open(os.path.join(self.drop_dir, "big.bin"), 'rb') as f:
+            self.assertEqual(f.read(), open(path, 'rb').read())
+
+    def test_folder_with_empty_files_is_sent_as_one_batch(self):
+        folder = os.path.join(self.tmp.name, "docs")
+        files = {"a.txt": b"a" * 1000, "empty.txt": b"", "sub/b.bin": os.urandom(2 * lan.CHUNK_SIZE + 7),
+                 "sub/deeper/empty.bin": b""}
+        for relpath, content in files.items():
+            self.make_file(os.path.join("docs", os.path.dirname(relpath)), os.path.basename(relpath), content, 1)
+        stats = self.client.send_files(self.target, [folder])
+        self.assertIsNotNone(stats, self.messages)
+        self.assertEqual(stats['files'], len(files))
+        for relpath, content in files.items():
+            with open(os.path.join(self.drop_dir, "docs", relpath), 'rb') as f:
+                self.assertEqual(f.read(), content)
+
+    def test_overwrite_never_shares_part_file_in_flight(self):
+        size = 3 * lan.CHUNK_SIZE
+        first = self.make_file("a", "x.bin", b'A', size)
+        second = self.make_file("b", "x.bin", b'B', size)
+        
+        # 第一个传输正在接收时，同名的覆盖接收被拒绝且不会改动临时文件
+        transfer = self.server._open_transfer(self.offer(first))
+        part_path = os.path.join(self.drop_dir, "x.bin.part")
+        with open(part_path, 'r+b') as f:
+            f.write(b'A' * size)
+        with self.assertRaises(lan.TransferRefused):
+            self.server._open_transfer(self.offer(second))
+        self.assertIsNone(self.client.send_files(self.target, [second], 4))
+        self.assertIn("同名文件正在接收中", self.messages[-1][1])
+        with open(part_path, 'rb') as f:
+            self.assertEqual(f.read(), b'A' * size)
+        
+        # 第一个传输结束后可以正常覆盖
+        with self.server.naming_lock:
+            self.server.receiving_names.difference_update(transfer['reserved'])
+        with self.server.transfers_lock:
+            self.server.transfers.pop(transfer['id'])
+        self.assertIsNotNone(self.client.send_files(self.target, [second], 4))
+        with open(os.path.join(self.drop_dir, "x.bin"), 'rb') as f:
+            self.assertEqual(f.read(), b'B' * size)
+
+    def test_parallel_full_width_sends_from_one_address(self):
+        # 同一地址同时进行两次满并行发送，超出名额的连接排队等待而不是被关闭
+        size = lan.MAX_STREAMS * lan.MIN_STREAM_CHUNKS * lan.CHUNK_SIZE
+        paths = [self.make_file("a", "p.bin", b'P', size), self.make_file("b", "q.bin", b'Q', size)]
+        for active_per_peer in (lan.MAX_ACTIVE_PER_PEER, 4):
+            with self.subTest(active_per_peer=active_per_peer):
+                self.server.connection_pool.shutdown()
+                self.server.connection_pool = lan.ConnectionPool(self.server._handle_client,
+                                                                 active_per_peer=active_per_peer)
+                results = [None, None]
+                def send(i):
+                    results[i] = self.client.send_files(self.target, [paths[i]], lan.MAX_STREAMS)
+                threads = [threading.Thread(target=send, args=(i,)) for i in range(2)]
+                for t in threads:
+                    t.start()
+                for t in threads:
+                    t.join()
+                self.assertEqual([stats and stats['streams'] for stats in results], [lan.MAX_STREAMS] * 2,
+                                 self.messages)
+                for path in paths:
+                    with open(os.path.join(self.drop_dir, os.path.basename(path)), 'rb') as f:
+                        self.assertEqual(f.read(), open(path, 'rb').read())
+
+
+class BeaconCacheTest(unittest.TestCase):
+    def test_cache_evicts_least_recent_address(self):
+        # 广播缓存超出上限时淘汰最久未收到广播的地址，最近刷新过的地址保留
+        manager = lan.NetworkManager()
+        saved = lan.BEACON_CACHE_SIZE
+        lan.BEACON_CACHE_SIZE = 3
+        try:
+            for i in range(3):
+                manager.cache_beacon(f'10.0.0.{i}', b'x')
+            manager.cache_beacon('10.0.0.0', b'y')
+            manager.cache_beacon('10.0.0.3', b'x')
+        finally:
+            lan.BEACON_CACHE_SIZE = saved
+        self.assertEqual(list(manager.beacon_cache), ['10.0.0.2', '10.0.0.0', '10.0.0.3'])
+        self.assertEqual(manager.beacon_cache['10.0.0.0'], b'y')
+
+
+if __name__ == '__main__':
+    unittest.main()
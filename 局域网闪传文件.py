@@ -1,373 +1,1529 @@
-import socket
-import threading
-import json
-import os
-import time
-import uuid
-from tkinter import Tk, Label, Entry, Button, Listbox, messagebox, filedialog, Frame, Radiobutton, StringVar
-
-class NetworkManager:
-    def __init__(self):
-        self.running = False
-        self.tcp_server = None
-        self.udp_broadcast = None
-        self.udp_listener = None
-        self.mode = "none"  # "server", "client", or "none"
-        self.server_info = {}
-        self.discovered_servers = []
-        self.lock = threading.Lock()
-
-    def get_local_ip(self):
-        try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            s.connect(("8.8.8.8", 80))
-            ip = s.getsockname()[0]
-            s.close()
-            return ip
-        except:
-            return "127.0.0.1"
-
-    def get_mac_address(self):
-        mac = uuid.getnode()
-        return ':'.join(("%012X" % mac)[i:i+2] for i in range(0, 12, 2))
-
-    def start_server(self, name, port=5000):
-        self.mode = "server"
-        self.running = True
-        self.server_info = {
-            "name": name,
-            "ip": self.get_local_ip(),
-            "mac": self.get_mac_address(),
-            "port": port
-        }
-        
-        # 启动TCP文件服务器
-        threading.Thread(target=self._start_tcp_server, daemon=True).start()
-        # 启动广播服务
-        threading.Thread(target=self._broadcast_presence, daemon=True).start()
-
-    def _start_tcp_server(self):
-        self.tcp_server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.tcp_server.bind(('0.0.0.0', self.server_info['port']))
-        self.tcp_server.listen(5)
-        
-        while self.running:
-            try:
-                client, addr = self.tcp_server.accept()
-                threading.Thread(target=self._handle_client, args=(client,)).start()
-            except:
-                break
-
-    def _handle_client(self, client):
-        try:
-            # 接收文件信息
-            file_info = json.loads(client.recv(1024).decode())
-            filename = file_info['filename']
-            filesize = file_info['filesize']
-            
-            # 选择保存位置
-            save_path = filedialog.asksaveasfilename(
-                initialfile=filename,
-                title="保存文件",
-                filetypes=(("所有文件", "*.*"),)
-            )
-            
-            if not save_path:
-                client.close()
-                return
-                
-            # 接收文件数据
-            with open(save_path, 'wb') as f:
-                received = 0
-                while received < filesize:
-                    data = client.recv(1024)
-                    if not data:
-                        break
-                    f.write(data)
-                    received += len(data)
-            
-            messagebox.showinfo("成功", f"文件 {filename} 接收完成!")
-        except Exception as e:
-            messagebox.showerror("错误", f"文件接收失败: {str(e)}")
-        finally:
-            client.close()
-
-    def _broadcast_presence(self):
-        self.udp_broadcast = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.udp_broadcast.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-        
-        while self.running:
-            data = json.dumps(self.server_info)
-            self.udp_broadcast.sendto(data.encode(), ('<broadcast>', 9999))
-            time.sleep(5)  # 每5秒广播一次
-
-    def start_client(self):
-        self.mode = "client"
-        self.running = True
-        # 启动服务器发现
-        threading.Thread(target=self._discover_servers, daemon=True).start()
-
-    def _discover_servers(self):
-        self.udp_listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.udp_listener.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-        self.udp_listener.settimeout(1)
-        self.udp_listener.bind(('', 9999))
-        
-        # 发送发现请求
-        self.udp_listener.sendto(b"DISCOVER", ('<broadcast>', 9999))
-        
-        while self.running:
-            try:
-                data, addr = self.udp_listener.recvfrom(1024)
-                server_info = json.loads(data.decode())
-                server_info['addr'] = addr[0]
-                
-                with self.lock:
-                    # 检查是否已存在相同服务器
-                    exists = False
-                    for s in self.discovered_servers:
-                        if s['ip'] == server_info['ip'] and s['port'] == server_info['port']:
-                            exists = True
-                            break
-                    
-                    if not exists:
-                        self.discovered_servers.append(server_info)
-            except socket.timeout:
-                # 定期重新发送发现请求
-                if self.running:
-                    self.udp_listener.sendto(b"DISCOVER", ('<broadcast>', 9999))
-            except:
-                continue
-
-    def get_discovered_servers(self):
-        with self.lock:
-            return self.discovered_servers.copy()
-
-    def send_file(self, server, filepath):
-        try:
-            # 连接到服务器
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.connect((server['ip'], server['port']))
-            
-            # 发送文件信息
-            filename = os.path.basename(filepath)
-            filesize = os.path.getsize(filepath)
-            file_info = json.dumps({
-                "filename": filename,
-                "filesize": filesize
-            })
-            s.send(file_info.encode())
-            
-            # 发送文件内容
-            with open(filepath, 'rb') as f:
-                while True:
-                    data = f.read(1024)
-                    if not data:
-                        break
-                    s.send(data)
-            
-            s.close()
-            return True
-        except Exception as e:
-            messagebox.showerror("错误", f"文件发送失败: {str(e)}")
-            return False
-
-    def stop(self):
-        self.running = False
-        self.mode = "none"
-        
-        if self.tcp_server:
-            self.tcp_server.close()
-            self.tcp_server = None
-        
-        if self.udp_broadcast:
-            self.udp_broadcast.close()
-            self.udp_broadcast = None
-        
-        if self.udp_listener:
-            self.udp_listener.close()
-            self.udp_listener = None
-        
-        with self.lock:
-            self.discovered_servers = []
-
-
-class FileTransferApp:
-    def __init__(self):
-        self.network = NetworkManager()
-        self.window = Tk()
-        self.window.title("局域网文件传输工具")
-        self.window.geometry("600x500")
-        
-        # 模式选择
-        self.mode_frame = Frame(self.window)
-        self.mode_frame.pack(pady=20)
-        
-        Label(self.mode_frame, text="选择模式:").grid(row=0, column=0, padx=5)
-        
-        self.mode_var = StringVar(value="none")
-        
-        Radiobutton(self.mode_frame, text="主机模式", variable=self.mode_var, 
-                   value="server", command=self.on_mode_change).grid(row=0, column=1, padx=5)
-        Radiobutton(self.mode_frame, text="客户端模式", variable=self.mode_var, 
-                   value="client", command=self.on_mode_change).grid(row=0, column=2, padx=5)
-        
-        # 服务器配置
-        self.server_frame = Frame(self.window)
-        Label(self.server_frame, text="主机配置").pack(pady=5)
-        
-        Label(self.server_frame, text="主机名称:").pack()
-        self.name_entry = Entry(self.server_frame, width=30)
-        self.name_entry.pack()
-        self.name_entry.insert(0, "我的电脑")
-        
-        Label(self.server_frame, text="端口号:").pack()
-        self.port_entry = Entry(self.server_frame, width=10)
-        self.port_entry.pack()
-        self.port_entry.insert(0, "5000")
-        
-        self.start_btn = Button(self.server_frame, text="启动服务", command=self.toggle_server)
-        self.start_btn.pack(pady=10)
-        
-        self.server_info_text = Label(self.server_frame, text="", justify="left")
-        self.server_info_text.pack(pady=5)
-        
-        # 客户端配置区域
-        self.client_frame = Frame(self.window)
-        Label(self.client_frame, text="客户端配置").pack(pady=5)
-        
-        self.refresh_btn = Button(self.client_frame, text="搜索主机", command=self.discover_servers)
-        self.refresh_btn.pack(pady=5)
-        
-        Label(self.client_frame, text="可用的主机:").pack()
-        self.server_list = Listbox(self.client_frame, width=70, height=10)
-        self.server_list.pack(pady=5, padx=10)
-        
-        self.select_btn = Button(self.client_frame, text="选择文件并发送", 
-                               command=self.send_file, state="disabled")
-        self.select_btn.pack(pady=10)
-        
-        # 初始状态
-        self.update_ui_based_on_mode()
-        
-        # 定期更新服务器列表
-        self.schedule_server_list_update()
-        
-        self.window.protocol("WM_DELETE_WINDOW", self.on_closing)
-
-    def on_mode_change(self):
-        # 停止当前活动
-        self.network.stop()
-        self.update_ui_based_on_mode()
-
-    def update_ui_based_on_mode(self):
-        mode = self.mode_var.get()
-        
-        # 隐藏所有框架
-        self.server_frame.pack_forget()
-        self.client_frame.pack_forget()
-        
-        if mode == "server":
-            self.server_frame.pack(fill="x", padx=20, pady=10)
-            self.start_btn.config(text="启动服务")
-            self.server_info_text.config(text="")
-        elif mode == "client":
-            self.client_frame.pack(fill="x", padx=20, pady=10)
-            self.refresh_btn.config(text="搜索主机", state="normal")
-            self.select_btn.config(state="disabled")
-            self.server_list.delete(0, 'end')
-
-    def toggle_server(self):
-        if self.network.mode == "server" and self.network.running:
-            self.network.stop()
-            self.start_btn.config(text="启动服务")
-            self.server_info_text.config(text="服务已停止")
-        else:
-            name = self.name_entry.get().strip()
-            if not name:
-                messagebox.showerror("错误", "请输入主机名称")
-                return
-                
-            try:
-                port = int(self.port_entry.get().strip())
-                if port < 1 or port > 65535:
-                    raise ValueError
-            except:
-                messagebox.showerror("错误", "请输入有效的端口号 (1-65535)")
-                return
-                
-            self.network.start_server(name, port)
-            self.start_btn.config(text="停止服务")
-            info = f"IP: {self.network.server_info['ip']}\nMAC: {self.network.server_info['mac']}\n端口: {port}"
-            self.server_info_text.config(text=info)
-
-    def discover_servers(self):
-        self.server_list.delete(0, 'end')
-        self.refresh_btn.config(state="disabled", text="搜索中...")
-        self.select_btn.config(state="disabled")
-        
-        # 确保网络处于客户端模式
-        if self.network.mode != "client":
-            self.network.stop()
-            self.network.start_client()
-        
-        # 清空之前的服务器列表
-        self.network.discovered_servers = []
-
-    def update_server_list(self):
-        if self.network.mode != "client" or not self.network.running:
-            return
-            
-        servers = self.network.get_discovered_servers()
-        self.server_list.delete(0, 'end')
-        
-        for server in servers:
-            self.server_list.insert('end', 
-                f"{server['name']} | IP: {server['ip']} | MAC: {server['mac']} | 端口: {server['port']}")
-        
-        if servers:
-            self.select_btn.config(state="normal")
-            self.refresh_btn.config(state="normal", text="刷新列表")
-        else:
-            self.refresh_btn.config(state="normal", text="重新搜索")
-
-    def schedule_server_list_update(self):
-        if self.network.mode == "client" and self.network.running:
-            self.update_server_list()
-        self.window.after(2000, self.schedule_server_list_update)
-
-    def send_file(self):
-        selection = self.server_list.curselection()
-        if not selection:
-            messagebox.showwarning("提示", "请先选择一个主机")
-            return
-            
-        servers = self.network.get_discovered_servers()
-        if not servers or selection[0] >= len(servers):
-            messagebox.showwarning("提示", "所选主机已不可用")
-            return
-            
-        server = servers[selection[0]]
-        filepath = filedialog.askopenfilename(title="选择要发送的文件")
-        if not filepath:
-            return
-            
-        self.select_btn.config(state="disabled", text="发送中...")
-        threading.Thread(target=self._send_file, args=(server, filepath)).start()
-
-    def _send_file(self, server, filepath):
-        if self.network.send_file(server, filepath):
-            messagebox.showinfo("成功", "文件发送完成!")
-        self.select_btn.config(state="normal", text="选择文件并发送")
-
-    def on_closing(self):
-        self.network.stop()
-        self.window.destroy()
-
-    def run(self):
-        self.window.mainloop()
-
-
-if __name__ == "__main__":
-    app = FileTransferApp()
+import socket
+import sys
+import argparse
+import threading
+import queue
+import json
+import os
+import time
+import uuid
+import struct
+import hashlib
+import zlib
+import math
+import collections
+import bisect
+import itertools
+import random
+try:
+    from tkinter import Tk, Label, Entry, Button, Listbox, messagebox, filedialog, Frame, Radiobutton, StringVar, Checkbutton, BooleanVar, Toplevel, ttk
+except ImportError:
+    # 没有安装Tk的服务器上只能使用命令行模式
+    Tk = None
+
+# 每个连接开头是4字节长度前缀 + JSON头
+# 控制连接先发送offer（含文件清单），接收方回复已收到的数据块位图；数据连接发送type为data的头，
+# 之后是若干个 (序号, 标志, 原长度, 传输长度, SHA-256) + 数据 的数据块，以序号END_OF_STREAM结束。
+# 双方在offer中协商压缩方式，标志含FLAG_ZLIB时数据为zlib压缩后的内容，校验针对原数据。
+# 清单中的文件按顺序首尾相接视为一个连续数据流，数据块可以跨越多个小文件
+HEADER_LENGTH = struct.Struct('!I')
+MAX_HEADER_SIZE = 16 * 1024 * 1024
+CHUNK_HEADER = struct.Struct('!IBII32s')
+FLAG_ZLIB = 1
+END_OF_STREAM = 0xFFFFFFFF
+DEFAULT_STREAMS = 4           # 默认并行连接数
+MAX_STREAMS = 16
+CHUNK_SIZE = 1024 * 1024      # 数据块大小，也是读写及收发缓冲区大小
+MIN_STREAM_CHUNKS = 4         # 每个连接至少分到的数据块数
+SOCKET_BUFFER_SIZE = 4 * 1024 * 1024
+SEND_ROUNDS = 3               # 补发校验失败数据块的最大轮数
+MAX_OPEN_FILES = 8            # 每个连接同时打开的文件数上限
+STATE_SAVE_INTERVAL = 1.0     # 保存断点状态的间隔(秒)
+RESUME_STATE_FILE = os.path.join(os.path.expanduser("~"), ".lan_transfer_resume.json")
+STATS_FILE = os.path.join(os.path.expanduser("~"), ".lan_transfer_stats.json")
+STATS_WRITE_INTERVAL = 5      # 统计有变化时写出统计文件的间隔(秒)
+TRANSFER_STALL_THRESHOLD = 0.5  # 传输超过该时长(秒)没有进展时计入停顿时间
+TRANSFER_HISTORY_SIZE = 100   # 统计中保留的已结束传输数量
+LATENCY_SMOOTHING = 0.125     # 往返时延平滑系数，与TCP计算SRTT相同
+METRICS_REFRESH_INTERVAL = 1000  # 传输监控窗口的刷新间隔(毫秒)
+ACK_OK = b'\x01'
+DEFAULT_PORT = 5000
+LISTEN_BACKLOG = 128          # 等待接受的连接队列长度，应对多个发送方同时连接
+CONNECTION_WORKERS = 32       # 处理连接的线程数上限
+CONNECTION_QUEUE_SIZE = 128   # 排队等待处理的连接数上限，超出时直接关闭新连接
+MAX_ACTIVE_PER_PEER = MAX_STREAMS + 4  # 同一地址同时处理的连接数上限，超出的连接排队等待该地址的连接结束
+MAX_CONNECTIONS_PER_PEER = 4 * (MAX_STREAMS + 1)  # 同一地址处理中和排队的连接数上限，足够同时进行多次满并行发送
+MAX_ACTIVE_TRANSFERS = CONNECTION_WORKERS // 4  # 同时接收的传输数上限，控制连接占满线程时数据连接将无法处理
+CONNECTION_IDLE_TIMEOUT = 60  # 连接等待文件信息或数据块的超时(秒)
+NAMING_POLICIES = {           # 无人值守接收时与已有文件同名的处理方式
+    "rename": "自动改名",
+    "overwrite": "覆盖",
+    "skip": "拒绝接收",
+}
+DISCOVERY_PORT = 9999
+BEACON_MIN_INTERVAL = 1.0     # 服务启动后首次广播间隔(秒)，之后逐次加倍
+BEACON_MAX_INTERVAL = 30.0    # 广播间隔上限(秒)，新客户端通过DISCOVER查询即时获得单播回复
+BEACON_JITTER = 0.25          # 间隔随机抖动比例，避免多台主机同时广播
+BEACON_CACHE_SIZE = 256       # 缓存原始广播的地址数量上限，超出时淘汰最久未收到广播的地址
+COMPRESS_LEVEL = 1            # zlib最快档，压缩速度优先
+COMPRESS_MAX_RATIO = 0.9      # 压缩后仍超过原大小该比例时按原样发送
+COMPRESS_ENTROPY_LIMIT = 7.5  # 抽样熵(比特/字节)高于该值视为不可压缩
+COMPRESS_SAMPLE_SIZE = 4096
+# 本身已压缩的文件格式，直接按原样发送
+COMPRESSED_EXTENSIONS = {
+    '.zip', '.gz', '.tgz', '.bz2', '.xz', '.7z', '.rar', '.zst', '.lz4', '.cab', '.jar', '.apk',
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic', '.mp3', '.aac', '.ogg', '.flac', '.m4a',
+    '.mp4', '.mkv', '.avi', '.mov', '.wmv', '.webm', '.docx', '.xlsx', '.pptx', '.pdf', '.msi',
+}
+
+
+def recv_exact(sock, size):
+    """接收指定长度的数据，连接提前关闭时抛出异常"""
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("连接已断开")
+        data.extend(chunk)
+    return bytes(data)
+
+
+def send_header(sock, header):
+    """发送带长度前缀的JSON头"""
+    data = json.dumps(header).encode()
+    sock.sendall(HEADER_LENGTH.pack(len(data)) + data)
+
+
+def recv_header(sock):
+    """接收带长度前缀的JSON头"""
+    size, = HEADER_LENGTH.unpack(recv_exact(sock, HEADER_LENGTH.size))
+    if size > MAX_HEADER_SIZE:
+        raise ValueError("文件信息过大")
+    return json.loads(recv_exact(sock, size).decode())
+
+
+def split_chunks(chunks, streams):
+    """把待发送的数据块序号切分为最多streams段连续的列表"""
+    streams = max(1, min(streams, len(chunks) // MIN_STREAM_CHUNKS or 1))
+    base, extra = divmod(len(chunks), streams)
+    parts = []
+    start = 0
+    for i in range(streams):
+        end = start + base + (1 if i < extra else 0)
+        parts.append(chunks[start:end])
+        start = end
+    return parts
+
+
+def build_manifest(paths):
+    """把选择的文件和文件夹展开为清单 [(相对路径, 本地路径, 大小), ...]，相对路径以/分隔，
+    顶层重名的项目自动加后缀"""
+    entries = []
+    used = set()
+    for path in paths:
+        path = os.path.abspath(path)
+        top = os.path.basename(path)
+        base, ext = os.path.splitext(top)
+        counter = 1
+        while top in used:
+            top = f"{base}_{counter}{ext}"
+            counter += 1
+        used.add(top)
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    full = os.path.join(root, name)
+                    relpath = os.path.relpath(full, path).replace(os.sep, '/')
+                    entries.append((f"{top}/{relpath}", full, os.path.getsize(full)))
+        else:
+            entries.append((top, path, os.path.getsize(path)))
+    return entries
+
+
+def make_transfer_id(entries):
+    """根据各文件的路径、大小和修改时间生成传输ID，内容不变时重新发送可以续传"""
+    h = hashlib.sha256()
+    for relpath, path, size in entries:
+        h.update(f"{relpath}|{path}|{size}|{os.stat(path).st_mtime_ns}\n".encode('utf-8'))
+    return h.hexdigest()[:32]
+
+
+def safe_relpath(relpath):
+    """校验对方发来的相对路径，防止写到保存目录之外"""
+    parts = relpath.split('/')
+    if any(part in ('', '.', '..') or ':' in part or '\\' in part for part in parts):
+        raise ValueError(f"非法的文件路径: {relpath}")
+    return os.path.join(*parts)
+
+
+class BatchLayout:
+    """清单中的文件按顺序首尾相接，把连续数据流中的位置映射到具体文件"""
+    def __init__(self, sizes):
+        self.sizes = sizes
+        self.starts = list(itertools.accumulate([0] + sizes[:-1]))
+        self.total = sum(sizes)
+
+    def locate(self, offset, length):
+        """返回 [(文件序号, 文件内偏移, 长度), ...]，自动跳过空文件"""
+        pieces = []
+        i = bisect.bisect_right(self.starts, offset) - 1
+        while length > 0:
+            n = min(length, self.sizes[i] - (offset - self.starts[i]))
+            if n > 0:
+                pieces.append((i, offset - self.starts[i], n))
+                offset += n
+                length -= n
+            i += 1
+        return pieces
+
+
+def open_piece(handles, index, path, mode):
+    """取得分段所在文件的句柄，打开文件过多时关闭已用过的"""
+    f = handles.get(index)
+    if f is None:
+        if len(handles) >= MAX_OPEN_FILES:
+            for old in handles.values():
+                old.close()
+            handles.clear()
+        f = handles[index] = open(path, mode)
+    return f
+
+
+def estimate_entropy(data):
+    """估算数据中间一段的字节熵(比特/字节)，用于快速判断是否值得压缩"""
+    start = max(0, len(data) // 2 - COMPRESS_SAMPLE_SIZE // 2)
+    sample = bytes(data[start:start + COMPRESS_SAMPLE_SIZE])
+    if not sample:
+        return 0.0
+    n = len(sample)
+    return -sum(c / n * math.log2(c / n) for c in collections.Counter(sample).values())
+
+
+def is_compressed_name(name):
+    return os.path.splitext(name)[1].lower() in COMPRESSED_EXTENSIONS
+
+
+def jittered(interval):
+    return interval * random.uniform(1 - BEACON_JITTER, 1 + BEACON_JITTER)
+
+
+def chunk_count(size):
+    return (size + CHUNK_SIZE - 1) // CHUNK_SIZE
+
+
+def missing_chunks(bitmap, count):
+    """返回位图中未收到的数据块序号"""
+    return [i for i in range(count) if i >> 3 >= len(bitmap) or not bitmap[i >> 3] >> (i & 7) & 1]
+
+
+def tune_socket(sock):
+    """调大收发缓冲区并关闭Nagle"""
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except:
+        pass
+
+
+def messagebox_notify(level, title, text):
+    """图形界面模式：用消息框提示"""
+    if level == "error":
+        messagebox.showerror(title, text)
+    else:
+        messagebox.showinfo(title, text)
+
+
+def console_notify(level, title, text):
+    """命令行模式：带时间输出到终端，错误输出到stderr"""
+    print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] {title}: {text}",
+          file=sys.stderr if level == "error" else sys.stdout, flush=True)
+
+
+def format_speed(size, seconds):
+    """格式化传输速度"""
+    speed = size / max(seconds, 1e-6)
+    if speed >= 1024 * 1024:
+        return f"{speed / 1024 / 1024:.1f} MB/s"
+    return f"{speed / 1024:.1f} KB/s"
+
+
+class TransferMetrics:
+    """传输和时延统计：每次传输的字节数、用时、速度、停顿时间和重试次数，以及各主机的往返时延
+    没有心跳，发送方以建立数据连接的耗时（一次往返）作为时延样本；各线程共用，内部加锁"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.active = {}
+        self.finished = collections.deque(maxlen=TRANSFER_HISTORY_SIZE)
+        self.latency = {}
+        self.totals = {'sent_bytes': 0, 'received_bytes': 0, 'completed': 0, 'failed': 0}
+        # 每次更新加一，写统计文件的线程据此判断是否有变化
+        self.changes = 0
+
+    def start(self, peer, name, direction, total):
+        """开始统计一次传输，direction为send或receive，返回统计编号"""
+        now = time.time()
+        with self.lock:
+            metrics_id = next(self.ids)
+            self.active[metrics_id] = {
+                'id': metrics_id, 'peer': peer, 'name': name, 'direction': direction,
+                'total': total, 'bytes': 0, 'wire_bytes': 0, 'start': now, 'last_progress': now,
+                'stall': 0.0, 'retries': 0
+            }
+            self.changes += 1
+        return metrics_id
+
+    def progress(self, metrics_id, raw_bytes, wire_bytes):
+        """记录传输进展，距上次进展超过阈值的间隔计入停顿时间"""
+        now = time.time()
+        with self.lock:
+            transfer = self.active.get(metrics_id)
+            if not transfer:
+                return
+            gap = now - transfer['last_progress']
+            if gap >= TRANSFER_STALL_THRESHOLD:
+                transfer['stall'] += gap
+            transfer['last_progress'] = now
+            transfer['bytes'] += raw_bytes
+            transfer['wire_bytes'] += wire_bytes
+            self.changes += 1
+
+    def retry(self, metrics_id):
+        with self.lock:
+            if metrics_id in self.active:
+                self.active[metrics_id]['retries'] += 1
+                self.changes += 1
+
+    def finish(self, metrics_id, error=None):
+        """结束统计，error为空表示成功"""
+        now = time.time()
+        with self.lock:
+            transfer = self.active.pop(metrics_id, None)
+            if not transfer:
+                return
+            self.describe(transfer, now)
+            transfer['end'] = now
+            transfer['error'] = error or ''
+            self.finished.appendleft(transfer)
+            self.totals['sent_bytes' if transfer['direction'] == 'send' else 'received_bytes'] += transfer['bytes']
+            self.totals['failed' if error else 'completed'] += 1
+            self.changes += 1
+
+    def record_latency(self, ip, name, rtt):
+        """记录一次往返时延(秒)"""
+        with self.lock:
+            entry = self.latency.get(ip)
+            if entry is None:
+                self.latency[ip] = {'name': name, 'last': rtt, 'smoothed': rtt, 'min': rtt, 'max': rtt, 'samples': 1}
+            else:
+                entry['name'] = name
+                entry['last'] = rtt
+                entry['smoothed'] += LATENCY_SMOOTHING * (rtt - entry['smoothed'])
+                entry['min'] = min(entry['min'], rtt)
+                entry['max'] = max(entry['max'], rtt)
+                entry['samples'] += 1
+            self.changes += 1
+
+    @staticmethod
+    def describe(transfer, now):
+        """补充用时、平均速度和截至当前的停顿时间"""
+        gap = now - transfer['last_progress']
+        if gap >= TRANSFER_STALL_THRESHOLD:
+            transfer['stall'] += gap
+            transfer['last_progress'] = now
+        transfer['duration'] = now - transfer['start']
+        transfer['speed'] = transfer['bytes'] / max(transfer['duration'], 1e-6)
+        return transfer
+
+    def snapshot(self):
+        """返回统计数据的副本"""
+        now = time.time()
+        with self.lock:
+            return {
+                'time': now,
+                'active': [self.describe(dict(transfer), now) for transfer in self.active.values()],
+                'finished': [dict(transfer) for transfer in self.finished],
+                'latency': {ip: dict(entry) for ip, entry in self.latency.items()},
+                'totals': dict(self.totals)
+            }
+
+    def write(self, path):
+        """把快照原子写入统计文件，排查传输慢的问题时可以直接读取"""
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.snapshot(), f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, path)
+
+
+class TransferRefused(Exception):
+    """接收方拒绝本次传输，异常消息作为原因回复给发送方"""
+
+
+class ConnectionPool:
+    """有上限的连接处理线程池：线程全忙时新连接排队；同一地址同时处理的连接过多时，
+    新连接等到该地址的连接结束后再处理。排队总数或同一地址的连接总数超过上限时直接关闭，
+    连接突增时服务仍然可用"""
+    def __init__(self, handler, workers=CONNECTION_WORKERS, queue_size=CONNECTION_QUEUE_SIZE,
+                 active_per_peer=MAX_ACTIVE_PER_PEER, per_peer=MAX_CONNECTIONS_PER_PEER):
+        self.handler = handler
+        self.queue_size = queue_size
+        self.active_per_peer = active_per_peer
+        self.per_peer = per_peer
+        self.queue = queue.Queue()
+        self.waiting = 0  # 排队等待线程和等待同一地址名额的连接数
+        self.active = collections.Counter()  # IP -> 占用名额(排队等待线程或处理中)的连接数
+        self.deferred = {}  # IP -> 等待名额的连接
+        self.lock = threading.Lock()
+        self.workers = []
+        for _ in range(workers):
+            t = threading.Thread(target=self._work, daemon=True)
+            t.start()
+            self.workers.append(t)
+
+    def submit(self, client, addr):
+        """交给线程池处理，无法接纳时关闭连接并返回False"""
+        ip = addr[0]
+        with self.lock:
+            deferred = self.deferred.get(ip, ())
+            admitted = self.waiting < self.queue_size and self.active[ip] + len(deferred) < self.per_peer
+            if admitted:
+                self.waiting += 1
+                if self.active[ip] < self.active_per_peer:
+                    self.active[ip] += 1
+                    self.queue.put((client, ip))
+                else:
+                    self.deferred.setdefault(ip, collections.deque()).append(client)
+        if not admitted:
+            print(f"连接过多，拒绝来自 {ip} 的连接")
+            client.close()
+        return admitted
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            client, ip = item
+            with self.lock:
+                self.waiting -= 1
+            try:
+                self.handler(client)
+            finally:
+                with self.lock:
+                    deferred = self.deferred.get(ip)
+                    if deferred:
+                        # 名额交给同一地址等待中的下一个连接
+                        self.queue.put((deferred.popleft(), ip))
+                        if not deferred:
+                            del self.deferred[ip]
+                    else:
+                        self.active[ip] -= 1
+                        if not self.active[ip]:
+                            del self.active[ip]
+
+    def shutdown(self):
+        """关闭排队中的连接并让线程在处理完当前连接后退出"""
+        with self.lock:
+            for deferred in self.deferred.values():
+                for client in deferred:
+                    client.close()
+            self.deferred.clear()
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item:
+                item[0].close()
+        for _ in self.workers:
+            self.queue.put(None)
+
+
+class NetworkManager:
+    """save_dir为空时由用户选择每次接收的保存位置，否则无人值守地保存到该目录，同名时按naming处理；
+    notify(级别, 标题, 内容)用于报告传输结果，图形界面用消息框，命令行输出到终端"""
+    def __init__(self, save_dir=None, naming="rename", notify=messagebox_notify):
+        self.save_dir = save_dir
+        self.naming = naming
+        self.notify = notify
+        # 无人值守接收时选择保存路径和创建临时文件互斥，避免同时到达的同名传输选到同一路径
+        self.naming_lock = threading.Lock()
+        # 无人值守接收时正在接收的顶层文件或文件夹路径，覆盖模式下同名的传输也不能共用临时文件
+        self.receiving_names = set()
+        self.running = False
+        self.tcp_server = None
+        self.connection_pool = None
+        self.udp_broadcast = None
+        self.udp_listener = None
+        self.mode = "none"  # "server", "client", or "none"
+        self.server_info = {}
+        self.discovered_servers = []
+        self.lock = threading.Lock()
+        # 客户端发现状态：各地址最近一次收到的原始广播，相同内容不再解析，按最近收到顺序排列
+        self.beacon_cache = collections.OrderedDict()
+        self.discover_interval = BEACON_MIN_INTERVAL
+        self.next_discover = 0
+        # 正在接收的传输：transfer_id -> 状态
+        self.transfers = {}
+        self.transfers_lock = threading.Lock()
+        # 断点状态文件的读写锁
+        self.resume_lock = threading.Lock()
+        # 传输和时延统计，有变化时定期写入统计文件
+        self.metrics = TransferMetrics()
+        threading.Thread(target=self._write_stats_loop, daemon=True).start()
+
+    def get_local_ip(self):
+        try:
+            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            s.connect(("8.8.8.8", 80))
+            ip = s.getsockname()[0]
+            s.close()
+            return ip
+        except:
+            return "127.0.0.1"
+
+    def get_mac_address(self):
+        mac = uuid.getnode()
+        return ':'.join(("%012X" % mac)[i:i+2] for i in range(0, 12, 2))
+
+    def start_server(self, name, port=DEFAULT_PORT):
+        self.mode = "server"
+        self.running = True
+        self.server_info = {
+            "name": name,
+            "ip": self.get_local_ip(),
+            "mac": self.get_mac_address(),
+            "port": port,
+            # 服务信息的版本号，每次启动服务时更新
+            "version": int(time.time())
+        }
+        
+        # 启动TCP文件服务器，端口被占用时直接报告，不再广播
+        try:
+            self.tcp_server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.tcp_server.bind(('0.0.0.0', port))
+            self.tcp_server.listen(LISTEN_BACKLOG)
+        except OSError as e:
+            self.running = False
+            self.notify("error", "错误", f"无法启动服务: {e}")
+            return False
+        self.connection_pool = ConnectionPool(self._handle_client)
+        threading.Thread(target=self._start_tcp_server, daemon=True).start()
+        # 启动广播服务
+        threading.Thread(target=self._broadcast_presence, daemon=True).start()
+        return True
+
+    def _start_tcp_server(self):
+        while self.running:
+            try:
+                client, addr = self.tcp_server.accept()
+                self.connection_pool.submit(client, addr)
+            except:
+                break
+
+    def _handle_client(self, client):
+        try:
+            tune_socket(client)
+            # 迟迟不发送数据的连接不能一直占用处理线程
+            client.settimeout(CONNECTION_IDLE_TIMEOUT)
+            # 接收文件信息
+            header = recv_header(client)
+            if header.get('type') == 'offer':
+                self._handle_offer(client, header)
+            elif header.get('type') == 'data':
+                self._handle_data(client, header)
+        except Exception as e:
+            print(f"连接处理错误: {e}")
+        finally:
+            client.close()
+
+    def _handle_offer(self, client, file_info):
+        """控制连接：回复已收到的数据块，每轮发送结束后检查是否收齐"""
+        transfer = None
+        transfer_id = file_info.get('transfer_id')
+        with self.transfers_lock:
+            # 同一批文件被同时重复发送时只接收一份，先占位再选择保存位置
+            if transfer_id in self.transfers:
+                busy = "相同的文件正在接收中"
+            elif len(self.transfers) >= MAX_ACTIVE_TRANSFERS:
+                busy = "对方正在接收的文件过多，请稍后重试"
+            else:
+                busy = None
+                self.transfers[transfer_id] = None
+        try:
+            if busy:
+                send_header(client, {"accepted": False, "reason": busy})
+                return
+            try:
+                transfer = self._open_transfer(file_info)
+            except TransferRefused as e:
+                print(f"拒绝接收 {file_info['name']}: {e}")
+                send_header(client, {"accepted": False, "reason": str(e)})
+                return
+            if not transfer:
+                send_header(client, {"accepted": False})
+                return
+            # 每轮数据发送期间控制连接保持空闲，时长取决于文件大小
+            client.settimeout(None)
+            transfer['metrics_id'] = self.metrics.start(client.getpeername()[0], transfer['name'], 'receive',
+                                                        transfer['filesize'])
+            # 对方提供的压缩方式中选择本机支持的
+            compression = "zlib" if "zlib" in file_info.get('compression', []) else ""
+            send_header(client, {"accepted": True, "received": transfer['received'].hex(),
+                                 "compression": compression})
+            
+            count = chunk_count(transfer['filesize'])
+            while True:
+                if recv_header(client).get('type') != 'done':
+                    continue
+                with transfer['lock']:
+                    received = bytes(transfer['received'])
+                if missing_chunks(received, count):
+                    self._save_resume_state(transfer)
+                    self.metrics.retry(transfer['metrics_id'])
+                    send_header(client, {"complete": False, "received": received.hex()})
+                    continue
+                
+                # 全部收齐后替换为最终文件
+                for target in transfer['targets']:
+                    os.replace(target + ".part", target)
+                self._remove_resume_state(transfer['id'])
+                send_header(client, {"complete": True})
+                transfer['finished'] = True
+                self.metrics.finish(transfer['metrics_id'])
+                elapsed = time.time() - transfer['start_time']
+                self.notify("info", "成功", f"{transfer['name']} 接收完成!\n"
+                            f"用时 {elapsed:.1f} 秒，平均速度 {format_speed(transfer['bytes_received'], elapsed)}")
+                return
+        except Exception as e:
+            if transfer:
+                self.metrics.finish(transfer['metrics_id'], str(e))
+                self.notify("error", "错误", f"文件接收中断: {str(e)}\n对方重新发送时将从中断处继续")
+            else:
+                self.notify("error", "错误", f"文件接收失败: {str(e)}")
+        finally:
+            if not busy:
+                with self.transfers_lock:
+                    self.transfers.pop(transfer_id, None)
+            if transfer:
+                with self.naming_lock:
+                    self.receiving_names.difference_update(transfer['reserved'])
+                if not transfer['finished']:
+                    self._save_resume_state(transfer)
+
+    def _open_transfer(self, file_info):
+        """按传输ID恢复上次中断的接收，否则选择保存位置并新建临时文件"""
+        transfer_id = file_info['transfer_id']
+        files = [[relpath, int(size)] for relpath, size in file_info['files']]
+        relpaths = [safe_relpath(relpath) for relpath, size in files]
+        sizes = [size for relpath, size in files]
+        layout = BatchLayout(sizes)
+        if not files or file_info.get('chunk_size') != CHUNK_SIZE or layout.total != file_info['filesize']:
+            raise ValueError("文件信息不一致")
+        
+        targets = None
+        received = None
+        reserved = set()
+        # 无人值守接收时断点状态的检查和保存路径的占用在同一个锁内完成，避免与同名的覆盖接收交错
+        with self.naming_lock:
+            with self.resume_lock:
+                saved = self._load_resume_states().get(transfer_id)
+            try:
+                if saved and saved['files'] == files and all(
+                        os.path.getsize(target + ".part") == size for target, size in zip(saved['targets'], sizes)):
+                    targets = saved['targets']
+                    received = bytearray.fromhex(saved['received'])
+            except:
+                pass
+            
+            if self.save_dir:
+                if not targets:
+                    targets = self._drop_targets(relpaths)
+                    # 覆盖了未完成接收的临时文件时，原来的断点状态已失效
+                    self._discard_resume_states(targets)
+                    self._create_part_files(targets, sizes)
+                    received = bytearray((chunk_count(layout.total) + 7) // 8)
+                # 接收完成或中断前占用这些名称
+                reserved = {os.path.join(self.save_dir, os.path.relpath(target, self.save_dir).split(os.sep)[0])
+                            for target in targets}
+                self.receiving_names.update(reserved)
+        
+        if not targets:
+            # 选择保存位置：单个文件选择文件名，多个文件或文件夹选择保存目录
+            if len(files) == 1 and os.sep not in relpaths[0]:
+                save_path = filedialog.asksaveasfilename(
+                    initialfile=relpaths[0],
+                    title="保存文件",
+                    filetypes=(("所有文件", "*.*"),)
+                )
+                targets = [save_path] if save_path else None
+            else:
+                save_dir = filedialog.askdirectory(
+                    title=f"选择保存位置: {file_info['name']} (共 {len(files)} 个文件)")
+                targets = [os.path.join(save_dir, relpath) for relpath in relpaths] if save_dir else None
+            if not targets:
+                return None
+            self._create_part_files(targets, sizes)
+            received = bytearray((chunk_count(layout.total) + 7) // 8)
+        
+        transfer = {
+            'id': transfer_id,
+            'name': file_info['name'],
+            'files': files,
+            'filesize': layout.total,
+            'layout': layout,
+            'targets': targets,
+            'received': received,
+            'lock': threading.Lock(),
+            'bytes_received': 0,
+            'last_save': time.time(),
+            'start_time': time.time(),
+            'finished': False,
+            'metrics_id': None,
+            'reserved': reserved
+        }
+        with self.transfers_lock:
+            self.transfers[transfer_id] = transfer
+        self._save_resume_state(transfer)
+        return transfer
+
+    def _drop_targets(self, relpaths):
+        """无人值守接收：在接收目录中确定各文件的保存路径，顶层项目与已有文件或未完成的接收同名时
+        按命名策略改名或覆盖，无法接收时抛出TransferRefused；正在接收中的名称任何策略下都不会覆盖
+        （调用方持有naming_lock）"""
+        renamed = {}
+        for relpath in relpaths:
+            top = relpath.split(os.sep)[0]
+            if top in renamed:
+                continue
+            base, ext = os.path.splitext(top)
+            name = top
+            counter = 1
+            while True:
+                path = os.path.join(self.save_dir, name)
+                if path in self.receiving_names:
+                    conflict = "同名文件正在接收中"
+                elif self.naming != "overwrite" and (os.path.exists(path) or os.path.exists(path + ".part")):
+                    conflict = "已存在同名文件"
+                else:
+                    break
+                if self.naming != "rename":
+                    raise TransferRefused(conflict)
+                name = f"{base} ({counter}){ext}"
+                counter += 1
+            renamed[top] = name
+        return [os.path.join(self.save_dir, renamed[relpath.split(os.sep)[0]], *relpath.split(os.sep)[1:])
+                for relpath in relpaths]
+
+    def _discard_resume_states(self, targets):
+        """删除使用了这些保存路径的断点状态"""
+        targets = set(targets)
+        try:
+            with self.resume_lock:
+                states = self._load_resume_states()
+                stale = [file_id for file_id, state in states.items() if targets.intersection(state['targets'])]
+                for file_id in stale:
+                    del states[file_id]
+                if stale:
+                    self._write_resume_states(states)
+        except Exception as e:
+            print(f"删除断点状态失败: {e}")
+
+    def _create_part_files(self, targets, sizes):
+        """预先设置各文件大小，各数据连接再各自定位写入"""
+        for target, size in zip(targets, sizes):
+            os.makedirs(os.path.dirname(target) or '.', exist_ok=True)
+            with open(target + ".part", 'wb') as f:
+                f.truncate(size)
+
+    def _handle_data(self, client, header):
+        """数据连接：校验每个数据块后写入对应文件的对应位置，每个连接使用独立的文件句柄"""
+        with self.transfers_lock:
+            transfer = self.transfers.get(header.get('transfer_id'))
+        if not transfer:
+            raise ValueError("未知的传输")
+        
+        filesize = transfer['filesize']
+        count = chunk_count(filesize)
+        buffer = bytearray(CHUNK_SIZE)
+        view = memoryview(buffer)
+        handles = {}
+        try:
+            while True:
+                index, flags, length, wire_length, digest = CHUNK_HEADER.unpack(recv_exact(client, CHUNK_HEADER.size))
+                if index == END_OF_STREAM:
+                    break
+                if (index >= count or length != min(CHUNK_SIZE, filesize - index * CHUNK_SIZE)
+                        or wire_length > length):
+                    raise ValueError(f"无效的数据块 {index}")
+                
+                received = 0
+                while received < wire_length:
+                    n = client.recv_into(view[received:wire_length])
+                    if not n:
+                        raise ConnectionError("连接已断开")
+                    received += n
+                
+                if flags & FLAG_ZLIB:
+                    data = self._decompress_chunk(view[:wire_length], length)
+                else:
+                    data = view[:length]
+                
+                # 校验失败的数据块不记录，由发送方下一轮补发
+                if data is None or hashlib.sha256(data).digest() != digest:
+                    print(f"数据块 {index} 校验失败")
+                    continue
+                pos = 0
+                data = memoryview(data)
+                for i, file_offset, n in transfer['layout'].locate(index * CHUNK_SIZE, length):
+                    f = open_piece(handles, i, transfer['targets'][i] + ".part", 'r+b')
+                    f.seek(file_offset)
+                    f.write(data[pos:pos + n])
+                    f.flush()
+                    pos += n
+                
+                self.metrics.progress(transfer['metrics_id'], length, wire_length)
+                with transfer['lock']:
+                    transfer['received'][index >> 3] |= 1 << (index & 7)
+                    transfer['bytes_received'] += length
+                    save = time.time() - transfer['last_save'] >= STATE_SAVE_INTERVAL
+                    if save:
+                        transfer['last_save'] = time.time()
+                if save:
+                    self._save_resume_state(transfer)
+        finally:
+            for f in handles.values():
+                f.close()
+        client.sendall(ACK_OK)
+
+    def _decompress_chunk(self, data, length):
+        """解压一个数据块，长度不符或数据损坏时返回None"""
+        try:
+            decompressor = zlib.decompressobj()
+            raw = decompressor.decompress(data, length)
+            if len(raw) != length or decompressor.unconsumed_tail or not decompressor.eof:
+                return None
+            return raw
+        except zlib.error:
+            return None
+
+    def _write_stats_loop(self):
+        """统计有变化时定期写出统计文件"""
+        written = 0
+        while True:
+            time.sleep(STATS_WRITE_INTERVAL)
+            changes = self.metrics.changes
+            if changes == written:
+                continue
+            try:
+                self.metrics.write(STATS_FILE)
+                written = changes
+            except Exception as e:
+                print(f"保存统计文件失败: {e}")
+
+    def _load_resume_states(self):
+        """读取所有未完成接收的断点状态：文件ID -> 状态"""
+        try:
+            with open(RESUME_STATE_FILE, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except:
+            return {}
+
+    def _write_resume_states(self, states):
+        tmp_path = RESUME_STATE_FILE + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(states, f, ensure_ascii=False)
+        os.replace(tmp_path, RESUME_STATE_FILE)
+
+    def _save_resume_state(self, transfer):
+        """保存一个传输的断点状态，只记录已写入文件的数据块"""
+        try:
+            with transfer['lock']:
+                received = transfer['received'].hex()
+            with self.resume_lock:
+                states = self._load_resume_states()
+                states[transfer['id']] = {
+                    "files": transfer['files'],
+                    "targets": transfer['targets'],
+                    "received": received
+                }
+                self._write_resume_states(states)
+        except Exception as e:
+            print(f"保存断点状态失败: {e}")
+
+    def _remove_resume_state(self, file_id):
+        try:
+            with self.resume_lock:
+                states = self._load_resume_states()
+                if states.pop(file_id, None) is not None:
+                    self._write_resume_states(states)
+        except Exception as e:
+            print(f"删除断点状态失败: {e}")
+
+    def _broadcast_presence(self):
+        """广播服务信息，间隔从BEACON_MIN_INTERVAL逐次加倍到上限；收到DISCOVER查询时单播回复"""
+        self.udp_broadcast = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp_broadcast.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        self.udp_broadcast.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.udp_broadcast.bind(('', DISCOVERY_PORT))
+        
+        data = json.dumps(self.server_info).encode()
+        interval = BEACON_MIN_INTERVAL
+        next_beacon = 0
+        while self.running:
+            now = time.monotonic()
+            if now >= next_beacon:
+                try:
+                    self.udp_broadcast.sendto(data, ('<broadcast>', DISCOVERY_PORT))
+                except OSError as e:
+                    print(f"广播失败: {e}")
+                next_beacon = now + jittered(interval)
+                interval = min(interval * 2, BEACON_MAX_INTERVAL)
+            
+            try:
+                self.udp_broadcast.settimeout(max(0.05, next_beacon - now))
+                request, addr = self.udp_broadcast.recvfrom(1024)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            if request == b"DISCOVER":
+                try:
+                    self.udp_broadcast.sendto(data, addr)
+                except OSError as e:
+                    print(f"回复发现请求失败: {e}")
+
+    def start_client(self):
+        self.mode = "client"
+        self.running = True
+        # 启动服务器发现
+        threading.Thread(target=self._discover_servers, daemon=True).start()
+
+    def request_discovery(self):
+        """立即重新发送发现请求，并从最短间隔重新开始退避"""
+        self.beacon_cache.clear()
+        self.discover_interval = BEACON_MIN_INTERVAL
+        self.next_discover = 0
+
+    def _discover_servers(self):
+        self.udp_listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp_listener.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        self.udp_listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.udp_listener.bind(('', DISCOVERY_PORT))
+        self.request_discovery()
+        
+        while self.running:
+            # 发现请求的间隔逐次加倍，服务端会单播回复，之后依靠其周期广播
+            now = time.monotonic()
+            if now >= self.next_discover:
+                try:
+                    self.udp_listener.sendto(b"DISCOVER", ('<broadcast>', DISCOVERY_PORT))
+                except OSError as e:
+                    print(f"发送发现请求失败: {e}")
+                self.next_discover = now + jittered(self.discover_interval)
+                self.discover_interval = min(self.discover_interval * 2, BEACON_MAX_INTERVAL)
+            
+            try:
+                self.udp_listener.settimeout(max(0.05, self.next_discover - now))
+                data, addr = self.udp_listener.recvfrom(1024)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            
+            # 忽略发现请求和与上次内容相同的广播
+            if data == b"DISCOVER":
+                continue
+            if self.beacon_cache.get(addr[0]) == data:
+                self.beacon_cache.move_to_end(addr[0])
+                continue
+            try:
+                server_info = json.loads(data.decode())
+                server_info['addr'] = addr[0]
+                
+                with self.lock:
+                    # 已存在相同服务器时更新其信息
+                    for i, s in enumerate(self.discovered_servers):
+                        if s['ip'] == server_info['ip'] and s['port'] == server_info['port']:
+                            self.discovered_servers[i] = server_info
+                            break
+                    else:
+                        self.discovered_servers.append(server_info)
+                self.cache_beacon(addr[0], data)
+            except:
+                continue
+
+    def cache_beacon(self, ip, data):
+        """记录该地址最近一次的原始广播，超出上限时淘汰最久未收到广播的地址"""
+        self.beacon_cache[ip] = data
+        self.beacon_cache.move_to_end(ip)
+        while len(self.beacon_cache) > BEACON_CACHE_SIZE:
+            self.beacon_cache.popitem(last=False)
+
+    def get_discovered_servers(self):
+        with self.lock:
+            return self.discovered_servers.copy()
+
+    def send_files(self, server, paths, streams=DEFAULT_STREAMS, compress=True):
+        """发送文件或文件夹：全部文件作为一个连续数据流，只发送对方缺少的数据块，
+        并通过多个连接并行发送，成功时返回传输统计"""
+        ctrl = None
+        metrics_id = None
+        try:
+            entries = build_manifest(paths)
+            if not entries:
+                raise Exception("没有可发送的文件")
+            transfer_id = make_transfer_id(entries)
+            filesize = sum(size for relpath, path, size in entries)
+            count = chunk_count(filesize)
+            if len(entries) == 1:
+                name = entries[0][0]
+            else:
+                name = f"{os.path.basename(os.path.abspath(paths[0]))} 等 {len(entries)} 个文件"
+            
+            # 通过控制连接一次发送整个清单，对方回复已收到的数据块
+            ctrl = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            ctrl.connect((server['ip'], server['port']))
+            send_header(ctrl, {
+                "type": "offer",
+                "transfer_id": transfer_id,
+                "name": name,
+                "files": [[relpath, size] for relpath, path, size in entries],
+                "filesize": filesize,
+                "chunk_size": CHUNK_SIZE,
+                "compression": ["zlib"] if compress else []
+            })
+            reply = recv_header(ctrl)
+            if not reply.get('accepted'):
+                raise Exception(reply.get('reason') or "对方拒绝接收")
+            received = bytearray.fromhex(reply['received'])
+            compress = reply.get('compression') == "zlib"
+            
+            metrics_id = self.metrics.start(server['name'], name, 'send', filesize)
+            start_time = time.time()
+            resumed = count - len(missing_chunks(received, count))
+            sent_bytes = 0
+            wire_bytes = 0
+            used_streams = 0
+            for round_no in range(SEND_ROUNDS):
+                if round_no:
+                    self.metrics.retry(metrics_id)
+                chunks = missing_chunks(received, count)
+                if chunks:
+                    parts = split_chunks(chunks, streams)
+                    used_streams = max(used_streams, len(parts))
+                    raw, wire = self._send_chunks(server, entries, transfer_id, parts, compress, metrics_id)
+                    sent_bytes += raw
+                    wire_bytes += wire
+                
+                # 每轮结束后由对方检查是否收齐，未收齐则补发校验失败的数据块
+                send_header(ctrl, {"type": "done"})
+                reply = recv_header(ctrl)
+                if reply.get('complete'):
+                    break
+                received = bytearray.fromhex(reply['received'])
+            else:
+                raise Exception("多次补发后数据仍不完整")
+            
+            elapsed = time.time() - start_time
+            self.metrics.finish(metrics_id)
+            return {"files": len(entries), "filesize": filesize, "sent": sent_bytes, "wire": wire_bytes,
+                    "elapsed": elapsed, "streams": used_streams, "resumed": min(resumed * CHUNK_SIZE, filesize),
+                    "ratio": wire_bytes / sent_bytes if sent_bytes else 1.0,
+                    "speed": format_speed(sent_bytes, elapsed), "wire_speed": format_speed(wire_bytes, elapsed)}
+        except Exception as e:
+            self.metrics.finish(metrics_id, str(e))
+            self.notify("error", "错误", f"文件发送失败: {str(e)}\n重新发送同一文件时将从中断处继续")
+            return None
+        finally:
+            if ctrl:
+                ctrl.close()
+
+    def _send_chunks(self, server, entries, transfer_id, parts, compress, metrics_id):
+        """每段数据块使用一个连接并行发送，返回 (原始字节数, 实际发送字节数)"""
+        layout = BatchLayout([size for relpath, path, size in entries])
+        # 全部来自已压缩格式文件的数据块不尝试压缩
+        compressible = [compress and not is_compressed_name(relpath) for relpath, path, size in entries]
+        errors = []
+        sent = [[0, 0] for _ in parts]
+        threads = []
+        for i, chunks in enumerate(parts):
+            t = threading.Thread(target=self._send_range,
+                                 args=(server, entries, layout, compressible, transfer_id, chunks, errors, sent[i],
+                                       metrics_id),
+                                 daemon=True)
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+        if errors:
+            raise Exception(errors[0])
+        return sum(raw for raw, wire in sent), sum(wire for raw, wire in sent)
+
+    def _send_range(self, server, entries, layout, compressible, transfer_id, chunks, errors, sent, metrics_id):
+        """通过一个连接发送一段数据块，每块附带序号和SHA-256校验并按需压缩，小文件连续打包不再逐个握手"""
+        s = None
+        handles = {}
+        try:
+            # 连接到服务器，建立连接的耗时约为一次往返，作为时延样本
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            tune_socket(s)
+            connect_start = time.perf_counter()
+            s.connect((server['ip'], server['port']))
+            self.metrics.record_latency(server['ip'], server['name'], time.perf_counter() - connect_start)
+            send_header(s, {"type": "data", "transfer_id": transfer_id})
+            
+            buffer = bytearray(CHUNK_HEADER.size + CHUNK_SIZE)
+            view = memoryview(buffer)
+            data = view[CHUNK_HEADER.size:]
+            for index in chunks:
+                offset = index * CHUNK_SIZE
+                length = min(CHUNK_SIZE, layout.total - offset)
+                pos = 0
+                try_compress = False
+                for i, file_offset, n in layout.locate(offset, length):
+                    f = open_piece(handles, i, entries[i][1], 'rb')
+                    f.seek(file_offset)
+                    if f.readinto(data[pos:pos + n]) != n:
+                        raise IOError("文件在发送过程中被修改")
+                    try_compress = try_compress or compressible[i]
+                    pos += n
+                digest = hashlib.sha256(data[:length]).digest()
+                
+                # 高熵数据或压缩效果不明显时按原样发送
+                compressed = None
+                if try_compress and estimate_entropy(data[:length]) < COMPRESS_ENTROPY_LIMIT:
+                    compressed = zlib.compress(data[:length], COMPRESS_LEVEL)
+                    if len(compressed) > length * COMPRESS_MAX_RATIO:
+                        compressed = None
+                if compressed is not None:
+                    s.sendall(CHUNK_HEADER.pack(index, FLAG_ZLIB, length, len(compressed), digest) + compressed)
+                    wire_length = len(compressed)
+                else:
+                    CHUNK_HEADER.pack_into(buffer, 0, index, 0, length, length, digest)
+                    s.sendall(view[:CHUNK_HEADER.size + length])
+                    wire_length = length
+                sent[0] += length
+                sent[1] += wire_length
+                self.metrics.progress(metrics_id, length, wire_length)
+            s.sendall(CHUNK_HEADER.pack(END_OF_STREAM, 0, 0, 0, bytes(32)))
+            
+            # 等待接收方确认这一段已写入
+            if recv_exact(s, 1) != ACK_OK:
+                errors.append("对方保存失败")
+        except Exception as e:
+            errors.append(str(e))
+        finally:
+            for f in handles.values():
+                f.close()
+            if s:
+                s.close()
+
+    def stop(self):
+        self.running = False
+        self.mode = "none"
+        
+        if self.tcp_server:
+            self.tcp_server.close()
+            self.tcp_server = None
+        
+        if self.connection_pool:
+            self.connection_pool.shutdown()
+            self.connection_pool = None
+        
+        if self.udp_broadcast:
+            self.udp_broadcast.close()
+            self.udp_broadcast = None
+        
+        if self.udp_listener:
+            self.udp_listener.close()
+            self.udp_listener = None
+        
+        with self.lock:
+            self.discovered_servers = []
+
+
+class FileTransferApp:
+    def __init__(self):
+        self.network = NetworkManager()
+        self.window = Tk()
+        self.window.title("局域网文件传输工具")
+        self.window.geometry("600x500")
+        
+        # 模式选择
+        self.mode_frame = Frame(self.window)
+        self.mode_frame.pack(pady=20)
+        
+        Label(self.mode_frame, text="选择模式:").grid(row=0, column=0, padx=5)
+        
+        self.mode_var = StringVar(value="none")
+        
+        Radiobutton(self.mode_frame, text="主机模式", variable=self.mode_var, 
+                   value="server", command=self.on_mode_change).grid(row=0, column=1, padx=5)
+        Radiobutton(self.mode_frame, text="客户端模式", variable=self.mode_var, 
+                   value="client", command=self.on_mode_change).grid(row=0, column=2, padx=5)
+        Button(self.mode_frame, text="传输监控", command=self.show_transfer_monitor).grid(row=0, column=3, padx=5)
+        
+        # 服务器配置
+        self.server_frame = Frame(self.window)
+        Label(self.server_frame, text="主机配置").pack(pady=5)
+        
+        Label(self.server_frame, text="主机名称:").pack()
+        self.name_entry = Entry(self.server_frame, width=30)
+        self.name_entry.pack()
+        self.name_entry.insert(0, "我的电脑")
+        
+        Label(self.server_frame, text="端口号:").pack()
+        self.port_entry = Entry(self.server_frame, width=10)
+        self.port_entry.pack()
+        self.port_entry.insert(0, str(DEFAULT_PORT))
+        
+        self.start_btn = Button(self.server_frame, text="启动服务", command=self.toggle_server)
+        self.start_btn.pack(pady=10)
+        
+        self.server_info_text = Label(self.server_frame, text="", justify="left")
+        self.server_info_text.pack(pady=5)
+        
+        # 客户端配置区域
+        self.client_frame = Frame(self.window)
+        Label(self.client_frame, text="客户端配置").pack(pady=5)
+        
+        self.refresh_btn = Button(self.client_frame, text="搜索主机", command=self.discover_servers)
+        self.refresh_btn.pack(pady=5)
+        
+        Label(self.client_frame, text="可用的主机:").pack()
+        self.server_list = Listbox(self.client_frame, width=70, height=10)
+        self.server_list.pack(pady=5, padx=10)
+        
+        Label(self.client_frame, text="并行连接数:").pack()
+        self.streams_entry = Entry(self.client_frame, width=10)
+        self.streams_entry.pack()
+        self.streams_entry.insert(0, str(DEFAULT_STREAMS))
+        
+        self.compress_var = BooleanVar(value=True)
+        Checkbutton(self.client_frame, text="传输时压缩（已压缩格式自动跳过）", variable=self.compress_var).pack()
+        
+        self.select_btn = Button(self.client_frame, text="选择文件并发送", 
+                               command=self.send_file, state="disabled")
+        self.select_btn.pack(pady=(10, 5))
+        
+        self.folder_btn = Button(self.client_frame, text="选择文件夹并发送", 
+                               command=self.send_folder, state="disabled")
+        self.folder_btn.pack(pady=(0, 10))
+        
+        # 初始状态
+        self.update_ui_based_on_mode()
+        
+        # 定期更新服务器列表
+        self.schedule_server_list_update()
+        
+        self.window.protocol("WM_DELETE_WINDOW", self.on_closing)
+
+    def on_mode_change(self):
+        # 停止当前活动
+        self.network.stop()
+        self.update_ui_based_on_mode()
+
+    def update_ui_based_on_mode(self):
+        mode = self.mode_var.get()
+        
+        # 隐藏所有框架
+        self.server_frame.pack_forget()
+        self.client_frame.pack_forget()
+        
+        if mode == "server":
+            self.server_frame.pack(fill="x", padx=20, pady=10)
+            self.start_btn.config(text="启动服务")
+            self.server_info_text.config(text="")
+        elif mode == "client":
+            self.client_frame.pack(fill="x", padx=20, pady=10)
+            self.refresh_btn.config(text="搜索主机", state="normal")
+            self.select_btn.config(state="disabled")
+            self.folder_btn.config(state="disabled")
+            self.server_list.delete(0, 'end')
+
+    def toggle_server(self):
+        if self.network.mode == "server" and self.network.running:
+            self.network.stop()
+            self.start_btn.config(text="启动服务")
+            self.server_info_text.config(text="服务已停止")
+        else:
+            name = self.name_entry.get().strip()
+            if not name:
+                messagebox.showerror("错误", "请输入主机名称")
+                return
+                
+            try:
+                port = int(self.port_entry.get().strip())
+                if port < 1 or port > 65535:
+                    raise ValueError
+            except:
+                messagebox.showerror("错误", "请输入有效的端口号 (1-65535)")
+                return
+                
+            if not self.network.start_server(name, port):
+                return
+            self.start_btn.config(text="停止服务")
+            info = f"IP: {self.network.server_info['ip']}\nMAC: {self.network.server_info['mac']}\n端口: {port}"
+            self.server_info_text.config(text=info)
+
+    def discover_servers(self):
+        self.server_list.delete(0, 'end')
+        self.refresh_btn.config(state="disabled", text="搜索中...")
+        self.select_btn.config(state="disabled")
+        self.folder_btn.config(state="disabled")
+        
+        # 确保网络处于客户端模式
+        if self.network.mode != "client":
+            self.network.stop()
+            self.network.start_client()
+        
+        # 清空之前的服务器列表，并立即重新发送发现请求
+        self.network.discovered_servers = []
+        self.network.request_discovery()
+
+    def update_server_list(self):
+        if self.network.mode != "client" or not self.network.running:
+            return
+            
+        servers = self.network.get_discovered_servers()
+        self.server_list.delete(0, 'end')
+        
+        for server in servers:
+            self.server_list.insert('end', 
+                f"{server['name']} | IP: {server['ip']} | MAC: {server['mac']} | 端口: {server['port']}")
+        
+        if servers:
+            self.select_btn.config(state="normal")
+            self.folder_btn.config(state="normal")
+            self.refresh_btn.config(state="normal", text="刷新列表")
+        else:
+            self.refresh_btn.config(state="normal", text="重新搜索")
+
+    def schedule_server_list_update(self):
+        if self.network.mode == "client" and self.network.running:
+            self.update_server_list()
+        self.window.after(2000, self.schedule_server_list_update)
+
+    def send_file(self):
+        """选择一个或多个文件发送"""
+        target = self.get_send_target()
+        if not target:
+            return
+        filepaths = filedialog.askopenfilenames(title="选择要发送的文件")
+        if not filepaths:
+            return
+        self.start_send(target, list(filepaths))
+
+    def send_folder(self):
+        """选择整个文件夹发送"""
+        target = self.get_send_target()
+        if not target:
+            return
+        folder = filedialog.askdirectory(title="选择要发送的文件夹")
+        if not folder:
+            return
+        self.start_send(target, [folder])
+
+    def get_send_target(self):
+        """检查所选主机和并行连接数，返回 (主机, 连接数)"""
+        selection = self.server_list.curselection()
+        if not selection:
+            messagebox.showwarning("提示", "请先选择一个主机")
+            return None
+            
+        servers = self.network.get_discovered_servers()
+        if not servers or selection[0] >= len(servers):
+            messagebox.showwarning("提示", "所选主机已不可用")
+            return None
+            
+        try:
+            streams = int(self.streams_entry.get().strip())
+            if streams < 1 or streams > MAX_STREAMS:
+                raise ValueError
+        except:
+            messagebox.showerror("错误", f"请输入有效的并行连接数 (1-{MAX_STREAMS})")
+            return None
+        return servers[selection[0]], streams
+
+    def start_send(self, target, paths):
+        server, streams = target
+        self.select_btn.config(state="disabled", text="发送中...")
+        self.folder_btn.config(state="disabled")
+        threading.Thread(target=self._send_files, args=(server, paths, streams, self.compress_var.get())).start()
+
+    def _send_files(self, server, paths, streams, compress):
+        stats = self.network.send_files(server, paths, streams, compress)
+        if stats:
+            messagebox.showinfo("成功", format_send_stats(stats))
+        self.select_btn.config(state="normal", text="选择文件并发送")
+        self.folder_btn.config(state="normal")
+
+    def show_transfer_monitor(self):
+        """传输监控窗口：进行中和最近结束的传输，以及各主机的往返时延，定时刷新"""
+        monitor = Toplevel(self.window)
+        monitor.title("传输监控")
+        monitor.geometry("860x460")
+        
+        totals_label = Label(monitor, text="", anchor="w", justify="left")
+        totals_label.pack(fill="x", padx=10, pady=(10, 0))
+        
+        columns = [("peer", "对方", 110), ("name", "文件", 180), ("direction", "方向", 50),
+                   ("progress", "进度", 130), ("speed", "速度", 90), ("duration", "用时", 70),
+                   ("stall", "停顿", 70), ("retries", "重试", 50), ("status", "状态", 120)]
+        transfer_tree = ttk.Treeview(monitor, columns=[c[0] for c in columns], show="headings")
+        for name, text, width in columns:
+            transfer_tree.heading(name, text=text)
+            transfer_tree.column(name, width=width)
+        transfer_tree.pack(fill="both", expand=True, padx=10, pady=10)
+        
+        columns = [("host", "主机", 160), ("last", "最近时延", 100), ("smoothed", "平滑时延", 100),
+                   ("min", "最小", 100), ("max", "最大", 100), ("samples", "样本数", 80)]
+        latency_tree = ttk.Treeview(monitor, columns=[c[0] for c in columns], show="headings", height=4)
+        for name, text, width in columns:
+            latency_tree.heading(name, text=text)
+            latency_tree.column(name, width=width)
+        latency_tree.pack(fill="x", padx=10, pady=(0, 10))
+        
+        def refresh():
+            if not monitor.winfo_exists():
+                return
+            snapshot = self.network.metrics.snapshot()
+            transfer_tree.delete(*transfer_tree.get_children())
+            for transfer in snapshot['active'] + snapshot['finished']:
+                status = (transfer['error'] or "完成") if 'end' in transfer else "进行中"
+                transfer_tree.insert("", "end", values=[
+                    transfer['peer'], transfer['name'],
+                    "发送" if transfer['direction'] == 'send' else "接收",
+                    f"{transfer['bytes'] / 1024 / 1024:.1f}/{transfer['total'] / 1024 / 1024:.1f} MB",
+                    format_speed(transfer['bytes'], transfer['duration']),
+                    f"{transfer['duration']:.1f} 秒", f"{transfer['stall']:.1f} 秒",
+                    transfer['retries'], status])
+            
+            latency_tree.delete(*latency_tree.get_children())
+            for ip, entry in snapshot['latency'].items():
+                latency_tree.insert("", "end", values=[
+                    f"{entry['name']} ({ip})",
+                    *(f"{entry[key] * 1000:.1f} 毫秒" for key in ('last', 'smoothed', 'min', 'max')),
+                    entry['samples']])
+            
+            totals = snapshot['totals']
+            totals_label.config(text=f"已发送 {totals['sent_bytes'] / 1024 / 1024:.1f} MB，已接收 "
+                                     f"{totals['received_bytes'] / 1024 / 1024:.1f} MB，完成 {totals['completed']} 次，"
+                                     f"失败 {totals['failed']} 次\n统计文件: {STATS_FILE}")
+            monitor.after(METRICS_REFRESH_INTERVAL, refresh)
+        
+        refresh()
+
+    def on_closing(self):
+        self.network.stop()
+        self.window.destroy()
+
+    def run(self):
+        self.window.mainloop()
+
+
+def format_send_stats(stats):
+    """格式化发送完成后的统计"""
+    resumed = f"，续传跳过 {stats['resumed'] / 1024 / 1024:.1f} MB" if stats['resumed'] else ""
+    ratio = (f"\n压缩后为原大小的 {stats['ratio']:.0%}，实际传输速度 {stats['wire_speed']}"
+             if stats['ratio'] < 1 else "")
+    return (f"{stats['files']} 个文件发送完成!\n"
+            f"{stats['streams']} 个连接，用时 {stats['elapsed']:.1f} 秒，有效速度 {stats['speed']}{resumed}{ratio}")
+
+
+def discover(network, timeout):
+    """在局域网中搜索主机，等待timeout秒后返回找到的主机"""
+    network.start_client()
+    time.sleep(timeout)
+    servers = network.get_discovered_servers()
+    network.stop()
+    return servers
+
+
+def parse_target(network, target, by_name, timeout):
+    """把 主机[:端口] 或主机名称解析为服务信息"""
+    if by_name:
+        for server in discover(network, timeout):
+            if server['name'] == target:
+                return server
+        raise ValueError(f"{timeout} 秒内未找到名为 {target} 的主机")
+    host, sep, port = target.rpartition(':')
+    if not sep or not port.isdigit():
+        host, port = target, DEFAULT_PORT
+    return {"name": host, "ip": host, "port": int(port)}
+
+
+def run_cli(args):
+    """命令行模式：serve 无人值守接收，send 脚本化发送，list 搜索主机；返回退出码"""
+    if args.command == "serve":
+        save_dir = os.path.abspath(args.dir)
+        os.makedirs(save_dir, exist_ok=True)
+        network = NetworkManager(save_dir=save_dir, naming=args.naming, notify=console_notify)
+        if not network.start_server(args.name, args.port):
+            return 1
+        console_notify("info", "服务已启动", f"{args.name} {network.server_info['ip']}:{args.port}，"
+                       f"保存到 {save_dir}，同名文件{NAMING_POLICIES[args.naming]}，统计文件 {STATS_FILE}")
+        try:
+            while network.running:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            network.stop()
+        return 0
+    
+    network = NetworkManager(notify=console_notify)
+    if args.command == "list":
+        for server in discover(network, args.timeout):
+            print(f"{server['name']}\t{server['ip']}:{server['port']}\t{server['mac']}")
+        return 0
+    
+    try:
+        server = parse_target(network, args.target, args.by_name, args.timeout)
+    except ValueError as e:
+        console_notify("error", "错误", str(e))
+        return 2
+    stats = network.send_files(server, args.paths, args.streams, not args.no_compress)
+    if not stats:
+        return 1
+    console_notify("info", "成功", format_send_stats(stats).replace("\n", "，"))
+    return 0
+
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description="局域网文件传输工具，不带命令时启动图形界面")
+    commands = parser.add_subparsers(dest="command")
+    
+    serve = commands.add_parser("serve", help="无人值守接收，不需要图形界面")
+    serve.add_argument("--dir", required=True, help="接收目录")
+    serve.add_argument("--name", default=socket.gethostname(), help="广播的主机名称，默认为计算机名")
+    serve.add_argument("--port", type=int, default=DEFAULT_PORT)
+    serve.add_argument("--naming", choices=list(NAMING_POLICIES), default="rename",
+                       help="与已有文件同名时: rename 自动加序号，overwrite 覆盖，skip 拒绝接收")
+    
+    send = commands.add_parser("send", help="发送文件或文件夹")
+    send.add_argument("target", help="主机[:端口]，使用 --by-name 时为主机名称")
+    send.add_argument("paths", nargs="+", help="要发送的文件或文件夹，全部作为一次传输")
+    send.add_argument("--by-name", action="store_true", help="通过局域网发现按主机名称查找")
+    send.add_argument("--timeout", type=float, default=3.0, help="按名称查找主机的等待时间(秒)")
+    send.add_argument("--streams", type=int, choices=range(1, MAX_STREAMS + 1), default=DEFAULT_STREAMS,
+                      metavar=f"1-{MAX_STREAMS}", help="并行连接数")
+    send.add_argument("--no-compress", action="store_true", help="传输时不压缩")
+    
+    listing = commands.add_parser("list", help="搜索局域网中的主机")
+    listing.add_argument("--timeout", type=float, default=3.0, help="等待时间(秒)")
+    return parser
+
+
+if __name__ == "__main__":
+    parser = build_arg_parser()
+    args = parser.parse_args()
+    if args.command:
+        sys.exit(run_cli(args))
+    if Tk is None:
+        parser.error("未安装tkinter，只能使用 serve、send 或 list 命令")
+    app = FileTransferApp()
     app.run()
\ No newline at end of file